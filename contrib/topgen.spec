@@ -12,7 +12,9 @@ Requires: coreutils, gawk, grep, sed, openssl, iproute
 Requires: bind, nginx, wget
 Requires: dovecot, postfix
 Requires: tor
-Requires: python3, python3-enlighten
+Requires: python3, python3-enlighten, python3-cryptography
+# topgen-scrape.py --engine native (h2 for HTTP/2), and --compress brotli:
+Recommends: python3-httpx, python3-h2, python3-brotli
 BuildRequires: systemd-units
 BuildArch: noarch
 
@@ -0,0 +1,432 @@
+#!/bin/python3
+
+# Benchmark TopGen on the host it runs on: generate a synthetic fleet of
+# vhosts, time the real topgen-scrape.py stages (and topgen-mkdns.py) on
+# it, then serve the fleet with nginx and load it with HTTP and HTTPS
+# clients. Results are written as JSON, for tracking regressions across
+# releases and sizing hardware.
+
+import importlib.util
+import argparse
+import asyncio
+import datetime
+import glob
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+SBIN = os.path.dirname(os.path.realpath(__file__))
+
+# topgen-scrape.py isn't an importable module name, so load it by path:
+spec = importlib.util.spec_from_file_location("topgen_scrape", os.path.join(SBIN, "topgen-scrape.py"))
+tg = importlib.util.module_from_spec(spec)
+sys.modules["topgen_scrape"] = tg
+spec.loader.exec_module(tg)
+
+# templates: from the source tree when run from it, installed ones otherwise
+BENCH_TEMPLATES = os.path.join(os.path.dirname(SBIN), "templates", "topgen-scrape")
+if not os.path.isdir(BENCH_TEMPLATES):
+    BENCH_TEMPLATES = tg.TOPGEN_TEMPLATES
+
+# Synthetic fleet defaults: BENCH_VHOSTS vhosts spread across BENCH_TLDS, each with an index page,
+# BENCH_PAGES further pages, a stylesheet and a BENCH_ASSET_SIZE byte image
+BENCH_VHOSTS = 1000
+BENCH_TLDS = ('com', 'org', 'net', 'edu', 'gov', 'io', 'de', 'co.uk')
+BENCH_PAGES = 4
+BENCH_ASSET_SIZE = 16384
+
+# Load generation: BENCH_CONNECTIONS concurrent connections per client process, for
+# BENCH_DURATION seconds per phase (keep-alive HTTP, keep-alive HTTPS, one HTTPS request per handshake)
+BENCH_CLIENTS = max(1, (os.cpu_count() or 1) // 2)
+BENCH_CONNECTIONS = 32
+BENCH_DURATION = 10.0
+BENCH_HTTP_PORT = 8080
+BENCH_HTTPS_PORT = 8443
+
+NGINX_MAIN_CONF = '''worker_processes auto;
+daemon off;
+pid {work}/nginx.pid;
+error_log {work}/nginx.error.log;
+worker_rlimit_nofile {nofile};
+
+events {{
+	worker_connections 4096;
+}}
+
+http {{
+	access_log off;
+	client_body_temp_path {work}/nginx.tmp/client_body;
+	proxy_temp_path {work}/nginx.tmp/proxy;
+	fastcgi_temp_path {work}/nginx.tmp/fastcgi;
+	uwsgi_temp_path {work}/nginx.tmp/uwsgi;
+	scgi_temp_path {work}/nginx.tmp/scgi;
+	include {nginx_conf};
+}}
+'''
+
+PAGE = '''<html><head><title>{vhost} page {page}</title>
+<link rel="stylesheet" href="/style.css"></head>
+<body><h1>{vhost}</h1><img src="/logo.png">
+{links}
+<p>{text}</p>
+</body></html>
+'''
+
+LOREM = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua. ") * 20
+
+
+def fleet_names(count):
+    """Return count distinct vhost names, about half of them www. variants of a domain"""
+    names = []
+    for i in range(count):
+        domain = f"bench{i // 2}.{BENCH_TLDS[i % len(BENCH_TLDS)]}"
+        names.append(f"www.{domain}" if i % 2 else domain)
+    return names
+
+
+def fleet_address(i):
+    """Distinct (fake, public looking) address for the i-th vhost"""
+    return f"{11 + i // 65024}.{(i // 254) % 256}.{i % 254 + 1}.{(i * 7) % 254 + 1}"
+
+
+def generate_fleet(names, pages, asset_size):
+    """Write a content tree for each vhost, like a (small) scraped site"""
+    logo = random.randbytes(asset_size)
+    style = "body { font-family: sans-serif; }\n" * 32
+    for name in names:
+        root = os.path.join(tg.TOPGEN_VHOSTS, name)
+        os.makedirs(root, exist_ok=True)
+        links = ''.join(f'<a href="/page{p}.html">page {p}</a>\n' for p in range(pages))
+        for page in ['index'] + [f'page{p}' for p in range(pages)]:
+            with open(os.path.join(root, f'{page}.html'), 'w') as f:
+                f.write(PAGE.format(vhost=name, page=page, links=links, text=LOREM))
+        with open(os.path.join(root, 'style.css'), 'w') as f:
+            f.write(style)
+        with open(os.path.join(root, 'logo.png'), 'wb') as f:
+            f.write(logo)
+
+
+async def timed(results, name, coro):
+    """Await coro, recording its wall-clock time in results['stages'][name]"""
+    started = time.monotonic()
+    value = await coro
+    results['stages'][name] = round(time.monotonic() - started, 3)
+    logging.info(f"{name}: {results['stages'][name]}s")
+    return value
+
+
+def run_mkdns(work):
+    """Run topgen-mkdns.py on the generated hosts.nginx"""
+    named = os.path.join(work, "named")
+    os.makedirs(named, exist_ok=True)
+    delegations = os.path.join(work, "delegations.dns")
+    with open(delegations, 'w') as f:
+        f.write("declare -A DELEGATIONS_FWD=(\n)\ndeclare -A DELEGATIONS_REV=(\n)\ndeclare -A DELEGATIONS_NS=(\n)\n")
+    subprocess.run([sys.executable, os.path.join(SBIN, "topgen-mkdns.py"), "-fq",
+                    "-w", os.path.join(tg.TOPGEN_VARETC, "hosts.nginx"), "-m", os.path.join(work, "hosts.vmail"),
+                    "-d", delegations, "-n", os.path.join(tg.TOPGEN_VARETC, "hosts.named"),
+                    "-c", os.path.join(tg.TOPGEN_VARETC, "named.conf"), "-z", named], check=True)
+
+
+def bench_templates(work, http_port, https_port):
+    """Copy the nginx templates, with server blocks listening on unprivileged loopback ports"""
+    templates = os.path.join(work, "templates")
+    shutil.copytree(BENCH_TEMPLATES, templates, dirs_exist_ok=True)
+    for name in ("nginx.conf_vhost", "nginx.conf_group"):
+        path = os.path.join(templates, name)
+        with open(path) as f:
+            text = f.read()
+        text = text.replace("listen 80;", f"listen 127.0.0.1:{http_port};")
+        text = text.replace("listen 443 ssl;", f"listen 127.0.0.1:{https_port} ssl;")
+        with open(path, 'w') as f:
+            f.write(text)
+    return templates
+
+
+def process_tree_rss(pid):
+    """Resident memory (bytes) of pid and all its children"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+    total, todo = 0, [pid]
+    while todo:
+        current = todo.pop()
+        todo.extend(children.get(current, []))
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+# Load generator (runs inside BENCH_CLIENTS processes)
+
+async def http_request(reader, writer, vhost, path):
+    """Send a GET request on an open connection and read the response; returns the status code"""
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {vhost}\r\nUser-Agent: topgen-bench\r\n\r\n".encode())
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode('latin-1').split("\r\n")
+    status = int(lines[0].split()[1])
+    length = 0
+    for line in lines[1:]:
+        if line.lower().startswith("content-length:"):
+            length = int(line.split(":", 1)[1])
+    await reader.readexactly(length)
+    return status
+
+
+async def load_connection(stats, deadline, vhosts, port, tls, keepalive):
+    """Issue requests for random vhost pages until deadline, recording latencies"""
+    context = None
+    if tls:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    paths = ['/', '/page0.html', '/style.css', '/logo.png']
+    reader = writer = None
+    while time.monotonic() < deadline:
+        vhost = random.choice(vhosts)
+        started = time.monotonic()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port, ssl=context, server_hostname=vhost if tls else None)
+                if tls:
+                    stats['handshakes'] += 1
+            status = await http_request(reader, writer, vhost, random.choice(paths))
+            stats['latencies'].append(time.monotonic() - started)
+            stats['requests'] += 1
+            if status != 200:
+                stats['errors'] += 1
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, IndexError):
+            stats['errors'] += 1
+            keepalive = keepalive and stats['errors'] < 1000
+            if writer:
+                writer.close()
+            reader = writer = None
+            continue
+        if not keepalive:
+            writer.close()
+            reader = writer = None
+    if writer:
+        writer.close()
+
+
+def load_client(vhosts, port, tls, keepalive, connections, duration):
+    """Run connections concurrent load connections for duration seconds (in a client process)"""
+    stats = {'requests': 0, 'handshakes': 0, 'errors': 0, 'latencies': []}
+
+    async def run():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(load_connection(stats, deadline, vhosts, port, tls, keepalive)
+                               for _ in range(connections)))
+    asyncio.run(run())
+    return stats
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_load(vhosts, port, tls, keepalive, clients, connections, duration):
+    """Load the server from clients processes; returns requests/s, handshakes/s and latencies"""
+    with tg.process_pool(clients) as pool:
+        started = time.monotonic()
+        futures = [pool.submit(load_client, vhosts, port, tls, keepalive, connections, duration)
+                   for _ in range(clients)]
+        results = [future.result() for future in futures]
+        elapsed = time.monotonic() - started
+    latencies = [l for r in results for l in r['latencies']]
+    requests = sum(r['requests'] for r in results)
+    return {
+        'requests': requests,
+        'errors': sum(r['errors'] for r in results),
+        'requests_per_s': round(requests / elapsed, 1),
+        'handshakes_per_s': round(sum(r['handshakes'] for r in results) / elapsed, 1) if tls else None,
+        'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    }
+
+
+def load_test(args, work, names, results):
+    """Serve the fleet with nginx and load it; fills in results['nginx'] and results['load']"""
+    nginx = shutil.which(args.nginx) or (args.nginx if os.path.isfile(args.nginx) else None)
+    if not nginx:
+        results['load'] = {'skipped': f"{args.nginx} not found"}
+        logging.warning(f"Skipping load test: {args.nginx} not found")
+        return
+    os.makedirs(os.path.join(work, "nginx.tmp"), exist_ok=True)
+    main_conf = os.path.join(work, "nginx.bench.conf")
+    with open(main_conf, 'w') as f:
+        f.write(NGINX_MAIN_CONF.format(work=work, nofile=tg.TOPGEN_NOFILE,
+                                       nginx_conf=os.path.join(tg.TOPGEN_VARETC, "nginx.conf")))
+    started = time.monotonic()
+    proc = subprocess.Popen([nginx, "-p", work, "-c", main_conf])
+    try:
+        if not (wait_for_port(args.http_port, 600) and wait_for_port(args.https_port, 60)):
+            results['load'] = {'skipped': "nginx did not start, see nginx.error.log"}
+            return
+        results['nginx'] = {'startup_s': round(time.monotonic() - started, 3),
+                            'rss_bytes_idle': process_tree_rss(proc.pid)}
+        phases = {'http': (args.http_port, False, True),
+                  'https': (args.https_port, True, True),
+                  'https_handshake': (args.https_port, True, False)}
+        results['load'] = {}
+        for phase, (port, tls, keepalive) in phases.items():
+            logging.info(f"Load phase {phase}: {args.clients} clients x {args.connections} connections, {args.duration}s")
+            results['load'][phase] = run_load(names, port, tls, keepalive,
+                                              args.clients, args.connections, args.duration)
+            logging.info(f"{phase}: {results['load'][phase]}")
+        results['nginx']['rss_bytes_loaded'] = process_tree_rss(proc.pid)
+    finally:
+        proc.send_signal(signal.SIGQUIT)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def cert_files():
+    """{path: (inode, mtime)} of the vhost certificates on disk; certificates are written to a
+    temporary file renamed into place, so each one (re)written gets a new inode"""
+    files = {}
+    for directory in (tg.TOPGEN_CERTS, tg.TOPGEN_SHARED_CERTS):
+        for path in glob.glob(os.path.join(directory, "*.cer")):
+            st = os.stat(path)
+            files[path] = (st.st_ino, st.st_mtime_ns)
+    return files
+
+
+async def run_stages(args, work, names, results):
+    """Run the topgen-scrape.py stages (and topgen-mkdns.py) on the synthetic fleet, timing each"""
+    loop = asyncio.get_running_loop()
+    await timed(results, 'fleet', loop.run_in_executor(None, generate_fleet, names, args.pages, args.asset_size))
+    await timed(results, 'postprocess', tg.postprocess_vhosts())
+    if args.compress:
+        tg.TOPGEN_COMPRESS = args.compress
+        await timed(results, 'compress', tg.compress_vhosts())
+    await timed(results, 'ca', tg.generate_CA())
+    before = cert_files()
+    await timed(results, 'certs', tg.generate_vhost_certificates())
+    after = cert_files()
+    written = sum(1 for path, key in after.items() if before.get(path) != key)
+    results['rates']['certs_per_s'] = round(written / max(results['stages']['certs'], 0.001), 1)
+
+    # resolve against a local stub DNS server, once from scratch and once from the resolve cache:
+    # (postprocess added the landing page vhost, so list what's actually there)
+    vhosts = sorted(os.listdir(tg.TOPGEN_VHOSTS))
+    records = {name: fleet_address(i) for i, name in enumerate(vhosts)}
+    transport, port = await tg.StubDNSServer.start(records)
+    tg.TOPGEN_RESOLVERS = f"127.0.0.1:{port}"
+    try:
+        await timed(results, 'hosts', tg.generate_hosts_nginx())
+        await timed(results, 'hosts_cached', tg.generate_hosts_nginx())
+    finally:
+        transport.close()
+    results['rates']['resolutions_per_s'] = round(len(vhosts) / max(results['stages']['hosts'], 0.001), 1)
+
+    await timed(results, 'nginx', tg.generate_nginx_conf(tg.TOPGEN_NGINX_SHARDS))
+    await timed(results, 'mkdns', loop.run_in_executor(None, run_mkdns, work))
+
+
+def host_info():
+    try:
+        with open('/proc/meminfo') as f:
+            memory = int(f.readline().split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        memory = None
+    return {'hostname': socket.gethostname(), 'cpus': os.cpu_count(), 'memory_bytes': memory,
+            'kernel': platform.release(), 'python': platform.python_version(),
+            'openssl': ssl.OPENSSL_VERSION}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TopGen: time the topgen-scrape.py stages and topgen-mkdns.py on a synthetic fleet of vhosts, then load the resulting nginx configuration with HTTP and HTTPS clients, and report the results as JSON.", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-N", "--vhosts", help=f"number of vhosts in the synthetic fleet;\n(default: {BENCH_VHOSTS})", type=int, default=BENCH_VHOSTS)
+    parser.add_argument("--pages", help=f"number of pages per vhost besides index.html;\n(default: {BENCH_PAGES})", type=int, default=BENCH_PAGES)
+    parser.add_argument("--asset-size", help=f"size in bytes of each vhost's image;\n(default: {BENCH_ASSET_SIZE})", type=int, default=BENCH_ASSET_SIZE)
+    parser.add_argument("--cert-mode", help=f"certificate mode, as for topgen-scrape.py;\n(default: {tg.TOPGEN_CERT_MODE})", choices=["vhost", "domain", "bucket"], default=tg.TOPGEN_CERT_MODE)
+    parser.add_argument("--compress", help="also time sidecar compression, as for topgen-scrape.py;\n(default: no)", choices=["gzip", "brotli"])
+    parser.add_argument("-w", "--work-dir", help="directory to generate the fleet in, which is kept afterwards;\n(default: a temporary directory, removed afterwards)")
+    parser.add_argument("--nginx", help="nginx binary serving the fleet for the load test;\n(default: nginx)", default="nginx")
+    parser.add_argument("--no-load", help="only time the stages, skip the load test", action="store_true")
+    parser.add_argument("-c", "--clients", help=f"number of load generating client processes;\n(default: {BENCH_CLIENTS})", type=int, default=BENCH_CLIENTS)
+    parser.add_argument("--connections", help=f"concurrent connections per client process;\n(default: {BENCH_CONNECTIONS})", type=int, default=BENCH_CONNECTIONS)
+    parser.add_argument("-d", "--duration", help=f"seconds per load phase;\n(default: {BENCH_DURATION})", type=float, default=BENCH_DURATION)
+    parser.add_argument("--http-port", help=f"loopback port the fleet is served on over HTTP;\n(default: {BENCH_HTTP_PORT})", type=int, default=BENCH_HTTP_PORT)
+    parser.add_argument("--https-port", help=f"loopback port the fleet is served on over HTTPS;\n(default: {BENCH_HTTPS_PORT})", type=int, default=BENCH_HTTPS_PORT)
+    parser.add_argument("-o", "--output", help="file to write the JSON results to;\n(default: standard output)")
+    args = parser.parse_args()
+
+    tg.setup_process(logging.INFO)
+    tg.logger.setLevel(logging.INFO)
+
+    work = os.path.realpath(args.work_dir or tempfile.mkdtemp(prefix="topgen-bench."))
+    tg.set_target_dir(work)
+    tg.TOPGEN_CUSTOM_VHOSTS = os.path.join(work, "custom_vhosts")
+    tg.TOPGEN_TEMPLATES = bench_templates(work, args.http_port, args.https_port)
+    tg.TOPGEN_CERT_MODE = args.cert_mode
+    names = fleet_names(args.vhosts)
+
+    results = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'host': host_info(),
+        'params': {'vhosts': args.vhosts, 'pages': args.pages, 'asset_size': args.asset_size,
+                   'cert_mode': args.cert_mode, 'compress': args.compress, 'clients': args.clients,
+                   'connections': args.connections, 'duration': args.duration},
+        'stages': {},
+        'rates': {},
+    }
+    try:
+        asyncio.run(run_stages(args, work, names, results))
+        if not args.no_load:
+            load_test(args, work, names, results)
+    finally:
+        tg.manager.stop()
+        if not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    output = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,467 @@
+#!/bin/python3
+
+# Issue TopGen vhost certificates on demand (topgen-scrape.py --cert-mode lazy):
+# nginx accepts HTTPS connections in a stream block, reads the requested name
+# (SNI) from the TLS ClientHello, and passes connections for names without a
+# certificate on to this service, which signs one with the TopGen CA, adds the
+# name to the map nginx routes by (reloading nginx), and meanwhile relays the
+# connection, ClientHello included, to nginx's vhost server blocks. Signing thus
+# scales with the vhosts actually visited rather than with the size of the fleet,
+# and once nginx has been reloaded, it serves the vhost's connections directly.
+
+import importlib.util
+import argparse
+import asyncio
+import hashlib
+import glob
+import logging
+import os
+import resource
+import shlex
+import signal
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+SBIN = os.path.dirname(os.path.realpath(__file__))
+
+# topgen-scrape.py isn't an importable module name, so load it by path:
+spec = importlib.util.spec_from_file_location("topgen_scrape", os.path.join(SBIN, "topgen-scrape.py"))
+tg = importlib.util.module_from_spec(spec)
+sys.modules["topgen_scrape"] = tg
+spec.loader.exec_module(tg)
+
+# Addresses nginx's stream block (see nginx.conf_stream) passes connections to ([host]:port, an
+# empty host means all addresses), prefixed with a PROXY protocol header, and the nginx listener
+# (see nginx.conf_lazy) they are handed on to
+CERTD_LISTEN = tg.TOPGEN_LAZY_CERTD
+CERTD_BACKEND = tg.TOPGEN_LAZY_BACKEND
+
+# Names issued (or evicted) are written to TOPGEN_LAZY_MAP, and nginx reloaded with CERTD_RELOAD,
+# at most every CERTD_RELOAD_INTERVAL seconds
+CERTD_RELOAD = "nginx -s reload"
+CERTD_RELOAD_INTERVAL = 10
+
+# Issued certificates are kept in TOPGEN_LAZY_CERTS, least recently seen ones are removed beyond
+# CERTD_MAX_CERTS (nginx serves names in the map without asking, so they are seen when issued, or
+# when connected to before nginx has been reloaded); file modification times record that (updated
+# at most every CERTD_TOUCH_INTERVAL seconds), so the order survives restarts
+CERTD_MAX_CERTS = 50000
+CERTD_TOUCH_INTERVAL = 3600
+
+# Server names are looked up lowercased and without a trailing dot, as nginx's map does, but until
+# nginx has been reloaded with a new name in the map, it loads the certificate named after the SNI
+# name as sent; other spellings of a vhost's name (at most CERTD_MAX_ALIASES of them) are symlinked
+# to its certificate
+CERTD_MAX_ALIASES = 8
+
+# Certificates are signed by CERTD_WORKERS processes, each loading the CA and vhost keys once
+CERTD_WORKERS = tg.TOPGEN_SIGN_WORKERS
+
+# Clients must send their ClientHello (of at most CERTD_HELLO_MAX bytes), after nginx's PROXY protocol
+# header, within CERTD_HELLO_TIMEOUT seconds
+CERTD_HELLO_TIMEOUT = 10
+CERTD_HELLO_MAX = 65536
+CERTD_BUFFER = 65536
+
+# Counters are logged every CERTD_STATS_INTERVAL seconds
+CERTD_STATS_INTERVAL = 300
+CERTD_NOFILE = 65536
+
+logger = logging.getLogger("topgen-certd")
+
+# TLS record and handshake types, and the server_name extension (RFC 8446, RFC 6066)
+TLS_HANDSHAKE = 22
+TLS_CLIENT_HELLO = 1
+TLS_EXT_SERVER_NAME = 0
+TLS_SNI_HOST_NAME = 0
+
+# PROXY protocol v1 headers, CRLF included, are at most this long
+PROXY_HEADER_MAX = 107
+
+
+def client_hello_sni(data):
+    """Return the SNI name of the ClientHello at the start of data ('' if there is none),
+    or None if more data is needed; raise ValueError if data isn't a ClientHello"""
+    handshake = b''
+    offset = 0
+    while True:
+        if len(handshake) >= 4:
+            length = int.from_bytes(handshake[1:4], 'big')
+            if len(handshake) >= 4 + length:
+                break
+        if len(data) < offset + 5:
+            return None
+        content_type, _, record_length = struct.unpack_from('!BHH', data, offset)
+        if content_type != TLS_HANDSHAKE:
+            raise ValueError("not a TLS handshake")
+        if len(data) < offset + 5 + record_length:
+            return None
+        handshake += data[offset + 5:offset + 5 + record_length]
+        offset += 5 + record_length
+    if handshake[0] != TLS_CLIENT_HELLO:
+        raise ValueError("not a ClientHello")
+
+    hello = handshake[4:4 + length]
+    try:
+        # legacy_version, random, then the variable length session id, cipher suites and compression methods:
+        pos = 2 + 32
+        pos += 1 + hello[pos]
+        pos += 2 + struct.unpack_from('!H', hello, pos)[0]
+        pos += 1 + hello[pos]
+        if pos >= len(hello):
+            return ''
+        end = pos + 2 + struct.unpack_from('!H', hello, pos)[0]
+        pos += 2
+        while pos + 4 <= end:
+            ext_type, ext_length = struct.unpack_from('!HH', hello, pos)
+            pos += 4
+            if ext_type == TLS_EXT_SERVER_NAME:
+                names_end = pos + 2 + struct.unpack_from('!H', hello, pos)[0]
+                pos += 2
+                while pos + 3 <= names_end:
+                    name_type, name_length = struct.unpack_from('!BH', hello, pos)
+                    pos += 3
+                    if name_type == TLS_SNI_HOST_NAME:
+                        return hello[pos:pos + name_length].decode('ascii')
+                    pos += name_length
+                return ''
+            pos += ext_length
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"malformed ClientHello: {e}")
+    return ''
+
+
+def parse_address(value, default_host=''):
+    """Split [host]:port into (host, port); IPv6 hosts go in brackets"""
+    host, _, port = value.rpartition(':')
+    return host.strip('[]') or default_host, int(port)
+
+
+def proxy_header(client, server):
+    """PROXY protocol (v1) header announcing the original client and server addresses"""
+    family = 'TCP6' if ':' in client[0] else 'TCP4'
+    return f"PROXY {family} {client[0]} {server[0]} {client[1]} {server[1]}\r\n".encode()
+
+
+def parse_proxy_header(line):
+    """Return the (client, server) addresses a PROXY protocol (v1) header announces, or
+    (None, None) for an UNKNOWN connection; raise ValueError if line isn't such a header"""
+    fields = line.decode('ascii', 'replace').split()
+    if len(line) > PROXY_HEADER_MAX or not fields or fields[0] != 'PROXY':
+        raise ValueError("no PROXY protocol header")
+    if fields[1:2] == ['UNKNOWN']:
+        return None, None
+    if len(fields) != 6 or fields[1] not in ('TCP4', 'TCP6'):
+        raise ValueError(f"malformed PROXY protocol header: {line!r}")
+    return (fields[2], int(fields[4])), (fields[3], int(fields[5]))
+
+
+class CertCache:
+    """Certificates issued to TOPGEN_LAZY_CERTS, in least recently seen order.
+
+    The names of all certificates on disk, and when their files were last touched, are kept
+    in memory, so a connection to a vhost whose certificate was issued before costs no file
+    system access at all; concurrent connections for a new name share a single signing job.
+    Changes are passed on to nginx by flush(), which certificates evicted meanwhile outlive.
+    """
+    def __init__(self, max_certs, pool, reload=None):
+        self.max_certs = max_certs
+        self.pool = pool
+        self.reload = reload
+        self.lru = OrderedDict()
+        self.aliases = {}
+        self.pending = {}
+        # {name: paths} of certificates evicted since the last flush, and as of the last flush:
+        self.evicted = {}
+        self.doomed = {}
+        self.flusher = None
+        self.flushing = None
+        self.stats = {'hits': 0, 'issued': 0, 'evicted': 0, 'failed': 0, 'reloads': 0}
+
+    def path(self, name):
+        return os.path.join(tg.TOPGEN_LAZY_CERTS, f"{name}.cer")
+
+    def load(self):
+        """Index the certificates on disk, dropping them all if the CA has changed since they were issued"""
+        os.makedirs(tg.TOPGEN_LAZY_CERTS, exist_ok=True)
+        with open(os.path.join(tg.TOPGEN_VARETC, "topgen_ca.cer"), 'rb') as f:
+            ca_digest = hashlib.sha256(f.read()).hexdigest()
+        marker = os.path.join(tg.TOPGEN_LAZY_CERTS, "ca.sha256")
+        try:
+            with open(marker) as f:
+                stale = f.read().strip() != ca_digest
+        except OSError:
+            stale = True
+
+        certs = []
+        aliases = []
+        for path in glob.glob(os.path.join(tg.TOPGEN_LAZY_CERTS, "*.cer")):
+            if stale:
+                os.remove(path)
+                continue
+            if os.path.islink(path):
+                aliases.append((os.path.basename(path)[:-len(".cer")], os.readlink(path)[:-len(".cer")]))
+                continue
+            try:
+                certs.append((os.stat(path).st_mtime, os.path.basename(path)[:-len(".cer")]))
+            except FileNotFoundError:
+                pass
+        if stale:
+            tg.write_atomic(marker, ca_digest + '\n')
+        for mtime, name in sorted(certs):
+            self.lru[name] = mtime
+        for alias, name in aliases:
+            if name in self.lru:
+                self.aliases.setdefault(name, set()).add(alias)
+            else:
+                os.remove(self.path(alias))
+        self.evict()
+        logger.info(f"{len(self.lru)} certificates on disk" + (" (dropped those of a previous CA)" if stale else ""))
+
+    def evict(self):
+        """Forget the least recently seen certificates beyond max_certs; nginx may still route their
+        names to itself until it has been reloaded, so their files are removed by the flush after next"""
+        while len(self.lru) > self.max_certs:
+            name, _ = self.lru.popitem(last=False)
+            self.evicted[name] = [self.path(name)] + [self.path(alias) for alias in self.aliases.pop(name, ())]
+            self.stats['evicted'] += 1
+
+    def changed(self):
+        """Have the names on disk passed on to nginx within CERTD_RELOAD_INTERVAL seconds"""
+        if self.flusher is None:
+            self.flusher = asyncio.get_running_loop().call_later(CERTD_RELOAD_INTERVAL, self.start_flush)
+
+    def start_flush(self):
+        self.flusher = None
+        self.flushing = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        """Write the names with a certificate to TOPGEN_LAZY_MAP and reload nginx, then remove the
+        certificates evicted before the previous flush (unless they have been issued again since)"""
+        if self.flusher:
+            self.flusher.cancel()
+            self.flusher = None
+        doomed, self.doomed, self.evicted = self.doomed, self.evicted, {}
+        tg.write_atomic(tg.TOPGEN_LAZY_MAP, ''.join(f"{name} {name};\n" for name in sorted(self.lru)))
+        if self.reload:
+            try:
+                proc = await asyncio.create_subprocess_exec(*self.reload)
+                if await proc.wait():
+                    logger.warning(f"{shlex.join(self.reload)} exited with status {proc.returncode}")
+                else:
+                    self.stats['reloads'] += 1
+            except OSError as e:
+                logger.warning(f"Unable to reload nginx: {e}")
+        for name, paths in doomed.items():
+            if name in self.lru:
+                continue
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def alias(self, name, alias):
+        """Make the certificate of name available under alias, another spelling of it"""
+        aliases = self.aliases.setdefault(name, set())
+        if alias in aliases or len(aliases) >= CERTD_MAX_ALIASES:
+            return
+        try:
+            os.symlink(f"{name}.cer", self.path(alias))
+        except FileExistsError:
+            pass
+        aliases.add(alias)
+
+    async def ensure(self, name):
+        """Make sure a certificate for name is on disk, signing one if necessary"""
+        now = time.time()
+        if name in self.lru:
+            self.lru.move_to_end(name)
+            if now - self.lru[name] < CERTD_TOUCH_INTERVAL:
+                self.stats['hits'] += 1
+                return
+            try:
+                os.utime(self.path(name))
+                self.lru[name] = now
+                self.stats['hits'] += 1
+                return
+            except FileNotFoundError:
+                # removed behind our back, issue it again:
+                del self.lru[name]
+
+        job = self.pending.get(name)
+        if job is None:
+            loop = asyncio.get_running_loop()
+            job = loop.run_in_executor(self.pool, tg.sign_batch, [(self.path(name), [name])])
+            self.pending[name] = job
+            job.add_done_callback(lambda _: self.pending.pop(name, None))
+            job.add_done_callback(lambda job: self.issued(name, job))
+        # a client giving up mustn't cancel the job other clients may be waiting for:
+        await asyncio.shield(job)
+
+    def issued(self, name, job):
+        if job.cancelled() or job.exception():
+            self.stats['failed'] += 1
+            logger.error(f"[{name}] Failed signing certificate: {job.exception() if not job.cancelled() else 'cancelled'}")
+            return
+        self.lru[name] = time.time()
+        self.stats['issued'] += 1
+        self.evict()
+        self.changed()
+        logger.debug(f"[{name}] Issued certificate")
+
+
+class CertService:
+    """Accept HTTPS connections from nginx's stream block, and hand them back to nginx's vhost
+    server blocks once their vhost's certificate exists"""
+    def __init__(self, cache, backend):
+        self.cache = cache
+        self.backend = backend
+        self.stats = {'connections': 0, 'active': 0, 'rejected': 0, 'errors': 0}
+
+    def vhost(self, sni):
+        """Return the vhost name the SNI name refers to, or None if there's no such vhost"""
+        if not sni or sni.startswith('.') or '/' in sni or '\0' in sni:
+            return None
+        name = sni.lower().rstrip('.')
+        if name not in self.cache.lru and not os.path.isdir(os.path.join(tg.TOPGEN_VHOSTS, name)):
+            return None
+        return name
+
+    async def handle(self, reader, writer):
+        self.stats['connections'] += 1
+        self.stats['active'] += 1
+        client = writer.get_extra_info('peername')
+        backend_writer = None
+        try:
+            header = await asyncio.wait_for(reader.readline(), CERTD_HELLO_TIMEOUT)
+            if not header:
+                return
+            announced, server = parse_proxy_header(header)
+            if announced:
+                client = announced
+            else:
+                server = writer.get_extra_info('sockname')
+            hello, sni = await asyncio.wait_for(self.read_client_hello(reader), CERTD_HELLO_TIMEOUT)
+            if hello is None:
+                return
+            name = self.vhost(sni)
+            if name is None:
+                self.stats['rejected'] += 1
+                logger.debug(f"{client[0]}: no vhost for SNI name '{sni}'")
+                return
+            await self.cache.ensure(name)
+            if sni != name:
+                self.cache.alias(name, sni)
+
+            backend_reader, backend_writer = await asyncio.open_connection(*self.backend)
+            backend_writer.write(proxy_header(client, server) + hello)
+            await asyncio.gather(self.pipe(reader, backend_writer), self.pipe(backend_reader, writer))
+        except (ValueError, asyncio.TimeoutError) as e:
+            self.stats['rejected'] += 1
+            logger.debug(f"{client[0]}: {e or 'timed out waiting for ClientHello'}")
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.debug(f"{client[0]}: {type(e).__name__}: {e}")
+        finally:
+            self.stats['active'] -= 1
+            for w in (writer, backend_writer):
+                if w:
+                    w.close()
+
+    @staticmethod
+    async def read_client_hello(reader):
+        """Return the ClientHello's bytes and SNI name, or (None, None) if the client hung up first"""
+        hello = b''
+        while True:
+            data = await reader.read(CERTD_BUFFER)
+            if not data:
+                return None, None
+            hello += data
+            sni = client_hello_sni(hello)
+            if sni is not None:
+                return hello, sni
+            if len(hello) > CERTD_HELLO_MAX:
+                raise ValueError("ClientHello too large")
+
+    @staticmethod
+    async def pipe(reader, writer):
+        """Copy data until EOF, which is passed on (half-closing the connection)"""
+        while data := await reader.read(CERTD_BUFFER):
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            try:
+                writer.write_eof()
+            except OSError:
+                # the other side has hung up already
+                pass
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(CERTD_STATS_INTERVAL)
+            logger.info(self.summary())
+
+    def summary(self):
+        return ', '.join(f"{k}={v}" for k, v in {**self.stats, **self.cache.stats, 'certs': len(self.cache.lru)}.items())
+
+
+async def main():
+    global CERTD_MAX_CERTS
+    global CERTD_WORKERS
+
+    parser = argparse.ArgumentParser(description="Issue TopGen vhost certificates on demand: read the server name requested by each HTTPS client nginx passes on, sign a certificate for it unless one was issued before, have nginx serve the name itself from then on, and pass the connection back to nginx (see topgen-scrape.py --cert-mode lazy).", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-t", "--target-dir", help=f"directory containing the TopGen CA, vhosts and certificates;\n(default: {tg.TOPGEN_VARLIB})", default=tg.TOPGEN_VARLIB)
+    parser.add_argument("-l", "--listen", help=f"comma separated [host]:port addresses to accept HTTPS connections (with a PROXY protocol header) on; an empty host means all addresses;\n(default: {CERTD_LISTEN})", default=CERTD_LISTEN)
+    parser.add_argument("-b", "--backend", help=f"host:port nginx accepts the connections on (with a PROXY protocol header);\n(default: {CERTD_BACKEND})", default=CERTD_BACKEND)
+    parser.add_argument("-r", "--reload", help=f"command reloading nginx once names were added to (or removed from) {os.path.basename(tg.TOPGEN_LAZY_MAP)}; empty to leave that to others;\n(default: {CERTD_RELOAD})", default=CERTD_RELOAD)
+    parser.add_argument("-m", "--max-certs", help=f"maximum number of certificates kept on disk, least recently used ones are removed;\n(default: {CERTD_MAX_CERTS})", type=int, default=CERTD_MAX_CERTS)
+    parser.add_argument("-w", "--workers", help=f"number of certificate signing processes;\n(default: {CERTD_WORKERS})", type=int, default=CERTD_WORKERS)
+    parser.add_argument("--log-level", help="minimum severity of messages logged; 'DEBUG' includes each issued certificate and failed connection;\n(default: INFO)", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
+    args = parser.parse_args()
+    CERTD_MAX_CERTS = max(1, args.max_certs)
+    CERTD_WORKERS = max(1, args.workers)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s: %(message)s')
+    tg.set_target_dir(args.target_dir)
+    backend = parse_address(args.backend, '127.0.0.1')
+
+    # one descriptor towards the client, and one towards nginx, per connection:
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (CERTD_NOFILE, CERTD_NOFILE))
+    except (ValueError, OSError) as e:
+        logger.warning(f"Unable to raise the open file limit to {CERTD_NOFILE}: {e}")
+
+    signer_args = (os.path.join(tg.TOPGEN_VARETC, "topgen_ca.key"),
+                   os.path.join(tg.TOPGEN_VARETC, "topgen_ca.cer"),
+                   os.path.join(tg.TOPGEN_VARETC, "topgen_vh.key"))
+    with tg.process_pool(CERTD_WORKERS, initializer=tg.signer_init, initargs=signer_args) as pool:
+        cache = CertCache(CERTD_MAX_CERTS, pool, shlex.split(args.reload))
+        cache.load()
+        await cache.flush()
+        service = CertService(cache, backend)
+
+        servers = []
+        for address in args.listen.split(','):
+            host, port = parse_address(address.strip())
+            servers.append(await asyncio.start_server(service.handle, host or None, port,
+                                                      reuse_address=True, backlog=4096))
+            logger.info(f"Accepting HTTPS connections on {address.strip()}, passing them to {args.backend}")
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        reporter = asyncio.create_task(service.report())
+        await stop.wait()
+        reporter.cancel()
+        for server in servers:
+            server.close()
+        # pass the names issued since the last flush on to nginx before leaving:
+        await cache.flush()
+        logger.info(service.summary())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
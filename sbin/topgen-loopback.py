@@ -0,0 +1,139 @@
+#!/bin/python3
+
+# Provision the loopback interface with the IP addresses of all TopGen
+# virtual hosts (web, mail, dns, ...), as listed in the <ip_addr fqdn>
+# hosts files generated by the various topgen-* scripts.
+#
+# The desired set of addresses is diffed against the addresses currently
+# configured on the interface, and only the difference is applied, in a
+# single 'ip -batch' run (rather than one 'ip' process per address), so
+# re-provisioning after a hosts file changed only adds/removes the delta.
+# Only addresses provisioned by an earlier run (as recorded in a state
+# file) are ever removed, addresses configured by anything else are left
+# alone.
+#
+# To try it out without touching the host's loopback interface, run it
+# against a network namespace, e.g.:
+#   ip netns add topgen-test
+#   topgen-loopback.py -N topgen-test -v
+
+import argparse
+import glob
+import ipaddress
+import os
+import subprocess
+import sys
+
+# input hosts files (<ip_addr fqdn> for all virtual hosts to be served):
+SRC_HOSTS = '/var/lib/topgen/etc/hosts.*'
+
+# interface to be provisioned:
+LO_DEV = 'lo'
+
+# path to the iproute2 'ip' utility:
+IP_CMD = '/usr/sbin/ip'
+
+# directory holding the state files listing the addresses we provisioned
+# (one per interface and network namespace, see state_path()):
+STATE_DIR = '/var/lib/topgen/etc'
+
+
+def desired_addresses(patterns):
+    """Return the set of (valid) IP addresses listed in all hosts files matching patterns"""
+    addresses = set()
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path) as f:
+                for line in f:
+                    fields = line.split()
+                    if not fields or fields[0].startswith('#'):
+                        continue
+                    try:
+                        addresses.add(ipaddress.ip_address(fields[0]))
+                    except ValueError:
+                        print(f'WARNING: {path}: skipping invalid address {fields[0]}', file=sys.stderr)
+    return addresses
+
+
+def ip_command(netns):
+    return [IP_CMD] + (['-n', netns] if netns else [])
+
+
+def current_addresses(dev, netns=None):
+    """Return the set of global scope IP addresses currently configured on dev"""
+    output = subprocess.run(ip_command(netns) + ['-o', 'addr', 'show', 'dev', dev, 'scope', 'global'],
+                            check=True, capture_output=True, text=True).stdout
+    addresses = set()
+    for line in output.splitlines():
+        # e.g. "1: lo    inet 10.0.0.1/32 scope global lo\       valid_lft forever ..."
+        fields = line.split()
+        if len(fields) > 3 and fields[2] in ('inet', 'inet6'):
+            addresses.add(ipaddress.ip_interface(fields[3]).ip)
+    return addresses
+
+
+def state_path(dev, netns=None):
+    """Return the default state file for dev (in netns)"""
+    return f"{STATE_DIR}/loopback.{netns + '.' if netns else ''}{dev}"
+
+
+def managed_addresses(path):
+    """Return the set of addresses recorded in the state file at path"""
+    try:
+        with open(path) as f:
+            return {ipaddress.ip_address(line.strip()) for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def save_managed(path, addresses):
+    """Atomically record addresses in the state file at path"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(f'{a}\n' for a in sorted(addresses, key=ipaddress.get_mixed_type_key))
+    os.replace(tmp_path, path)
+
+
+def batch(dev, add, remove):
+    """Return 'ip -batch' input adding and removing the given addresses on dev"""
+    commands = [f'addr del {a}/{a.max_prefixlen} dev {dev}\n' for a in sorted(remove, key=ipaddress.get_mixed_type_key)]
+    commands += [f'addr add {a}/{a.max_prefixlen} scope global dev {dev}\n' for a in sorted(add, key=ipaddress.get_mixed_type_key)]
+    return ''.join(commands)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add (and remove) loopback interface IP addresses to match the <ip_addr fqdn> hosts files of all TopGen virtual hosts, applying only the difference to what is currently configured.", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-H", "--hosts", help=f"hosts file(s) listing the addresses to be configured (glob patterns allowed; may be used multiple times);\n(default: {SRC_HOSTS})", action="append")
+    parser.add_argument("-d", "--dev", help=f"interface to be provisioned;\n(default: {LO_DEV})", default=LO_DEV)
+    parser.add_argument("-N", "--netns", help="provision the interface inside the given network namespace (e.g. for testing);\n(default: the current namespace)")
+    parser.add_argument("-S", "--state", help=f"file recording the addresses provisioned by this script; only those are ever removed;\n(default: {state_path('<dev>')}, or {state_path('<dev>', '<netns>')} with -N)")
+    parser.add_argument("-k", "--keep", help="only add missing addresses, do not remove addresses no longer listed in any hosts file", action="store_true")
+    parser.add_argument("-n", "--dry-run", help="print the 'ip -batch' commands instead of running them", action="store_true")
+    parser.add_argument("-v", "--verbose", help="report the number of addresses added and removed", action="store_true")
+    args = parser.parse_args()
+
+    state = args.state or state_path(args.dev, args.netns)
+    desired = desired_addresses(args.hosts or [SRC_HOSTS])
+    current = current_addresses(args.dev, args.netns)
+    # addresses we provisioned earlier, and are still configured:
+    managed = managed_addresses(state) & current
+    add = desired - current
+    remove = set() if args.keep else managed - desired
+    commands = batch(args.dev, add, remove)
+
+    if args.dry_run:
+        sys.stdout.write(commands)
+        return
+    if commands:
+        # -force: keep going if single commands fail (e.g., an address added concurrently)
+        proc = subprocess.run(ip_command(args.netns) + ['-force', '-batch', '-'], input=commands, text=True)
+        if proc.returncode != 0:
+            sys.exit(f'ERROR: {IP_CMD} -batch failed with exit code {proc.returncode}')
+    # addresses listed in the hosts files are ours from now on, even if they were configured already:
+    save_managed(state, (managed | desired) - remove)
+    if args.verbose:
+        print(f'{args.dev}: {len(desired)} addresses desired, added {len(add)}, removed {len(remove)}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+#!/bin/python3
+
+# Generate synthetic mail traffic for the TopGen virtual mail domains
+# configured by topgen-vmail.py:
+#
+#   inject: deliver generated messages straight into each account's
+#           maildir (no postfix involved), to pre-populate mailboxes
+#   load:   drive concurrent SMTP submission and IMAP sessions against
+#           the local postfix/dovecot services, and report messages/s,
+#           login latency and fetch latency as JSON
+#
+# Accounts (and their passwords) are read from the same vmail.cfg used
+# by topgen-vmail.py, so everything runs on the TopGen host itself, over
+# the loopback addresses provisioned for the mail servers.
+
+import importlib.util
+import argparse
+import base64
+import datetime
+import imaplib
+import json
+import multiprocessing
+import os
+import pwd
+import random
+import smtplib
+import socket
+import ssl
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+SBIN = os.path.dirname(os.path.realpath(__file__))
+
+# topgen-vmail.py isn't an importable module name, so load it by path (for its vmail.cfg parser):
+spec = importlib.util.spec_from_file_location("topgen_vmail", os.path.join(SBIN, "topgen-vmail.py"))
+vmail = importlib.util.module_from_spec(spec)
+sys.modules["topgen_vmail"] = vmail
+spec.loader.exec_module(vmail)
+
+# input: topgen virtual mail config file
+VMAIL_CFG = vmail.VMAIL_CFG
+
+# topgen directory structure:
+TOPGEN_VARLIB = vmail.TOPGEN_VARLIB
+
+# inject: MAIL_MESSAGES messages per mailbox on average (uniformly 0 to twice as many), sized
+# log-normally around MAIL_SIZE bytes (MAIL_SIZE_SIGMA spread, at most MAIL_MAX_SIZE bytes), dated
+# over the last MAIL_DAYS days; MAIL_SEEN of them flagged as read. Messages larger than
+# MAIL_ATTACH_SIZE carry the bulk of their size as a base64 encoded attachment.
+MAIL_MESSAGES = 20
+MAIL_SIZE = 8192
+MAIL_SIZE_SIGMA = 1.0
+MAIL_MAX_SIZE = 10 * 2**20
+MAIL_DAYS = 30
+MAIL_SEEN = 0.5
+MAIL_ATTACH_SIZE = 16384
+
+# mailboxes are filled in batches of INJECT_BATCH across INJECT_WORKERS processes:
+INJECT_BATCH = 64
+INJECT_WORKERS = os.cpu_count() or 1
+
+# senders are drawn from a random sample of at most CORRESPONDENTS addresses:
+CORRESPONDENTS = 10000
+
+# load: LOAD_SMTP_CLIENTS threads submitting messages, and LOAD_IMAP_CLIENTS threads running IMAP
+# sessions (login, select INBOX, fetch LOAD_IMAP_FETCHES random messages, logout), for LOAD_DURATION s
+LOAD_SMTP_CLIENTS = 16
+LOAD_IMAP_CLIENTS = 64
+LOAD_IMAP_FETCHES = 5
+LOAD_DURATION = 30.0
+LOAD_TIMEOUT = 30.0
+# pause after a failed session, so a client doesn't spin against a server that's down:
+LOAD_ERROR_PAUSE = 0.5
+SMTP_PORT = 587
+IMAP_PORT = 993
+
+WORDS = ('the meeting report budget project schedule update please review attached draft team '
+         'network exercise server access account password reset training week monday friday '
+         'deadline quarter results customer order invoice shipment delivery status question '
+         'thanks regards urgent follow up notes agenda minutes plan proposal approval contract '
+         'security policy incident response patch system outage maintenance window change').split()
+
+ATTACHMENTS = (('application/pdf', 'pdf'), ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'docx'),
+               ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'), ('image/jpeg', 'jpg'),
+               ('application/zip', 'zip'))
+
+
+def accounts(path):
+    """Return [(address, password, server_addr), ...] for all accounts in a vmail.cfg"""
+    return [(f'{user}@{domain}', password, addr)
+            for host, domain, addr, users in vmail.read_vmail_cfg(path)
+            for user, password in users]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def latency_ms(values):
+    """p50/p99 of a list of latencies (in seconds) in milliseconds"""
+    return {'p50_ms': round(percentile(values, 0.50) * 1000, 3) if values else None,
+            'p99_ms': round(percentile(values, 0.99) * 1000, 3) if values else None}
+
+
+def message_size(rng, median, sigma, maximum):
+    return max(256, min(maximum, int(rng.lognormvariate(0, sigma) * median)))
+
+
+def sentence(rng, words):
+    text = ' '.join(rng.choices(WORDS, k=words))
+    return text[0].upper() + text[1:]
+
+
+def generate_message(rng, sender, recipient, size, date):
+    """Return a plausible RFC 5322 message of about size bytes (LF line endings)"""
+    subject = sentence(rng, rng.randint(2, 7))
+    headers = (f'Return-Path: <{sender}>\n'
+               f'From: <{sender}>\n'
+               f'To: <{recipient}>\n'
+               f'Subject: {subject}\n'
+               f'Date: {date.strftime("%a, %d %b %Y %H:%M:%S +0000")}\n'
+               f'Message-ID: <{rng.getrandbits(64):016x}.{int(date.timestamp())}@{sender.split("@", 1)[1]}>\n'
+               f'MIME-Version: 1.0\n')
+    text_size = min(size, MAIL_ATTACH_SIZE) - len(headers)
+    lines = []
+    while text_size > 0:
+        line = sentence(rng, rng.randint(6, 12)) + '.\n'
+        lines.append(line)
+        text_size -= len(line)
+    text = ''.join(lines)
+    if size <= MAIL_ATTACH_SIZE:
+        return (headers + 'Content-Type: text/plain; charset=us-ascii\n\n' + text).encode()
+    boundary = f'=_{rng.getrandbits(64):016x}'
+    content_type, extension = rng.choice(ATTACHMENTS)
+    encoded = base64.encodebytes(rng.randbytes((size - MAIL_ATTACH_SIZE) * 3 // 4)).decode()
+    return (headers + f'Content-Type: multipart/mixed; boundary="{boundary}"\n\n'
+            f'--{boundary}\nContent-Type: text/plain; charset=us-ascii\n\n{text}\n'
+            f'--{boundary}\nContent-Type: {content_type}\n'
+            f'Content-Disposition: attachment; filename="{subject.split()[0].lower()}.{extension}"\n'
+            f'Content-Transfer-Encoding: base64\n\n{encoded}\n'
+            f'--{boundary}--\n').encode()
+
+
+# Injection (runs inside INJECT_WORKERS processes)
+
+def inject_init(options, correspondents, owner):
+    global inject_options, inject_correspondents, inject_owner
+    inject_options, inject_correspondents, inject_owner = options, correspondents, owner
+
+
+def inject_batch(seed, mailboxes):
+    """Deliver generated messages into the maildirs of a batch of (address, maildir) mailboxes"""
+    rng = random.Random(seed)
+    o = inject_options
+    hostname = socket.gethostname()
+    now = time.time()
+    delivered = written = 0
+    for recipient, maildir in mailboxes:
+        for sub in ('', 'cur', 'new', 'tmp'):
+            path = os.path.join(maildir, sub)
+            if not os.path.isdir(path):
+                os.makedirs(path, mode=0o700, exist_ok=True)
+                if inject_owner:
+                    os.chown(path, *inject_owner)
+        for n in range(rng.randint(0, 2 * o['messages'])):
+            received = now - rng.random() * o['days'] * 86400
+            data = generate_message(rng, rng.choice(inject_correspondents), recipient,
+                                    message_size(rng, o['size'], o['sigma'], o['max_size']),
+                                    datetime.datetime.fromtimestamp(received, datetime.timezone.utc))
+            # maildir delivery: write into tmp/, then rename into new/ (or into cur/, flagged as seen)
+            name = f'{int(received)}.M{rng.getrandbits(20)}P{os.getpid()}Q{n}.{hostname},S={len(data)}'
+            tmp = os.path.join(maildir, 'tmp', name)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.utime(tmp, (received, received))
+            if inject_owner:
+                os.chown(tmp, *inject_owner)
+            if rng.random() < o['seen']:
+                os.rename(tmp, os.path.join(maildir, 'cur', name + ':2,S'))
+            else:
+                os.rename(tmp, os.path.join(maildir, 'new', name))
+            delivered += 1
+            written += len(data)
+    return delivered, written
+
+
+def inject(args, results):
+    mboxdir = os.path.join(args.target_dir, 'vmail')
+    if not os.path.isdir(mboxdir):
+        sys.exit(f'\nERROR: folder "{mboxdir}" MUST exist before running this command!\n')
+    accts = accounts(args.vmail_cfg)
+    rng = random.Random(args.seed)
+    correspondents = [a for a, _, _ in rng.sample(accts, min(len(accts), CORRESPONDENTS))]
+    mailboxes = [(a, os.path.join(mboxdir, a.split('@', 1)[1], a.split('@', 1)[0])) for a, _, _ in accts]
+    owner = None
+    if os.geteuid() == 0:
+        try:
+            dovenull = pwd.getpwnam('dovenull')
+            owner = (dovenull.pw_uid, dovenull.pw_gid)
+        except KeyError:
+            pass
+    options = {'messages': args.messages, 'size': args.size, 'sigma': args.size_sigma,
+               'max_size': args.max_size, 'days': args.days, 'seen': args.seen}
+
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=max(1, args.workers), mp_context=multiprocessing.get_context('forkserver'),
+                             initializer=inject_init, initargs=(options, correspondents, owner)) as pool:
+        batches = [mailboxes[i:i + INJECT_BATCH] for i in range(0, len(mailboxes), INJECT_BATCH)]
+        # each batch gets its own seed, so a given --seed reproduces the same mailboxes:
+        seeds = [rng.getrandbits(64) for _ in batches]
+        done = list(pool.map(inject_batch, seeds, batches))
+    elapsed = time.monotonic() - started
+    messages = sum(d for d, _ in done)
+    written = sum(w for _, w in done)
+    results['inject'] = {'mailboxes': len(mailboxes), 'messages': messages, 'bytes': written,
+                         'seconds': round(elapsed, 3), 'messages_per_s': round(messages / max(elapsed, 0.001), 1)}
+
+
+# Load generation
+
+def tls_context():
+    # TopGen's mail servers use self-signed certificates:
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class LoadStats:
+    """Counters and latency samples shared by the load generating threads"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.latencies = {}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def sample(self, name, seconds):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+
+def smtp_client(args, accts, stats, deadline, rng):
+    """Submit messages as random accounts to random recipients until deadline, one session per message batch"""
+    while time.monotonic() < deadline:
+        sender, password, addr = rng.choice(accts)
+        server = args.server or addr
+        try:
+            started = time.monotonic()
+            with smtplib.SMTP(server, args.smtp_port, timeout=LOAD_TIMEOUT) as smtp:
+                smtp.ehlo()
+                if smtp.has_extn('starttls'):
+                    smtp.starttls(context=tls_context())
+                    smtp.ehlo()
+                smtp.login(sender, password)
+                stats.sample('smtp_login', time.monotonic() - started)
+                for _ in range(args.smtp_batch):
+                    if time.monotonic() >= deadline:
+                        break
+                    recipient = rng.choice(accts)[0]
+                    data = generate_message(rng, sender, recipient,
+                                            message_size(rng, args.size, args.size_sigma, args.max_size),
+                                            datetime.datetime.now(datetime.timezone.utc))
+                    started = time.monotonic()
+                    smtp.sendmail(sender, [recipient], data)
+                    stats.sample('smtp_send', time.monotonic() - started)
+                    stats.count('smtp_messages')
+                    stats.count('smtp_bytes', len(data))
+        except (OSError, smtplib.SMTPException) as e:
+            stats.count('smtp_errors')
+            if args.verbose:
+                print(f'SMTP {sender} via {server}: {e!r}', file=sys.stderr)
+            time.sleep(LOAD_ERROR_PAUSE)
+
+
+def imap_client(args, accts, stats, deadline, rng):
+    """Run IMAP sessions (login, select INBOX, fetch some messages, logout) as random accounts until deadline"""
+    while time.monotonic() < deadline:
+        user, password, addr = rng.choice(accts)
+        server = args.server or addr
+        try:
+            started = time.monotonic()
+            if args.imap_port == 993:
+                imap = imaplib.IMAP4_SSL(server, args.imap_port, ssl_context=tls_context(), timeout=LOAD_TIMEOUT)
+            else:
+                imap = imaplib.IMAP4(server, args.imap_port, timeout=LOAD_TIMEOUT)
+                if 'STARTTLS' in imap.capabilities:
+                    imap.starttls(ssl_context=tls_context())
+            try:
+                imap.login(user, password)
+                stats.sample('imap_login', time.monotonic() - started)
+                stats.count('imap_sessions')
+                status, data = imap.select('INBOX', readonly=True)
+                exists = int(data[0]) if status == 'OK' and data[0] else 0
+                for _ in range(min(args.imap_fetches, exists)):
+                    started = time.monotonic()
+                    status, data = imap.fetch(str(rng.randint(1, exists)), '(BODY.PEEK[])')
+                    if status != 'OK':
+                        stats.count('imap_errors')
+                        continue
+                    stats.sample('imap_fetch', time.monotonic() - started)
+                    stats.count('imap_fetches')
+                    stats.count('imap_bytes', sum(len(part[1]) for part in data if isinstance(part, tuple)))
+            except BaseException:
+                imap.shutdown()
+                raise
+            imap.logout()
+        except (OSError, imaplib.IMAP4.error, ValueError) as e:
+            stats.count('imap_errors')
+            if args.verbose:
+                print(f'IMAP {user} via {server}: {e!r}', file=sys.stderr)
+            time.sleep(LOAD_ERROR_PAUSE)
+
+
+def load(args, results):
+    accts = accounts(args.vmail_cfg)
+    if not accts:
+        sys.exit(f'\nERROR: no accounts found in "{args.vmail_cfg}"!\n')
+    stats = LoadStats()
+    rng = random.Random(args.seed)
+    clients = [(smtp_client, random.Random(rng.random())) for _ in range(args.smtp_clients)]
+    clients += [(imap_client, random.Random(rng.random())) for _ in range(args.imap_clients)]
+    started = time.monotonic()
+    deadline = started + args.duration
+    with ThreadPoolExecutor(max_workers=max(1, len(clients))) as pool:
+        for future in [pool.submit(client, args, accts, stats, deadline, client_rng) for client, client_rng in clients]:
+            future.result()
+    elapsed = time.monotonic() - started
+
+    counts, latencies = stats.counts, stats.latencies
+    results['load'] = {'seconds': round(elapsed, 3)}
+    if args.smtp_clients:
+        results['load']['smtp'] = {
+            'clients': args.smtp_clients,
+            'messages': counts.get('smtp_messages', 0),
+            'bytes': counts.get('smtp_bytes', 0),
+            'errors': counts.get('smtp_errors', 0),
+            'messages_per_s': round(counts.get('smtp_messages', 0) / elapsed, 1),
+            'login': latency_ms(latencies.get('smtp_login', [])),
+            'send': latency_ms(latencies.get('smtp_send', [])),
+        }
+    if args.imap_clients:
+        results['load']['imap'] = {
+            'clients': args.imap_clients,
+            'sessions': counts.get('imap_sessions', 0),
+            'fetches': counts.get('imap_fetches', 0),
+            'bytes': counts.get('imap_bytes', 0),
+            'errors': counts.get('imap_errors', 0),
+            'logins_per_s': round(counts.get('imap_sessions', 0) / elapsed, 1),
+            'fetches_per_s': round(counts.get('imap_fetches', 0) / elapsed, 1),
+            'login': latency_ms(latencies.get('imap_login', [])),
+            'fetch': latency_ms(latencies.get('imap_fetch', [])),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic mail traffic for the TopGen virtual mail domains: inject generated messages straight into their maildirs, and/or load the local postfix (SMTP submission) and dovecot (IMAP) services with concurrent sessions, reporting the results as JSON.", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("mode", nargs="+", choices=["inject", "load"], help="'inject' pre-populates all mailboxes, 'load' drives SMTP and IMAP sessions\n(both may be given, injection runs first)")
+    parser.add_argument("-c", dest="vmail_cfg", metavar="vmail_config", help=f"virtual mail domain configuration file (as used by topgen-vmail.py);\n(default: {VMAIL_CFG})", default=VMAIL_CFG)
+    parser.add_argument("-t", dest="target_dir", metavar="target_directory", help=f"directory containing the vmail folder with all maildirs;\n(default: {TOPGEN_VARLIB})", default=TOPGEN_VARLIB)
+    parser.add_argument("-n", "--messages", help=f"average number of messages injected per mailbox;\n(default: {MAIL_MESSAGES})", type=int, default=MAIL_MESSAGES)
+    parser.add_argument("--size", help=f"median message size in bytes (sizes are log-normally distributed);\n(default: {MAIL_SIZE})", type=int, default=MAIL_SIZE)
+    parser.add_argument("--size-sigma", help=f"spread of message sizes (sigma of the log-normal distribution);\n(default: {MAIL_SIZE_SIGMA})", type=float, default=MAIL_SIZE_SIGMA)
+    parser.add_argument("--max-size", help=f"maximum message size in bytes;\n(default: {MAIL_MAX_SIZE})", type=int, default=MAIL_MAX_SIZE)
+    parser.add_argument("--days", help=f"injected messages are dated over this many past days;\n(default: {MAIL_DAYS})", type=float, default=MAIL_DAYS)
+    parser.add_argument("--seen", help=f"fraction of injected messages flagged as read;\n(default: {MAIL_SEEN})", type=float, default=MAIL_SEEN)
+    parser.add_argument("-w", dest="workers", metavar="workers", help=f"number of processes injecting messages;\n(default: {INJECT_WORKERS})", type=int, default=INJECT_WORKERS)
+    parser.add_argument("-s", "--server", help="address of the mail server to connect to for all domains;\n(default: each domain's own address from the vmail config file)")
+    parser.add_argument("--smtp-clients", help=f"number of concurrent SMTP submission clients;\n(default: {LOAD_SMTP_CLIENTS})", type=int, default=LOAD_SMTP_CLIENTS)
+    parser.add_argument("--smtp-batch", help="number of messages submitted per SMTP session;\n(default: 10)", type=int, default=10)
+    parser.add_argument("--smtp-port", help=f"SMTP submission port (STARTTLS is used if offered);\n(default: {SMTP_PORT})", type=int, default=SMTP_PORT)
+    parser.add_argument("--imap-clients", help=f"number of concurrent IMAP clients;\n(default: {LOAD_IMAP_CLIENTS})", type=int, default=LOAD_IMAP_CLIENTS)
+    parser.add_argument("--imap-fetches", help=f"number of random messages fetched per IMAP session;\n(default: {LOAD_IMAP_FETCHES})", type=int, default=LOAD_IMAP_FETCHES)
+    parser.add_argument("--imap-port", help=f"IMAP port (993 is IMAP over TLS, on other ports STARTTLS is used if offered);\n(default: {IMAP_PORT})", type=int, default=IMAP_PORT)
+    parser.add_argument("-d", "--duration", help=f"seconds to run the load for;\n(default: {LOAD_DURATION})", type=float, default=LOAD_DURATION)
+    parser.add_argument("--seed", help="random seed, for reproducible mailbox contents;\n(default: random)", type=int)
+    parser.add_argument("-o", "--output", help="file to write the JSON results to;\n(default: standard output)")
+    parser.add_argument("-v", dest="verbose", help="report individual SMTP and IMAP errors", action="store_true")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.vmail_cfg):
+        sys.exit(f'\nERROR: file "{args.vmail_cfg}" MUST exist before running this command!\n')
+
+    results = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'host': {'hostname': socket.gethostname(), 'cpus': os.cpu_count()},
+    }
+    if 'inject' in args.mode:
+        inject(args, results)
+    if 'load' in args.mode:
+        load(args, results)
+
+    output = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
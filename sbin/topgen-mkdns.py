@@ -0,0 +1,427 @@
+#!/bin/python3
+
+# Generate full bind9 configuration from a (TopGen) hosts file
+# (glsomlo@cert.org, June 2015)
+#
+# We assume a well-behaved hosts file consisting of valid lines
+# of the form <ip_addr fqdn> (a file auto-generated by the TopGen
+# scraper should work unequivocally; for now, though, we skip any
+# additional error checking and validation).
+#
+# All hosts are indexed in memory (forward zones by TLD, reverse zones
+# by /8, MX records by second-level domain, delegations by second-level
+# domain and /24 network), and each zone file is then written out in a
+# single buffered pass, so even very large fleets take seconds.
+#
+# NOTE on DELEGATIONS:
+# For each delegated 2nd-level domain (forward) or /24 subnet (reverse),
+# we list one or more name server fqdn(s), which will handle lookups
+# for that respective domain or subnet.
+# We then separately list each name server fqdn with its ip address.
+# Each listed delegation name server MUST have a subsequent entry
+# containing its IP address (we warn about any that don't, since
+# they result in undefined behavior).
+
+import argparse
+import os
+import re
+import shutil
+import sys
+
+# input hosts file (<ip_addr fqdn> for all virtual Web hosts):
+SRC_WHOSTS = '/var/lib/topgen/etc/hosts.nginx'
+
+# input hosts file (<ip_addr fqdn> for all virtual mail servers):
+SRC_MHOSTS = '/var/lib/topgen/etc/hosts.vmail'
+
+# input delegations file (bash hashes DELEGATIONS_FWD, DELEGATIONS_REV, DELEGATIONS_NS):
+SRC_DELEG = '/etc/topgen/delegations.dns'
+
+# output hosts file (<ip_addr fqdn> for all virtual DNS servers impersonated):
+NAMED_HOSTS = '/var/lib/topgen/etc/hosts.named'
+
+# output named.conf
+NAMED_CONF = '/var/lib/topgen/etc/named.conf'
+
+# output folder for zone files:
+NAMED_ZD = '/var/lib/topgen/named'
+
+# if True, do not print warnings and a success notification
+QUIET_GEN = False
+
+###########################################################################
+####    NO FURTHER USER-SERVICEABLE PARTS BEYOND THIS POINT !!!!!!!    ####
+###########################################################################
+
+# Caching servers (for use in view match, and to ensure existence of A records):
+CACHING_NS = {
+    'b.resolvers.level3.net': '4.2.2.2',
+    'google-public-dns-a.google.com': '8.8.8.8',
+    'google-public-dns-b.google.com': '8.8.4.4',
+}
+
+# TLD servers (for use in view match, and to ensure existence of A records):
+TOPLEVEL_NS = {
+    'ns.level3.net': '4.4.4.8',
+    'ns.att.net': '12.12.12.24',
+    'ns.verisign.com': '69.58.181.181',
+}
+
+# Root servers (for use in view match, and to ensure existence of A records):
+# NOTE: these are "well-known", i.e. hardcoded on various other software
+#       packages (e.g., bind9), so don't change them unless you REALLY know
+#       what you're doing !!!
+ROOT_NS = {
+    'a.root-servers.net': '198.41.0.4',
+    'b.root-servers.net': '192.228.79.201',
+    'c.root-servers.net': '192.33.4.12',
+    'd.root-servers.net': '199.7.91.13',
+    'e.root-servers.net': '192.203.230.10',
+    'f.root-servers.net': '192.5.5.241',
+    'g.root-servers.net': '192.112.36.4',
+    'h.root-servers.net': '128.63.2.53',
+    'i.root-servers.net': '192.36.148.17',
+    'j.root-servers.net': '192.58.128.30',
+    'k.root-servers.net': '193.0.14.129',
+    'l.root-servers.net': '199.7.83.42',
+    'm.root-servers.net': '202.12.27.33',
+}
+
+NAMED_CONF_OPTIONS = '''}};
+
+options {{
+	listen-on port 53 {{ "cache_addrs"; "root_addrs"; "tld_addrs"; }};
+	allow-query {{ any; }};
+	recursion no;
+	check-names master ignore;
+	directory "/var/named";
+	dump-file "/var/named/data/cache_dump.db";
+	statistics-file "/var/named/data/named_stats.txt";
+	memstatistics-file "/var/named/data/named_mem_stats.txt";
+	pid-file "/run/named/named.pid";
+	session-keyfile "/run/named/session.key";
+}};
+
+logging {{
+	channel default_debug {{
+		file "data/named.run";
+		severity dynamic;
+		print-time yes;
+	}};
+}};
+
+view "caching" {{
+	match-destinations {{ "cache_addrs"; }};
+
+	recursion yes;
+	dnssec-validation no;
+
+	zone "." IN {{
+		type hint;
+		file "/etc/topgen/named.root";
+	}};
+}};
+
+view "rootsrv" {{
+	match-destinations {{ "root_addrs"; }};
+
+	zone "." IN {{
+		type master;
+		file "{root_zone}";
+		allow-update {{ none; }};
+	}};
+}};
+
+view "tldsrv" {{
+	match-destinations {{ "tld_addrs"; }};
+
+'''
+
+NAMED_CONF_ZONE = '''	zone "{name}" IN {{
+		type master;
+		file "{path}";
+		allow-update {{ none; }};
+	}};
+'''
+
+SOA = '$TTL 300\n$ORIGIN @\n@ SOA {ns}. admin.step-fwd.net. (15061601 600 300 800 300)\n'
+
+SUCCESS_BLURB = '''
+SUCCESS: bind9 configuration generated based on the following inputs:
+
+    Web hosts:   {whosts}
+    Xtra hosts:  {xhosts}
+    Mail srvrs:  {mhosts}
+    Delegations: {deleg}
+
+Output was written to the following locations:
+
+    DNS hosts:   {named_hosts}
+    named.conf:  {named_conf}
+    zone folder: {named_zd}
+
+Required next steps may include:
+
+    - update loopback interface to contain virtual DNS host IP addresses
+
+    - (re-)start topgen-named service
+'''
+
+# delegations.dns is a bash script declaring three hashes, e.g.:
+#   declare -A DELEGATIONS_FWD=(
+#     ['example.com']='ns1.example.com ns2.example.com'
+#   )
+DECLARE = re.compile(r'^\s*declare\s+-A\s+(\w+)=\(', re.M)
+# [key]=value, with key and value each single quoted, double quoted, or bare:
+ENTRY = re.compile(r'''\[\s*(?:'([^']*)'|"([^"]*)"|([^\]\s'"]+))\s*\]=(?:'([^']*)'|"([^"]*)"|([^\s)'"]*))''')
+
+
+def warn(msg):
+    if not QUIET_GEN:
+        print(f'\n{msg}')
+
+
+def fail(msg):
+    sys.exit(f'\nERROR: {msg}\n')
+
+
+def nonempty(path):
+    return os.path.isfile(path) and os.path.getsize(path) > 0
+
+
+def read_hosts(path):
+    """Yield (ip_addr, fqdn) pairs from an <ip_addr fqdn> hosts file"""
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                yield fields[0], fields[1]
+
+
+def read_delegations(path):
+    """Return the DELEGATIONS_FWD, DELEGATIONS_REV and DELEGATIONS_NS hashes from delegations.dns"""
+    with open(path) as f:
+        text = re.sub(r'(?m)^\s*#.*$', '', f.read())
+    hashes = {}
+    for match in DECLARE.finditer(text):
+        # the body ends at the first ')' outside quotes, wherever it is (e.g. "=()" on one line):
+        quote = None
+        for end in range(match.end(), len(text)):
+            if quote:
+                if text[end] == quote:
+                    quote = None
+            elif text[end] in '\'"':
+                quote = text[end]
+            elif text[end] == ')':
+                break
+        else:
+            fail(f'unterminated "declare -A {match.group(1)}" in {path}')
+        entries = {}
+        for entry in ENTRY.finditer(text, match.end(), end):
+            groups = entry.groups()
+            key = next(k for k in groups[:3] if k is not None)
+            entries[key] = next(v for v in groups[3:] if v is not None)
+        hashes[match.group(1)] = entries
+    return tuple(hashes.get(name, {}) for name in ('DELEGATIONS_FWD', 'DELEGATIONS_REV', 'DELEGATIONS_NS'))
+
+
+class DNSConfig:
+    """In-memory bind9 configuration: zone records indexed by TLD (forward) and /8 (reverse)"""
+    def __init__(self, named_conf, named_zd):
+        self.named_conf = named_conf
+        self.root_zone_path = os.path.join(named_zd, 'rootsrv', 'root.zone')
+        self.tld_zd = os.path.join(named_zd, 'tldsrv')
+        # zone file name -> list of record lines (in order of creation):
+        self.zones = {}
+        self.conf_zones = []
+        self.root_delegations = []
+
+    def zone(self, name, conf_name, forward):
+        """Return the record list of zone file <name>.zone, creating the zone if necessary"""
+        records = self.zones.get(name)
+        if records is None:
+            records = self.zones[name] = []
+            self.conf_zones.append(NAMED_CONF_ZONE.format(name=conf_name, path=f'{self.tld_zd}/{name}.zone'))
+            if forward:
+                # NS records pointing at our TLD servers go into root.zone:
+                self.root_delegations.extend(f'{name}.\tNS\t{ns}\n' for ns in TOPLEVEL_NS)
+        return records
+
+    def forward(self, tld):
+        return self.zone(tld, tld, True)
+
+    def reverse(self, octet):
+        return self.zone(octet, f'{octet}.in-addr.arpa.', False)
+
+    def render_named_conf(self):
+        acl = lambda servers: ''.join(f'\t{ip}/32;        /* {ns} */\n' for ns, ip in servers.items())
+        return ''.join([
+            'acl "cache_addrs" {\n', acl(CACHING_NS),
+            '};\n\nacl "root_addrs" {\n', acl(ROOT_NS),
+            '};\n\nacl "tld_addrs" {\n', acl(TOPLEVEL_NS),
+            NAMED_CONF_OPTIONS.format(root_zone=self.root_zone_path),
+            *self.conf_zones,
+            '};\n'])
+
+    def render_root_zone(self):
+        return ''.join([
+            SOA.format(ns='a.root-servers.net'),
+            *(f'\t\t\tNS\t{ns}.\n' for ns in ROOT_NS),
+            *(f'{ns}.\tA\t{ip}\n' for ns, ip in ROOT_NS.items()),
+            ';\n; in-game reverse DNS is also handled by the tld servers:\n;\n',
+            *(f'in-addr.arpa.\t\tNS\t{ns}.\n' for ns in TOPLEVEL_NS),
+            *(f'{ns}.\tA\t{ip}\n' for ns, ip in TOPLEVEL_NS.items()),
+            ';\n; begin root zone data here:\n;\n',
+            *self.root_delegations])
+
+    def tld_zone_header(self):
+        return ''.join([
+            SOA.format(ns='ns.level3.net'),
+            *(f'\t\t\tNS\t{ns}.\n' for ns in TOPLEVEL_NS),
+            *(f'{ns}.\tA\t{ip}\n' for ns, ip in TOPLEVEL_NS.items()),
+            ';\n; begin zone data here:\n;\n'])
+
+    def write(self):
+        os.mkdir(os.path.dirname(self.root_zone_path))
+        os.mkdir(self.tld_zd)
+        header = self.tld_zone_header()
+        for name, records in self.zones.items():
+            with open(f'{self.tld_zd}/{name}.zone', 'w') as f:
+                f.write(header + ''.join(records))
+        with open(self.root_zone_path, 'w') as f:
+            f.write(self.render_root_zone())
+        with open(self.named_conf, 'w') as f:
+            f.write(self.render_named_conf())
+
+
+def main():
+    global QUIET_GEN
+
+    parser = argparse.ArgumentParser(description="Generate bind9 configuration (named.conf, zone files, and a list of DNS virtual hosts) based on a given hosts file (containing a list of <ip_addr fqdn> pairs) and a list of 2nd-level domain delegation target name servers.", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-w", dest="whosts", metavar="web_hosts", help=f"name of the input hosts list containing <ip_addr fqdn> pairs of all virtual Web TopGen hosts\nto be hosted by the web server;\n(default: {SRC_WHOSTS})", default=SRC_WHOSTS)
+    parser.add_argument("-x", dest="xhosts", metavar="xtra_hosts", help="name of additional hosts list(s) containing <ip_addr fqdn> mappings to be resolved\nby the DNS infrastructure (may be used multiple times);\n(default: <empty>)", action="append", default=[])
+    parser.add_argument("-m", dest="mhosts", metavar="mail_hosts", help=f"name of the input hosts list containing <ip_addr fqdn> pairs of all of TopGen's virtual\nmail servers;\n(default: {SRC_MHOSTS})", default=SRC_MHOSTS)
+    parser.add_argument("-d", dest="deleg", metavar="delegations", help=f"name of the input file containing hashes associating delegated forward 2nd-level domains\nand reverse /24 networks with their respective authoritative name servers, and also providing\nan IP address for each such name server;\n(default: {SRC_DELEG})", default=SRC_DELEG)
+    parser.add_argument("-n", dest="named_hosts", metavar="dns_hosts", help=f"name of the output hosts list containing <ip_addr fqdn> pairs for all virtual DNS TopGen\nservers supported by the configuration being generated;\n(default: {NAMED_HOSTS})", default=NAMED_HOSTS)
+    parser.add_argument("-c", dest="named_conf", metavar="named_conf", help=f"name of the generated bind9 named.conf file;\n(default: {NAMED_CONF})", default=NAMED_CONF)
+    parser.add_argument("-z", dest="named_zd", metavar="zone_folder", help=f"name of the folder where all zone files referenced in named.conf will be generated;\n(default: {NAMED_ZD})", default=NAMED_ZD)
+    parser.add_argument("-f", dest="force", help="do not stop if pre-existing configuration is encountered; instead, forcibly remove\nand re-create the configuration. CAUTION: pre-existing configuration will be lost !", action="store_true")
+    parser.add_argument("-q", dest="quiet", help="do not print warnings or a success notification\n(output will still be generated if exiting with an error)", action="store_true")
+    args = parser.parse_args()
+    QUIET_GEN = args.quiet
+
+    # assert existence of web hosts and delegations files, and zone folder:
+    if not (nonempty(args.whosts) and nonempty(args.deleg) and os.path.isdir(args.named_zd)):
+        fail(f'files "{args.whosts}", "{args.deleg}", and\n       folder "{args.named_zd}" MUST exist\n'
+             f'       before running this command!')
+
+    # view-specific zone files go in folders underneath the zone folder:
+    root_zd = os.path.join(args.named_zd, 'rootsrv')
+    tld_zd = os.path.join(args.named_zd, 'tldsrv')
+
+    # assert non-existence of dns hosts, named.conf, and per-view zone folders:
+    if args.force:
+        for path in (args.named_hosts, args.named_conf):
+            if os.path.lexists(path):
+                os.remove(path)
+        for path in (root_zd, tld_zd):
+            shutil.rmtree(path, ignore_errors=True)
+    if nonempty(args.named_hosts) or nonempty(args.named_conf) or os.path.isdir(root_zd) or os.path.isdir(tld_zd):
+        fail(f'files "{args.named_hosts}", "{args.named_conf}", or\n'
+             f'       folders "{root_zd}", "{tld_zd}" must NOT exist!\n'
+             f'       Please remove them manually before running this command again!')
+
+    delegations_fwd, delegations_rev, delegations_ns = read_delegations(args.deleg)
+    for ns in sorted({ns for servers in (*delegations_fwd.values(), *delegations_rev.values())
+                      for ns in servers.split()} - set(delegations_ns)):
+        warn(f'WARNING: delegation name server {ns} has no IP address in {args.deleg}!')
+
+    # fqdn -> ip_addr for each host, and second-level domain -> MX hostnames:
+    hosts = {}
+    domain_mx = {}
+
+    def hosts_list_add(ipaddr, fqdn, is_mx):
+        """Check that a host is not delegated, then add it (and its MX record, if is_mx)"""
+        domain = '.'.join(fqdn.split('.')[-2:])
+        if domain in delegations_fwd:
+            warn(f'WARNING: skipping host {fqdn} in delegated domain {domain}')
+            return
+        network = ipaddr.rsplit('.', 1)[0]
+        if network in delegations_rev:
+            warn(f'WARNING: skipping host {fqdn}: ip {ipaddr} in delegated network {network}')
+            return
+        hosts[fqdn] = ipaddr
+        if is_mx:
+            domain_mx.setdefault(domain, []).append(fqdn)
+
+    # grab web and extra hosts, skip & warn on collision with delegations:
+    for path in [args.whosts] + args.xhosts:
+        for ipaddr, fqdn in read_hosts(path):
+            hosts_list_add(ipaddr, fqdn, False)
+
+    # grab mail hosts (also adding them as MX records for their domain):
+    mhosts = nonempty(args.mhosts)
+    if mhosts:
+        for ipaddr, fqdn in read_hosts(args.mhosts):
+            hosts_list_add(ipaddr, fqdn, True)
+
+    # unconditionally add all delegations' designated name servers:
+    for ns, ip in delegations_ns.items():
+        if ns in hosts:
+            warn(f'WARNING: Delegation name server {ns} already in {args.whosts}!\n'
+                 f'         (old address {hosts[ns]}, using {ip})')
+        hosts[ns] = ip
+
+    # unconditionally add all public caching, toplevel and root name servers:
+    for servers in (CACHING_NS, TOPLEVEL_NS, ROOT_NS):
+        for ns, ip in servers.items():
+            if ns in hosts:
+                warn(f'WARNING: Top level name server {ns} already exists!\n'
+                     f'         (old address {hosts[ns]}, using {ip})')
+            hosts[ns] = ip
+
+    # generate dns hosts file:
+    with open(args.named_hosts, 'w') as f:
+        f.write(''.join(f'{ip} {ns}\n' for servers in (CACHING_NS, TOPLEVEL_NS, ROOT_NS)
+                        for ns, ip in servers.items()))
+
+    config = DNSConfig(args.named_conf, args.named_zd)
+
+    # add A and PTR records for all hosts, creating zones if needed:
+    for fqdn, ipaddr in hosts.items():
+        ip1, ip2, ip3, ip4 = ipaddr.split('.')
+        name, _, tld = fqdn.rpartition('.')
+        config.forward(tld).append(f'{name}\tA\t{ipaddr}\n')
+        config.reverse(ip1).append(f'{ip4}.{ip3}.{ip2}\tPTR\t{fqdn}.\n')
+
+    # add NS records for all forward delegations:
+    for domain, servers in delegations_fwd.items():
+        name, _, tld = domain.rpartition('.')
+        config.forward(tld).extend(f'{name}\tNS\t{ns}.\n' for ns in servers.split())
+
+    # add NS records for all reverse delegations:
+    for network, servers in delegations_rev.items():
+        ip1, ip2, ip3 = network.split('.')
+        config.reverse(ip1).extend(f'{ip3}.{ip2}\tNS\t{ns}.\n' for ns in servers.split())
+
+    # add MX records for all vmail domains:
+    for domain, servers in domain_mx.items():
+        name, _, tld = domain.rpartition('.')
+        config.forward(tld).extend(f'{name}\tMX\t10\t{mx}.\n' for mx in servers)
+
+    config.write()
+
+    # we're done!
+    warn(SUCCESS_BLURB.format(whosts=args.whosts, xhosts=' '.join(args.xhosts),
+                              mhosts=args.mhosts if mhosts else '', deleg=args.deleg,
+                              named_hosts=args.named_hosts, named_conf=args.named_conf,
+                              named_zd=args.named_zd).lstrip('\n'))
+
+    # FIXME: Sort out SELinux policy associated with topgen package !!!
+    # But, for now, let's label the relevant files for use by named:
+    # chcon -t named_conf_t $NAMED_CONF
+    # chcon -R -t named_zone_t $NAMED_ZD/*
+
+
+if __name__ == "__main__":
+    main()
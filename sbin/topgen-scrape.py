@@ -1,6 +1,10 @@
 #!/bin/python3
 
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlsplit, urljoin, urldefrag, unquote
+from html.parser import HTMLParser
+from email.utils import formatdate, parsedate_to_datetime
+import posixpath
+import mimetypes
 import logging
 import asyncio
 import glob
@@ -9,11 +13,31 @@ import shutil
 import os
 from string import Template
 import tempfile
-import atexit
 import enlighten
 import argparse
 import resource
 import socket
+import datetime
+import time
+import itertools
+import sqlite3
+import hashlib
+import threading
+import stat
+import errno
+import fcntl
+import struct
+import random
+import cProfile
+import fnmatch
+import json
+import gzip
+from collections import defaultdict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from cryptography import x509
+from cryptography.x509.oid import NameOID, ObjectIdentifier
+from cryptography.hazmat.primitives import hashes, serialization
 
 # How deep will wget go, setting this to anything more than 1 will increase scrape time by a LOT, but will result in more complete sites
 wget_depth = 1
@@ -23,7 +47,9 @@ TOPGEN_ETC = os.path.realpath("/etc/topgen")
 TOPGEN_VHOSTS = os.path.join(TOPGEN_VARLIB, "vhosts")
 TOPGEN_VARETC = os.path.join(TOPGEN_VARLIB, "etc")
 TOPGEN_CERTS = os.path.join(TOPGEN_VARLIB, "certs")
-TOPGEN_TEMPLATES = os.path.join(TOPGEN_VARLIB, "templates/topgen-scrape")
+# install.sh and the RPM install the templates under /etc/topgen, not TOPGEN_VARLIB (which is
+# where this script used to look for them), so they also don't move with --target-dir
+TOPGEN_TEMPLATES = os.path.join(TOPGEN_ETC, "templates/topgen-scrape")
 
 TOPGEN_ORIG = os.path.join(TOPGEN_ETC, "scrape_sites.txt")
 TOPGEN_CUSTOM_VHOSTS = os.path.join(TOPGEN_ETC, "custom_vhosts")
@@ -32,39 +58,191 @@ TOPGEN_CUSTOM_VHOSTS = os.path.join(TOPGEN_ETC, "custom_vhosts")
 TOPGEN_SITE = os.path.join(TOPGEN_VHOSTS, "topgen.info")
 
 # The maximum number of open file descriptors, if you get an error about too many open files, increase this number
-# 8192 is more than enough for ~500 sites
+# 8192 is more than enough for TOPGEN_SCRAPE_WORKERS concurrent wget processes
 TOPGEN_NOFILE = 8192
 
-# up limits so topgen-scrape.py won't run out of file descriptors:
-resource.setrlimit(
-    resource.RLIMIT_NOFILE,
-    (TOPGEN_NOFILE, TOPGEN_NOFILE))
+# wget log line for a completed download, e.g. "... - '/path/file' saved [12345/12345]"
+WGET_SAVED = re.compile(r"""- [‘'](.+)[’'] saved \[(\d+)(?:/\d+)?\]$""")
+# wget log lines announcing a download ("Length: 12345 (12K) [text/html]", "Saving to: '/path/file'")
+# and its progress in --progress=dot:binary format (8K per dot, 384K per line, e.g.
+# "   384K ........ ........ ........ ........ ........ ........  50% 1.2M 3s")
+WGET_LENGTH = re.compile(r"^Length: .*\[([^\]]+)\]$")
+WGET_SAVING = re.compile(r"""^Saving to: [‘'](.+)[’']$""")
+WGET_PROGRESS = re.compile(r"^(\d+)K [. ]")
 
-# Ensure directories exist
-os.makedirs(TOPGEN_VHOSTS, exist_ok=True)
-os.makedirs(TOPGEN_CERTS, exist_ok=True)
-os.makedirs(TOPGEN_VARETC, exist_ok=True)
+# Scrape engine: 'wget' runs one wget process per site, 'native' uses the built-in NativeCrawler,
+# which keeps at most TOPGEN_NATIVE_CONNECTIONS connections open across all sites and fetches
+# up to TOPGEN_NATIVE_PER_SITE files of the same site concurrently
+TOPGEN_SCRAPE_ENGINE = "wget"
+TOPGEN_NATIVE_CONNECTIONS = 256
+TOPGEN_NATIVE_PER_SITE = 8
 
-#CA
-TMP_CA_DIR = None
-CA_CONF_PATH = None
+# Stylesheet url(...) and @import references, and quoted href/src attributes (for link conversion)
+CSS_URL = re.compile(r"""url\(\s*['"]?([^'")\s]+)['"]?\s*\)|@import\s+['"]([^'"]+)['"]""")
+HTML_REF = re.compile(r"""(\b(?:href|src)\s*=\s*)(["'])([^"'<>]*)\2""", re.I)
+CSS_REF = re.compile(r"""(url\(\s*['"]?)([^'")\s]+)(['"]?\s*\))""")
 
-# enlighten progress
-manager = enlighten.get_manager()
-BAR_FMT = '{desc}:{desc_pad}{percentage:3.0f}% |{bar}| {count:{len_total}d}/{total:d} [Elapsed: {elapsed}]'
+# Scrape scheduling: at most TOPGEN_SCRAPE_WORKERS wget processes run at once, and at most
+# TOPGEN_SCRAPE_PER_DOMAIN of them for the same registered domain (e.g. example.co.uk)
+TOPGEN_SCRAPE_WORKERS = 16
+TOPGEN_SCRAPE_PER_DOMAIN = 2
+# wget exits with 8 when a server answered some request with an error (e.g. a 404 for one of the
+# page requisites), which still makes a scraped site; 4 is a network failure, -1 stands for a scrape
+# that raised an exception (e.g. wget could not be run), and those are worth retrying
+SCRAPE_COMPLETED = (0, 8)
+SCRAPE_TRANSIENT = (4, -1)
+# Sites failing transiently are retried this many times
+TOPGEN_SCRAPE_RETRIES = 2
+# Domains failing transiently wait BACKOFF_BASE * 2^(failures-1) seconds (capped) before their next scrape starts
+TOPGEN_BACKOFF_BASE = 30
+TOPGEN_BACKOFF_MAX = 1800
+# Order in which sites are started, by the duration (then size) of their last scrape: 'fastest' finishes
+# small and fast sites first, 'slowest' starts the longest scrapes first, so a run doesn't end waiting
+# for a few stragglers; sites never scraped before go first either way, shallow ones first
+TOPGEN_SCRAPE_ORDER = "fastest"
+
+# Scrape journal recording per-site progress, so interrupted scrapes can be resumed (--resume)
+TOPGEN_JOURNAL = os.path.join(TOPGEN_VARETC, "scrape.journal")
+
+# Scrape budgets: per-site limits on downloaded bytes, number of files and wall-time, and MIME type
+# or extension allow/deny lists, enforced while a site downloads. Set for all sites (--max-bytes, ...)
+# or per site in TOPGEN_ORIG, after its url, e.g.:
+#   https://www.example.com/ 2 bytes=500M files=20000 time=6h deny=video/*,.iso
+# Sites cut short by their budget are listed, with what was truncated, in TOPGEN_SCRAPE_REPORT
+TOPGEN_BUDGET_BYTES = None
+TOPGEN_BUDGET_FILES = None
+TOPGEN_BUDGET_TIME = None
+TOPGEN_BUDGET_ALLOW = None
+TOPGEN_BUDGET_DENY = None
+TOPGEN_SCRAPE_REPORT = os.path.join(TOPGEN_VARETC, "scrape.report.json")
+
+# Deduplication: identical scraped files are replaced with hardlinks to (or reflink copies of)
+# a single copy kept in the content-addressed blob store TOPGEN_BLOBS
+TOPGEN_BLOBS = os.path.join(TOPGEN_VARLIB, "blobs")
+TOPGEN_DEDUP = None
+TOPGEN_DEDUP_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Files are (re)linked by creating a temporary file with this prefix next to them, and renaming it
+DEDUP_TMP_PREFIX = ".topgen-dedup."
+
+# Post-processing (custom vhosts, cleanup, curation) is IO-bound, and runs in a thread pool
+TOPGEN_POSTPROCESS_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# FICLONE ioctl from <linux/fs.h>, used to create reflinks
+FICLONE = 0x40049409
+
+# vhost IP resolution: up to TOPGEN_RESOLVE_CONCURRENCY outstanding queries, each tried up to
+# TOPGEN_RESOLVE_ATTEMPTS times (rotating through the resolvers) with a TOPGEN_RESOLVE_TIMEOUT
+# second timeout. Results are cached in TOPGEN_RESOLVE_CACHE for their TTL, but at least
+# TOPGEN_RESOLVE_MIN_TTL seconds (failures for TOPGEN_RESOLVE_NEGATIVE_TTL), so re-runs shortly
+# after each other don't resolve the whole fleet again. Unresolvable vhosts get TOPGEN_FALLBACK_IP.
+TOPGEN_RESOLVERS = None
+TOPGEN_RESOLVE_CONCURRENCY = 256
+TOPGEN_RESOLVE_ATTEMPTS = 3
+TOPGEN_RESOLVE_TIMEOUT = 2.0
+TOPGEN_RESOLVE_CACHE = os.path.join(TOPGEN_VARETC, "resolve.cache")
+TOPGEN_RESOLVE_MIN_TTL = 300
+TOPGEN_RESOLVE_NEGATIVE_TTL = 86400
+TOPGEN_FALLBACK_IP = "1.0.0.0"
+
+# nginx.conf includes the vhost server blocks from TOPGEN_NGINX_SHARDS shard files (vhosts are
+# assigned to shards by a hash of their name); only shards whose vhosts or certificates changed,
+# according to the content hashes in the shard manifest, are rewritten
+TOPGEN_NGINX_SHARDS = 64
+TOPGEN_NGINX_SHARDS_DIR = os.path.join(TOPGEN_VARETC, "nginx.d")
+
+# Precompressed sidecars (--compress): text assets of at least TOPGEN_COMPRESS_MIN_SIZE bytes get
+# a .gz (and with 'brotli', also a .br) copy next to them, which nginx serves via gzip_static.
+# Sidecars carry their source's mtime, so files unchanged since the last run are skipped; so are
+# files whose sidecars weren't smaller than the original, listed (with their mtime) in TOPGEN_COMPRESS_SKIP
+TOPGEN_COMPRESS = None
+TOPGEN_COMPRESS_SKIP = os.path.join(TOPGEN_VARETC, "compress.skip.json")
+TOPGEN_COMPRESS_MIN_SIZE = 1024
+TOPGEN_COMPRESS_TYPES = ('.html', '.htm', '.css', '.js', '.mjs', '.json', '.xml', '.svg', '.txt',
+                         '.csv', '.map', '.ico', '.ttf', '.otf', '.eot', '.rss', '.atom')
+TOPGEN_COMPRESS_BATCH = 256
+TOPGEN_COMPRESS_WORKERS = os.cpu_count() or 1
+
+# Certificate signing: vhosts are signed in batches of TOPGEN_SIGN_BATCH across
+# TOPGEN_SIGN_WORKERS processes, each of which loads the CA and vhost keys once
+TOPGEN_SIGN_BATCH = 256
+TOPGEN_SIGN_WORKERS = os.cpu_count() or 1
+
+# Certificate consolidation: 'vhost' issues one certificate per vhost, 'domain' and 'bucket'
+# issue multi-SAN certificates (stored in TOPGEN_SHARED_CERTS) covering up to TOPGEN_CERT_BUCKET
+# vhosts of the same registered domain, or of the same hash bucket, respectively; 'lazy' issues
+# nothing up front, certificates are signed by topgen-certd.py on the first HTTPS connection to a vhost
+TOPGEN_CERT_MODE = "vhost"
+TOPGEN_CERT_BUCKET = 100
+TOPGEN_SHARED_CERTS = os.path.join(TOPGEN_CERTS, "shared")
+
+# On-demand certificates (--cert-mode lazy): nginx accepts HTTPS connections on port 443 in a stream
+# block (TOPGEN_NGINX_STREAM, to be included at the top level of nginx.conf) and reads the requested
+# name from the ClientHello (ssl_preread); names listed in TOPGEN_LAZY_MAP have a certificate in
+# TOPGEN_LAZY_CERTS, and go straight to the vhost server blocks listening on TOPGEN_LAZY_BACKEND,
+# others to topgen-certd.py on TOPGEN_LAZY_CERTD, which signs a certificate, adds the name to the map
+# and reloads nginx; nginx keeps up to TOPGEN_LAZY_CACHE parsed certificates in memory
+# (ssl_certificate_cache, nginx 1.27.4 or later; 0 disables it)
+TOPGEN_LAZY_CERTS = os.path.join(TOPGEN_CERTS, "lazy")
+TOPGEN_LAZY_MAP = os.path.join(TOPGEN_VARETC, "lazy_certs.map")
+TOPGEN_NGINX_STREAM = os.path.join(TOPGEN_VARETC, "nginx-stream.conf")
+TOPGEN_LAZY_BACKEND = "127.0.0.1:4443"
+TOPGEN_LAZY_CERTD = "127.0.0.1:4444"
+TOPGEN_LAZY_CACHE = 10000
 
+# Issued certificate parameters (formerly CertificateAuthority.conf and vHost_CSR.conf)
+TOPGEN_CERT_DAYS = 3650
+TOPGEN_CERT_COMMENT = b"TopGen CA Generated Certificate"
+TOPGEN_VH_SUBJECT = x509.Name([
+    x509.NameAttribute(NameOID.COUNTRY_NAME, "US"),
+    x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "PA"),
+    x509.NameAttribute(NameOID.LOCALITY_NAME, "Pgh"),
+    x509.NameAttribute(NameOID.ORGANIZATION_NAME, "CMU"),
+    x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "CERT"),
+    x509.NameAttribute(NameOID.COMMON_NAME, "topgen_vh"),
+])
 
-# Modify the logging configuration at the top
-logging.basicConfig(
-#    filename='topgen-scrape.log',
-    level=logging.DEBUG,
-    format='%(asctime)s %(levelname)s: %(message)s',
-)
+# Netscape extensions emitted by `openssl ca` (nsCertType = server, nsComment)
+OID_NS_CERT_TYPE = ObjectIdentifier("2.16.840.1.113730.1.1")
+OID_NS_COMMENT = ObjectIdentifier("2.16.840.1.113730.1.13")
 
-# Log both to console and file
+# Logging: --log-level; at DEBUG, every line of wget output is logged
+TOPGEN_LOG_LEVEL = "INFO"
+
+# Run metrics (--metrics): per-stage and per-site durations, downloaded bytes and files, subprocess
+# counts, DNS query latencies and certificate signing rates, written to TOPGEN_METRICS every
+# TOPGEN_METRICS_INTERVAL seconds and when the run ends, as JSON or, if TOPGEN_METRICS ends in
+# .prom (e.g. in node_exporter's textfile collector directory), in the Prometheus text format
+TOPGEN_METRICS = None
+TOPGEN_METRICS_INTERVAL = 30
+# Histogram buckets (in seconds) for DNS query latencies and per-site scrape durations
+TOPGEN_METRICS_DNS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+TOPGEN_METRICS_SITE_BUCKETS = (1, 10, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+
+# Profiling (--profile): cProfile statistics of the main process are dumped to this file
+TOPGEN_PROFILE = None
+
+# enlighten progress; bars are only drawn once setup_process() replaces this disabled manager,
+# so importing this file (as topgen-bench.py and topgen-certd.py do) leaves the terminal alone
+manager = enlighten.Manager(enabled=False)
+BAR_FMT = '{desc}:{desc_pad}{percentage:3.0f}% |{bar}| {count:{len_total}d}/{total:d} [Elapsed: {elapsed}]'
+
+# Messages propagate to the root logger's handler set up by setup_process(); adding
+# another handler here would print each of them twice
 logger = logging.getLogger("enlighten")
 #logger.addHandler(logging.FileHandler('topgen-scrape.log'))
-logger.addHandler(logging.StreamHandler())
+
+def setup_process(log_level=TOPGEN_LOG_LEVEL):
+    """Set up logging, progress bars and the open file limit of a topgen-scrape.py run"""
+    global manager
+    logging.basicConfig(
+    #    filename='topgen-scrape.log',
+        level=log_level,
+        format='%(asctime)s %(levelname)s: %(message)s',
+    )
+    manager = enlighten.get_manager()
+    # up limits so topgen-scrape.py won't run out of file descriptors:
+    resource.setrlimit(
+        resource.RLIMIT_NOFILE,
+        (TOPGEN_NOFILE, TOPGEN_NOFILE))
 
 # Helper functions
 def format_elapsed_time(seconds):
@@ -80,159 +258,1781 @@ def format_elapsed_time(seconds):
     else:
         return f"{secs}s"
 
-async def update_progress(tasks, pbar):
-    while not all(task.done() for task in tasks):
-        completed = sum(task.done() for task in tasks)
-        pbar.count = completed
-        await asyncio.sleep(1)
+def write_atomic(path, data):
+    """Write data to path via a temporary file and rename, so readers never see partial files"""
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def chunked(items, size):
+    """Split items into lists of at most size elements"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def registered_domain(hostname):
+    """Approximate the registered domain of hostname (www.bbc.co.uk -> bbc.co.uk)"""
+    labels = hostname.lower().rstrip('.').split('.')
+    # country-code TLDs with a second-level registry (co.uk, com.au, ac.jp, ...):
+    if (len(labels) > 2 and len(labels[-1]) == 2 and
+            labels[-2] in ('ac', 'co', 'com', 'edu', 'gov', 'net', 'org', 'ne', 'or', 'go')):
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+class Metrics:
+    """Counters, histograms and stage/site timings of a run, exported as JSON or Prometheus text.
+
+    Per-site figures are only part of the JSON export; the Prometheus export carries their
+    totals and a histogram of site scrape durations, as a series per site would not scale.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.sites = {}
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, value, buckets):
+        histogram = self.histograms.setdefault(name, {'le': buckets, 'buckets': [0] * len(buckets), 'count': 0, 'sum': 0.0})
+        for i, bound in enumerate(histogram['le']):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+    def stage_started(self, name):
+        self.stages[name] = {'status': 'running', 'started': time.monotonic(), 'seconds': 0.0}
+
+    def stage_finished(self, name, ok=True):
+        stage = self.stages[name]
+        stage.update(status='finished' if ok else 'failed', seconds=time.monotonic() - stage['started'])
+
+    def site(self, hostname, result, seconds):
+        """Record a finished site scrape (result as returned by download_website())"""
+        self.sites[hostname] = {'seconds': round(seconds, 3), 'returncode': result['returncode'],
+                                'files': result['files'], 'bytes': result['bytes'], 'truncated': result['truncated']}
+        outcome = ('failed' if result['returncode'] not in SCRAPE_COMPLETED else
+                   'truncated' if result['truncated'] else 'ok')
+        self.count('sites', result=outcome)
+        self.count('site_files', result['files'])
+        self.count('site_bytes', result['bytes'])
+        self.observe('site_scrape_seconds', seconds, TOPGEN_METRICS_SITE_BUCKETS)
+
+    def stage_seconds(self, name):
+        stage = self.stages[name]
+        return time.monotonic() - stage['started'] if stage['status'] == 'running' else stage['seconds']
+
+    def rates(self):
+        signed = self.counters['certs_signed', (('stage', 'certs'),)]
+        seconds = self.counters['cert_signing_seconds', ()]
+        return {'cert_signing_per_second': round(signed / seconds, 1) if seconds else None}
+
+    @staticmethod
+    def series(name, labels):
+        if not labels:
+            return name
+        return name + '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+    def snapshot(self):
+        return {
+            'started': datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(timespec='seconds'),
+            'elapsed': round(time.time() - self.started, 3),
+            'stages': {name: {'status': stage['status'], 'seconds': round(self.stage_seconds(name), 3)}
+                       for name, stage in self.stages.items()},
+            'counters': {self.series(name, labels): value for (name, labels), value in sorted(self.counters.items())},
+            'histograms': self.histograms,
+            'rates': self.rates(),
+            'sites': self.sites,
+        }
+
+    def prometheus(self):
+        prefix = 'topgen_scrape_'
+        lines = [f'# TYPE {prefix}elapsed_seconds gauge', f'{prefix}elapsed_seconds {time.time() - self.started:.3f}']
+        if self.stages:
+            lines.append(f'# TYPE {prefix}stage_seconds gauge')
+            lines += [f'{prefix}stage_seconds{{stage="{name}",status="{stage["status"]}"}} {self.stage_seconds(name):.3f}'
+                      for name, stage in self.stages.items()]
+        declared = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {prefix}{name}_total counter')
+            lines.append(f'{self.series(prefix + name + "_total", labels)} {value:g}')
+        for name, histogram in sorted(self.histograms.items()):
+            lines.append(f'# TYPE {prefix}{name} histogram')
+            lines += [f'{prefix}{name}_bucket{{le="{bound:g}"}} {count}'
+                      for bound, count in zip(histogram['le'], histogram['buckets'])]
+            lines += [f'{prefix}{name}_bucket{{le="+Inf"}} {histogram["count"]}',
+                      f'{prefix}{name}_sum {histogram["sum"]:.6f}',
+                      f'{prefix}{name}_count {histogram["count"]}']
+        for name, value in self.rates().items():
+            if value is not None:
+                lines += [f'# TYPE {prefix}{name} gauge', f'{prefix}{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics to path, in the Prometheus text format if it ends in .prom, as JSON otherwise"""
+        try:
+            write_atomic(path, self.prometheus() if path.endswith('.prom') else
+                         json.dumps(self.snapshot(), indent=1, sort_keys=True))
+        except OSError as e:
+            logger.warning(f"Failed writing metrics to {path}: {e}")
+
+    async def export_periodically(self, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.write(path)
+
+metrics = Metrics()
+
+def parse_size(value):
+    """Parse a byte count with an optional K/M/G/T suffix (powers of 1024)"""
+    value = value.strip().upper().rstrip('B')
+    units = 'KMGT'
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * 1024 ** (units.index(value[-1]) + 1))
+    return int(value)
+
+def parse_duration(value):
+    """Parse a number of seconds with an optional s/m/h/d suffix"""
+    value = value.strip().lower()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+def parse_patterns(value):
+    """Parse a comma separated list of MIME types (text/*) and extensions (.iso)"""
+    return [p.strip().lower() for p in value.split(',') if p.strip()]
+
+class BudgetExceeded(Exception):
+    """A site ran out of its scrape budget"""
+
+class ScrapeBudget:
+    """Scrape limits for a site: max bytes, files and seconds, and MIME type/extension allow and deny lists"""
+    PARSERS = {'bytes': parse_size, 'files': int, 'time': parse_duration,
+               'allow': parse_patterns, 'deny': parse_patterns}
+
+    def __init__(self, bytes=None, files=None, time=None, allow=None, deny=None):
+        self.limits = {'bytes': bytes, 'files': files, 'time': time, 'allow': allow, 'deny': deny}
+
+    @classmethod
+    def default(cls):
+        """The budget set for all sites on the command line"""
+        return cls(TOPGEN_BUDGET_BYTES, TOPGEN_BUDGET_FILES, TOPGEN_BUDGET_TIME,
+                   TOPGEN_BUDGET_ALLOW, TOPGEN_BUDGET_DENY)
+
+    def override(self, token):
+        """Return a copy of this budget with a key=value token (e.g. bytes=500M) applied"""
+        key, value = token.split('=', 1)
+        budget = ScrapeBudget(**self.limits)
+        budget.limits[key] = self.PARSERS[key](value)
+        return budget
+
+    def __getattr__(self, key):
+        try:
+            return self.__dict__['limits'][key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __str__(self):
+        return ' '.join(f"{key}={','.join(value) if isinstance(value, list) else value}"
+                        for key, value in self.limits.items() if value is not None) or 'unlimited'
+
+    @staticmethod
+    def matches(patterns, name, content_type):
+        extension = posixpath.splitext(urlsplit(name).path)[1].lower()
+        mime = content_type.split(';')[0].strip().lower()
+        for pattern in patterns:
+            if '/' in pattern:
+                if mime and fnmatch.fnmatchcase(mime, pattern):
+                    return True
+            elif extension and extension == '.' + pattern.lstrip('.'):
+                return True
+        return False
+
+    def permits(self, name, content_type=''):
+        """Whether a file (url or path) of the given content type may be kept"""
+        if self.allow and not self.matches(self.allow, name, content_type):
+            return False
+        return not (self.deny and self.matches(self.deny, name, content_type))
+
+    def wget_options(self):
+        """wget arguments rejecting denied extensions before they are downloaded"""
+        extensions = [p.lstrip('.') for p in self.deny or () if '/' not in p]
+        return ['-R', ','.join(extensions)] if extensions else []
+
+    def meter(self):
+        """Start metering a scrape attempt against this budget"""
+        return BudgetMeter(self)
+
+class BudgetMeter:
+    """Track a scrape attempt's usage of its ScrapeBudget, and what was truncated because of it"""
+    def __init__(self, budget):
+        self.budget = budget
+        self.files = 0
+        self.bytes = 0
+        self.deadline = time.monotonic() + budget.time if budget.time else None
+        self.exceeded = None
+        self.rejected = defaultdict(int)
+
+    def exhausted(self):
+        """Whether the site ran out of budget; nothing more should be downloaded if it did"""
+        if not self.exceeded and self.deadline and time.monotonic() >= self.deadline:
+            self.exceeded = f"time limit of {format_elapsed_time(self.budget.time)} reached"
+        return self.exceeded is not None
+
+    def remaining_time(self):
+        return max(0.0, self.deadline - time.monotonic()) if self.deadline else None
+
+    def admit(self, name, content_type=''):
+        """Whether a file may be downloaded (or kept); counts it against the file limit if so"""
+        if self.exhausted():
+            return False
+        if not self.budget.permits(name, content_type):
+            self.rejected[content_type.split(';')[0].strip() or
+                          posixpath.splitext(urlsplit(name).path)[1] or 'unknown'] += 1
+            return False
+        if self.budget.files is not None and self.files >= self.budget.files:
+            self.exceeded = f"file limit of {self.budget.files} reached"
+            return False
+        self.files += 1
+        return True
+
+    def wanted(self, url):
+        """Whether url is worth requesting at all (its extension is not denied)"""
+        if self.budget.deny and self.budget.matches(self.budget.deny, url, ''):
+            self.rejected[posixpath.splitext(urlsplit(url).path)[1]] += 1
+            return False
+        return not self.exhausted()
+
+    def fits(self, size):
+        """Whether size more bytes (of a file still downloading) fit within the byte limit"""
+        if self.budget.bytes is not None and self.bytes + size > self.budget.bytes:
+            self.exceeded = self.exceeded or f"byte limit of {self.budget.bytes} reached"
+        return not self.exhausted()
+
+    def consume(self, size):
+        """Count size downloaded bytes; False once the byte limit is exceeded"""
+        fits = self.fits(size)
+        self.bytes += size
+        return fits
+
+    def report(self):
+        """Describe what was truncated, if anything"""
+        truncated = [self.exceeded] if self.exhausted() else []
+        truncated += [f"rejected {count} {kind} file(s)" for kind, count in sorted(self.rejected.items())]
+        return truncated
+
+def parse_sites(path):
+    """Return (url, depth, budget) tuples from a sites file.
+
+    A number following a url overrides its depth, and key=value tokens (bytes=500M, files=1000,
+    time=2h, allow=text/*,image/*, deny=.iso) override its ScrapeBudget.
+    """
+    sites = []
+    default = ScrapeBudget.default()
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            for token in line.split():
+                if token.isdigit() and sites:
+                    sites[-1] = (sites[-1][0], int(token), sites[-1][2])
+                elif '=' in token and sites and token.split('=', 1)[0] in ScrapeBudget.PARSERS:
+                    try:
+                        sites[-1] = sites[-1][:2] + (sites[-1][2].override(token),)
+                    except ValueError:
+                        logger.warning(f"{sites[-1][0]}: ignoring invalid budget '{token}'")
+                else:
+                    sites.append((token, wget_depth, default))
+    return sites
+
+
+def process_pool(workers, initializer=None, initargs=()):
+    """Return a ProcessPoolExecutor whose worker processes are started by a forkserver.
+
+    Stages run alongside each other's thread pools (and enlighten's refresh threads), and a
+    process forked while another thread holds a lock (e.g. logging's) deadlocks on it. Workers
+    import this file afresh instead, so they only see its constants, not what main() changed.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'),
+                               initializer=initializer, initargs=initargs)
+
+# Sidecar compression (runs inside TOPGEN_COMPRESS_WORKERS processes)
+
+def compress_batch(paths, brotli=False, skip=None):
+    """Write .gz (and .br) sidecars for paths not compressed since they last changed.
+
+    skip maps sidecars found not worth writing to the mtime (in ns) their source had then.
+    Returns (compressed, bytes_in, bytes_out, skip), the latter covering the sidecars of paths
+    still not worth writing.
+    """
+    skip = skip or {}
+    skipped = {}
+    if brotli:
+        import brotli as brotli_module
+    compressed = bytes_in = bytes_out = 0
+    for path in paths:
+        try:
+            st = os.stat(path)
+            if st.st_size < TOPGEN_COMPRESS_MIN_SIZE:
+                continue
+            sidecars = [(path + '.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=int(st.st_mtime)))]
+            if brotli:
+                sidecars.append((path + '.br', brotli_module.compress))
+            stale = []
+            for sidecar, compress in sidecars:
+                if skip.get(sidecar) == st.st_mtime_ns:
+                    skipped[sidecar] = st.st_mtime_ns
+                    continue
+                try:
+                    if os.stat(sidecar).st_mtime_ns == st.st_mtime_ns:
+                        continue
+                except FileNotFoundError:
+                    pass
+                stale.append((sidecar, compress))
+            if not stale:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            written = 0
+            for sidecar, compress in stale:
+                packed = compress(data)
+                if len(packed) >= len(data):
+                    # not worth it, nginx falls back to the original; remember not to try again:
+                    if os.path.exists(sidecar):
+                        os.remove(sidecar)
+                    skipped[sidecar] = st.st_mtime_ns
+                    continue
+                write_atomic(sidecar, packed)
+                os.utime(sidecar, ns=(st.st_atime_ns, st.st_mtime_ns))
+                written += len(packed)
+            if written:
+                compressed += 1
+                bytes_in += len(data)
+                bytes_out += written
+        except OSError as e:
+            logger.debug(f"Failed compressing {path}: {e}")
+    return compressed, bytes_in, bytes_out, skipped
+
+
+# Certificate signing engine (runs inside TOPGEN_SIGN_WORKERS processes)
+_signer = None
+
+def signer_init(ca_key_path, ca_cert_path, vh_key_path):
+    """Load the CA key/cert and the shared vhost key once per worker process"""
+    global _signer
+    with open(ca_key_path, 'rb') as f:
+        ca_key = serialization.load_pem_private_key(f.read(), password=None)
+    with open(ca_cert_path, 'rb') as f:
+        ca_cert = x509.load_pem_x509_certificate(f.read())
+    with open(vh_key_path, 'rb') as f:
+        vh_public_key = serialization.load_pem_private_key(f.read(), password=None).public_key()
+    _signer = {
+        'ca_key': ca_key,
+        'ca_cert': ca_cert,
+        'vh_public_key': vh_public_key,
+        'ski': x509.SubjectKeyIdentifier.from_public_key(vh_public_key),
+        'aki': x509.AuthorityKeyIdentifier(
+            key_identifier=x509.SubjectKeyIdentifier.from_public_key(ca_key.public_key()).digest,
+            authority_cert_issuer=[x509.DirectoryName(ca_cert.subject)],
+            authority_cert_serial_number=ca_cert.serial_number),
+    }
+
+def sign_certificate(names):
+    """Return a PEM certificate for the shared vhost key, valid for the given DNS names"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = (x509.CertificateBuilder()
+        .subject_name(TOPGEN_VH_SUBJECT)
+        .issuer_name(_signer['ca_cert'].subject)
+        .public_key(_signer['vh_public_key'])
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=TOPGEN_CERT_DAYS))
+        # the extensions (and their order) 'openssl ca' used to add, followed by the SANs it copied from the CSR:
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=False)
+        # DER BIT STRING with only the "SSL server" bit set:
+        .add_extension(x509.UnrecognizedExtension(OID_NS_CERT_TYPE, b'\x03\x02\x06\x40'), critical=False)
+        # DER IA5String:
+        .add_extension(x509.UnrecognizedExtension(OID_NS_COMMENT,
+            b'\x16' + bytes([len(TOPGEN_CERT_COMMENT)]) + TOPGEN_CERT_COMMENT), critical=False)
+        .add_extension(_signer['ski'], critical=False)
+        .add_extension(_signer['aki'], critical=False)
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(n) for n in names]), critical=False))
+    cert = builder.sign(_signer['ca_key'], hashes.SHA512())
+    return cert.public_bytes(serialization.Encoding.PEM)
+
+def sign_batch(certs):
+    """Sign and atomically write each (cert_path, names) certificate in the batch"""
+    for cert_path, names in certs:
+        write_atomic(cert_path, sign_certificate(names))
+    return len(certs)
+
+def cert_groups(vhost_names, mode=None, bucket_size=None):
+    """Map each certificate to be issued to the vhost names it covers, as {cert_path: [names]}.
+
+    In 'vhost' mode every vhost gets its own <vhost>.cer. In 'domain' mode vhosts of the same
+    registered domain share a multi-SAN certificate, and in 'bucket' mode vhosts are hashed into
+    buckets of about bucket_size names each; either is split into chunks of bucket_size names.
+    Consolidated certificates live in TOPGEN_SHARED_CERTS and are named after a digest of
+    the names they cover, so a certificate is only reissued when its set of names changes.
+    """
+    mode = mode or TOPGEN_CERT_MODE
+    bucket_size = bucket_size or TOPGEN_CERT_BUCKET
+    if mode == 'vhost':
+        return {os.path.join(TOPGEN_CERTS, f"{v}.cer"): [v] for v in vhost_names}
+
+    groups = defaultdict(list)
+    if mode == 'domain':
+        for vhost_base in sorted(vhost_names):
+            groups[registered_domain(vhost_base)].append(vhost_base)
+    else:
+        # power-of-two bucket count, so buckets only reshuffle when the fleet doubles:
+        buckets = 1
+        while buckets * bucket_size < len(vhost_names):
+            buckets *= 2
+        for vhost_base in sorted(vhost_names):
+            groups[f"bucket-{nginx_shard(vhost_base, buckets):05d}"].append(vhost_base)
+    # large domains, and buckets the hash filled above average, are split at bucket_size names:
+    for group, names in list(groups.items()):
+        if len(names) > bucket_size:
+            del groups[group]
+            for i, chunk in enumerate(chunked(names, bucket_size)):
+                groups[f"{group}.{i}"] = chunk
+
+    certs = {}
+    for group, names in groups.items():
+        digest = hashlib.sha1('\n'.join(names).encode()).hexdigest()[:12]
+        certs[os.path.join(TOPGEN_SHARED_CERTS, f"{group}-{digest}.cer")] = names
+    return certs
+
+# Content-addressed deduplication store (--dedup)
+
+class DedupStore:
+    """Blob store keyed by SHA-256 of file contents.
+
+    The first copy of some content becomes the blob (<root>/<xx>/<sha256>); later copies
+    are replaced by hardlinks to it or, in 'reflink' mode, by copy-on-write clones.
+    Hardlinked files share one inode, so they must only ever be replaced (written to a
+    temporary file and renamed, as the native engine does), never rewritten in place.
+    """
+    def __init__(self, root, mode='hardlink'):
+        self.root = root
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.disabled = False
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    @staticmethod
+    def digest(path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def clone(self, src, dst):
+        """Create dst as a hardlink to (or reflink copy of) src"""
+        if self.mode == 'hardlink':
+            os.link(src, dst)
+            return
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(src, dst)
+
+    def link(self, path, digest):
+        """Deduplicate path (with the given content digest), returning the number of bytes saved"""
+        if self.disabled:
+            return 0
+        blob = self.blob_path(digest)
+        try:
+            with self.lock:
+                if not os.path.exists(blob):
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    self.clone(path, blob)
+                    return 0
+            if self.mode == 'hardlink' and os.path.samefile(blob, path):
+                return 0
+            size = os.path.getsize(path)
+            tmp_path = os.path.join(os.path.dirname(path), DEDUP_TMP_PREFIX + os.path.basename(path))
+            self.clone(blob, tmp_path)
+            os.replace(tmp_path, path)
+            return size
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                logger.warning(f"Deduplication disabled, {self.mode}s from {path} to {self.root} unsupported: {e}")
+                self.disabled = True
+            else:
+                logger.debug(f"Failed deduplicating {path}: {e}")
+            return 0
+
+    def scan_blobs(self):
+        """Return {(dev, inode): (blob path, size, link count)} for all blobs"""
+        blobs = {}
+        if not os.path.isdir(self.root):
+            return blobs
+        for bucket in os.scandir(self.root):
+            if not bucket.is_dir(follow_symlinks=False):
+                continue
+            for blob in os.scandir(bucket.path):
+                if blob.name.startswith('.'):
+                    continue
+                st = blob.stat(follow_symlinks=False)
+                blobs[(st.st_dev, st.st_ino)] = (blob.path, st.st_size, st.st_nlink)
+        return blobs
+
+    def deduplicate(self, top, workers=TOPGEN_DEDUP_WORKERS, progress=None):
+        """Deduplicate every regular file under top, returning (files linked, bytes saved).
+
+        Only files sharing their size with another file or blob are hashed, plus any blob
+        changed since the previous pass: blobs whose content no longer matches their name
+        (a hardlinked copy rewritten in place) are dropped, as are blobs no longer
+        referenced by any file. Reflinked files don't share the blob's inode, so in
+        'reflink' mode an index next to the blobs records the digest of every file cloned,
+        which is skipped by later passes for as long as its inode, size and times match.
+        """
+        started = time.time()
+        marker = os.path.join(self.root, '.verified')
+        verified = os.path.getmtime(marker) if os.path.exists(marker) else 0
+        blobs = self.scan_blobs()
+        index = self.load_index() if self.mode == 'reflink' else {}
+        indexed = {}
+        files = defaultdict(list)
+        changed = set()
+        for path in self.walk(top):
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                entry = index.get(path)
+                if entry and entry[:4] == (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns):
+                    # cloned (or left to be the blob) by an earlier pass and untouched since:
+                    indexed[path] = entry
+                    continue
+                key = (st.st_dev, st.st_ino)
+                files[key].append((path, st.st_size))
+                # in reflink mode, files still hardlinked by an earlier hardlink pass get clones of their own:
+                if key in blobs and st.st_ctime >= verified or self.mode == 'reflink' and st.st_nlink > 1:
+                    changed.add(key)
+        sizes = defaultdict(int)
+        for entries in files.values():
+            sizes[entries[0][1]] += 1
+        for key, (_, size, _) in blobs.items():
+            if key not in files:
+                sizes[size] += 1
+        candidates = [(key, entries) for key, entries in files.items()
+                      if sizes[entries[0][1]] > 1 or key in changed]
+
+        def dedup_inode(item):
+            key, entries = item
+            digest = self.digest(entries[0][0])
+            if key in blobs and os.path.basename(blobs[key][0]) != digest:
+                logger.debug(f"Dropping stale blob {blobs[key][0]}")
+                os.unlink(blobs[key][0])
+            linked = saved = 0
+            records = {}
+            for path, size in entries:
+                result = self.link(path, digest)
+                if result:
+                    linked += 1
+                    saved += result
+                if self.mode == 'reflink' and not self.disabled:
+                    st = os.lstat(path)
+                    records[path] = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, digest)
+            return linked, saved, digest, records
+
+        linked = saved = 0
+        seen = {entry[4] for entry in indexed.values()}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for n, s, digest, records in pool.map(dedup_inode, candidates):
+                linked += n
+                saved += s
+                seen.add(digest)
+                indexed.update(records)
+                if progress:
+                    progress()
+
+        for path, _, nlink in self.scan_blobs().values():
+            if nlink == 1 if self.mode == 'hardlink' else os.path.basename(path) not in seen:
+                os.unlink(path)
+        os.makedirs(self.root, exist_ok=True)
+        if self.mode == 'reflink':
+            self.save_index(indexed)
+        with open(os.path.join(self.root, '.mode'), 'w') as f:
+            f.write(self.mode + '\n')
+        with open(marker, 'w'):
+            pass
+        os.utime(marker, (started, started))
+        return linked, saved
+
+    def load_index(self):
+        """Return {path: (inode, size, mtime_ns, ctime_ns, digest)} as recorded by the previous reflink pass"""
+        path = os.path.join(self.root, '.index')
+        if not os.path.exists(path):
+            return {}
+        db = sqlite3.connect(path)
+        try:
+            return {row[0]: tuple(row[1:]) for row in db.execute(
+                "SELECT path, inode, size, mtime_ns, ctime_ns, digest FROM files")}
+        finally:
+            db.close()
+
+    def save_index(self, index):
+        """Replace the index with {path: (inode, size, mtime_ns, ctime_ns, digest)}"""
+        db = sqlite3.connect(os.path.join(self.root, '.index'))
+        try:
+            with db:
+                db.execute("""CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    inode INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    ctime_ns INTEGER NOT NULL,
+                    digest TEXT NOT NULL)""")
+                db.execute("DELETE FROM files")
+                db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                               ((path, *entry) for path, entry in index.items()))
+        finally:
+            db.close()
+
+    def hardlinked(self):
+        """Whether files may share an inode with the blob store, i.e. it was last filled in hardlink mode"""
+        try:
+            with open(os.path.join(self.root, '.mode')) as f:
+                return f.read().strip() != 'reflink'
+        except FileNotFoundError:
+            # blobs linked by the native engine, or by a pass from before the mode was recorded:
+            return os.path.isdir(self.root)
+
+    @staticmethod
+    def walk(top):
+        """Yield the path of every file under top, removing temporary files left behind by an interrupted pass"""
+        for dirpath, _, filenames in os.walk(top):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name.startswith(DEDUP_TMP_PREFIX):
+                    logger.debug(f"Removing leftover {path}")
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                yield path
+
+    def unlink(self, tops, workers=TOPGEN_DEDUP_WORKERS):
+        """Give every hardlinked file under the tops an inode of its own again, returning the number of files copied.
+
+        wget -N rewrites files in place, which would change the content of every vhost (and of
+        the blob) sharing a hardlinked inode; the next deduplication pass links them up again.
+        """
+        paths = []
+        for top in tops:
+            for path in self.walk(top):
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                    paths.append(path)
+
+        def copy(path):
+            tmp_path = os.path.join(os.path.dirname(path), DEDUP_TMP_PREFIX + os.path.basename(path))
+            shutil.copy2(path, tmp_path)
+            os.replace(tmp_path, path)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(copy, paths))
+        return len(paths)
+
+# Asynchronous DNS resolution (hosts.nginx)
+
+def dns_query(fqdn, txid):
+    """Build a recursive DNS query for the A record of fqdn"""
+    qname = b''.join(bytes([len(label)]) + label.encode('idna') for label in fqdn.rstrip('.').split('.'))
+    return struct.pack('>HHHHHH', txid, 0x0100, 1, 0, 0, 0) + qname + b'\x00' + struct.pack('>HH', 1, 1)
+
+def dns_skip_name(data, offset):
+    """Return the offset following the (possibly compressed) domain name at offset"""
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xc0 == 0xc0:
+            return offset + 2
+        offset += length + 1
+
+def dns_parse(data):
+    """Parse a DNS response, returning (txid, flags, rcode, [(ip, ttl) for each A record])"""
+    txid, flags, qdcount, ancount, _, _ = struct.unpack_from('>HHHHHH', data)
+    offset = 12
+    for _ in range(qdcount):
+        offset = dns_skip_name(data, offset) + 4
+    addresses = []
+    for _ in range(ancount):
+        offset = dns_skip_name(data, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack_from('>HHIH', data, offset)
+        offset += 10
+        if rtype == 1 and rclass == 1 and rdlength == 4:
+            addresses.append((socket.inet_ntoa(data[offset:offset + 4]), ttl))
+        offset += rdlength
+    return txid, flags, flags & 0x000f, addresses
+
+class DNSClientProtocol(asyncio.DatagramProtocol):
+    """Deliver a single DNS response with the expected transaction id"""
+    def __init__(self, txid):
+        self.txid = txid
+        self.response = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if len(data) >= 12 and struct.unpack_from('>H', data)[0] == self.txid and not self.response.done():
+            self.response.set_result(data)
+
+    def error_received(self, exc):
+        if not self.response.done():
+            self.response.set_exception(exc)
+
+class ResolveCache:
+    """Persistent fqdn -> IP address cache honouring record TTLs (with a small floor), stored in SQLite"""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS hosts (fqdn TEXT PRIMARY KEY, ip TEXT, expires REAL NOT NULL)")
+        self.pending = 0
+
+    def get(self, fqdn):
+        """Return (hit, ip); ip is None for a cached resolution failure (NXDOMAIN)"""
+        row = self.db.execute("SELECT ip, expires FROM hosts WHERE fqdn = ?", (fqdn,)).fetchone()
+        if row and row[1] > time.time():
+            return True, row[0]
+        return False, None
+
+    def put(self, fqdn, ip, ttl):
+        self.db.execute("INSERT OR REPLACE INTO hosts (fqdn, ip, expires) VALUES (?, ?, ?)",
+                        (fqdn, ip, time.time() + max(ttl, TOPGEN_RESOLVE_MIN_TTL)))
+        self.pending += 1
+        if self.pending >= 1000:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+class Resolver:
+    """Resolve many names concurrently against a set of upstream resolvers, with caching and retries"""
+    def __init__(self, nameservers, cache=None, concurrency=TOPGEN_RESOLVE_CONCURRENCY,
+                 timeout=TOPGEN_RESOLVE_TIMEOUT, attempts=TOPGEN_RESOLVE_ATTEMPTS):
+        self.nameservers = nameservers
+        self.cache = cache
+        self.slots = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.attempts = attempts
+        self.stats = {'cached': 0, 'resolved': 0, 'failed': 0, 'queries': 0}
+
+    def tally(self, outcome):
+        self.stats[outcome] += 1
+        metrics.count('resolutions', result=outcome)
+
+    async def query(self, fqdn, nameserver):
+        txid = random.getrandbits(16)
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: DNSClientProtocol(txid), remote_addr=nameserver)
+        started = time.monotonic()
+        try:
+            self.stats['queries'] += 1
+            transport.sendto(dns_query(fqdn, txid))
+            return dns_parse(await asyncio.wait_for(protocol.response, self.timeout))
+        finally:
+            metrics.observe('dns_query_seconds', time.monotonic() - started, TOPGEN_METRICS_DNS_BUCKETS)
+            transport.close()
+
+    async def resolve(self, fqdn):
+        """Return the (first) IP address of fqdn, or None if it does not resolve"""
+        if self.cache:
+            hit, ip = self.cache.get(fqdn)
+            if hit:
+                self.tally('cached')
+                return ip
+        async with self.slots:
+            for attempt in range(self.attempts):
+                nameserver = self.nameservers[attempt % len(self.nameservers)]
+                try:
+                    _, flags, rcode, addresses = await self.query(fqdn, nameserver)
+                except (asyncio.TimeoutError, OSError, struct.error, IndexError, UnicodeError) as e:
+                    logger.debug(f"[{fqdn}] query to {nameserver[0]} failed: {e!r}")
+                    continue
+                if rcode == 3 or (rcode == 0 and not addresses and not flags & 0x0200):
+                    # NXDOMAIN, or no A record
+                    self.tally('failed')
+                    if self.cache:
+                        self.cache.put(fqdn, None, TOPGEN_RESOLVE_NEGATIVE_TTL)
+                    return None
+                if rcode == 0 and addresses:
+                    self.tally('resolved')
+                    if self.cache:
+                        self.cache.put(fqdn, addresses[0][0], min(ttl for _, ttl in addresses))
+                    return addresses[0][0]
+                # SERVFAIL, REFUSED or truncated: try the next resolver
+        self.tally('failed')
+        return None
+
+def system_nameservers():
+    """Return the nameservers listed in /etc/resolv.conf (or localhost)"""
+    nameservers = []
+    try:
+        with open('/etc/resolv.conf') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    nameservers.append(fields[1])
+    except OSError:
+        pass
+    return nameservers or ['127.0.0.1']
+
+def parse_nameservers(spec):
+    """Parse 'ip[:port],...' (use [ipv6]:port for IPv6) into (host, port) tuples"""
+    nameservers = []
+    for item in spec.split(','):
+        item = item.strip()
+        match = re.match(r'^\[(.+)\](?::(\d+))?$', item) or re.match(r'^([^:]+)(?::(\d+))?$', item) \
+            or re.match(r'^(.+)()$', item)
+        nameservers.append((match.group(1), int(match.group(2) or 53)))
+    return nameservers
+
+class StubDNSServer(asyncio.DatagramProtocol):
+    """Minimal local DNS server answering A queries from a {fqdn: ip} dict, NXDOMAIN otherwise.
+
+    Stands in for upstream resolvers when testing or benchmarking (--resolvers 127.0.0.1:<port>).
+    """
+    def __init__(self, records, ttl=300):
+        self.records = {k.lower().rstrip('.'): v for k, v in records.items()}
+        self.ttl = ttl
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            txid, _, qdcount, _, _, _ = struct.unpack_from('>HHHHHH', data)
+            end = dns_skip_name(data, 12)
+            labels, offset = [], 12
+            while data[offset]:
+                labels.append(data[offset + 1:offset + 1 + data[offset]].decode('ascii'))
+                offset += data[offset] + 1
+            question = data[12:end + 4]
+        except (struct.error, IndexError, UnicodeError):
+            return
+        ip = self.records.get('.'.join(labels).lower())
+        flags = 0x8180 if ip else 0x8183
+        answer = b''
+        if ip:
+            answer = b'\xc0\x0c' + struct.pack('>HHIH', 1, 1, self.ttl, 4) + socket.inet_aton(ip)
+        header = struct.pack('>HHHHHH', txid, flags, 1, 1 if ip else 0, 0, 0)
+        self.transport.sendto(header + question + answer, addr)
+
+    @classmethod
+    async def start(cls, records, host='127.0.0.1', port=0, ttl=300):
+        """Serve records on host:port (0 picks a free port); returns (transport, port)"""
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: cls(records, ttl), local_addr=(host, port))
+        return transport, transport.get_extra_info('sockname')[1]
+
 # Big Boy Functions
 
-async def download_websites():
-    """Download all websites from TOPGEN_ORIG"""
-    tasks = []
-    # Create task list
-    for url in open(TOPGEN_ORIG):
-        if url.startswith('#'):
-            continue
-        task = asyncio.create_task(download_website(url))
-        tasks.append(task)
-    
-    # Create progress bar
-    pbar = manager.counter(total=len(tasks),desc='Scraping Websites',bar_format=BAR_FMT)
-    await asyncio.sleep(0.1)  # Wait for progress bar to initialize
-    # Update progress bar every second
-    
-    # Run progress updater and tasks
-    update_task = asyncio.create_task(update_progress(tasks, pbar))
-    await asyncio.gather(*tasks)
-    await update_task
+class ScrapeJournal:
+    """Persistent per-site scrape state (pending/running/done/failed), stored in SQLite"""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sites (
+            url TEXT PRIMARY KEY,
+            depth INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            returncode INTEGER,
+            files INTEGER,
+            bytes INTEGER,
+            queued_at REAL,
+            started_at REAL,
+            finished_at REAL)""")
+        # journals written before scrape budgets lack the truncation report:
+        try:
+            self.db.execute("ALTER TABLE sites ADD COLUMN truncated TEXT")
+        except sqlite3.OperationalError:
+            pass
+        # what each site's last successful scrape took, kept across runs (reset() leaves it alone):
+        self.db.execute("""CREATE TABLE IF NOT EXISTS history (
+            url TEXT PRIMARY KEY,
+            bytes INTEGER NOT NULL,
+            seconds REAL NOT NULL)""")
+
+    def reset(self):
+        """Forget all recorded progress"""
+        self.db.execute("DELETE FROM sites")
+
+    def add(self, url, depth):
+        """Record url as pending unless it is already known"""
+        self.db.execute("INSERT OR IGNORE INTO sites (url, depth, queued_at) VALUES (?, ?, ?)",
+                        (url, depth, time.time()))
+
+    def unfinished(self):
+        """Return (url, depth) for every site not successfully scraped yet"""
+        return self.db.execute("SELECT url, depth FROM sites WHERE state != 'done' ORDER BY rowid").fetchall()
+
+    def counts(self):
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM sites GROUP BY state").fetchall())
+
+    def start(self, url):
+        self.db.execute("UPDATE sites SET state = 'running', attempts = attempts + 1, started_at = ? WHERE url = ?",
+                        (time.time(), url))
+
+    def finish(self, url, result):
+        state = 'done' if result['returncode'] in SCRAPE_COMPLETED else 'failed'
+        truncated = json.dumps(result['truncated']) if result.get('truncated') else None
+        now = time.time()
+        self.db.execute("UPDATE sites SET state = ?, returncode = ?, files = ?, bytes = ?, finished_at = ?, truncated = ? WHERE url = ?",
+                        (state, result['returncode'], result['files'], result['bytes'], now, truncated, url))
+        if state == 'done':
+            self.db.execute("INSERT OR REPLACE INTO history (url, bytes, seconds) "
+                            "SELECT url, ?, ? - started_at FROM sites WHERE url = ? AND started_at IS NOT NULL",
+                            (result['bytes'], now, url))
+
+    def history(self):
+        """Return {url: (bytes, seconds)} of the last successful scrape of each site, from this run or earlier ones"""
+        return {url: (size, seconds) for url, size, seconds in self.db.execute("SELECT url, bytes, seconds FROM history")}
+
+    def truncations(self):
+        """Return {url: {'files', 'bytes', 'truncated'}} for sites cut short by their scrape budget"""
+        rows = self.db.execute("SELECT url, files, bytes, truncated FROM sites WHERE truncated IS NOT NULL ORDER BY url")
+        return {url: {'files': files, 'bytes': size, 'truncated': json.loads(truncated)}
+                for url, files, size, truncated in rows}
+
+    def close(self):
+        self.db.close()
+
+class ScrapeJob:
+    """A single site to be scraped by the ScrapeScheduler; jobs with lower (comparable) priorities go first"""
+    def __init__(self, url, depth, priority, budget=None):
+        self.url = url
+        self.depth = depth
+        self.priority = priority
+        self.budget = budget
+        self.hostname = urlparse(url).hostname or url
+        self.domain = registered_domain(self.hostname)
+        self.attempts = 0
+
+class ScrapeScheduler:
+    """Run download_website() (or another fetch coroutine) for queued jobs with a global and a per-domain concurrency cap.
+
+    Jobs are taken from a priority queue (lowest priority value first, retries after all
+    first attempts). Jobs whose domain is already at its concurrency cap are parked until a
+    slot for that domain frees up, and domains returning errors are backed off exponentially.
+    """
+    def __init__(self, workers, per_domain, retries, fetch=None):
+        self.fetch = fetch or download_website
+        self.workers = workers
+        self.per_domain = per_domain
+        self.retries = retries
+        self.queue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.active = defaultdict(int)
+        self.parked = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.not_before = {}
+        self.outstanding = 0
+        self.running = 0
+        self.finished = 0
+        self.failed = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def submit(self, job):
+        self.outstanding += 1
+        self.idle.clear()
+        self.queue.put_nowait((job.attempts, job.priority, next(self.sequence), job))
+
+    def requeue(self, job):
+        self.queue.put_nowait((job.attempts, job.priority, next(self.sequence), job))
+
+    def queued(self):
+        return self.outstanding - self.running
+
+    def backoff(self, domain):
+        """Seconds remaining until domain may be scraped again"""
+        return max(0.0, self.not_before.get(domain, 0) - time.monotonic())
+
+    def record_result(self, domain, returncode):
+        if returncode in SCRAPE_COMPLETED:
+            self.failures[domain] = max(0, self.failures[domain] - 1)
+            return
+        if returncode not in SCRAPE_TRANSIENT:
+            return
+        self.failures[domain] += 1
+        delay = min(TOPGEN_BACKOFF_MAX, TOPGEN_BACKOFF_BASE * 2 ** (self.failures[domain] - 1))
+        self.not_before[domain] = time.monotonic() + delay
+        logger.debug(f'{domain}: backing off for {delay}s after {self.failures[domain]} failure(s)')
+
+    async def worker(self, on_start, on_done):
+        loop = asyncio.get_running_loop()
+        while True:
+            *_, job = await self.queue.get()
+            if self.active[job.domain] >= self.per_domain:
+                self.parked[job.domain].append(job)
+                continue
+            delay = self.backoff(job.domain)
+            if delay > 0:
+                loop.call_later(delay, self.requeue, job)
+                continue
+
+            self.active[job.domain] += 1
+            self.running += 1
+            job.attempts += 1
+            on_start(job)
+            try:
+                result = await self.fetch(job.url, job.depth, job.budget)
+            except Exception as e:
+                # a fetch that blew up counts as a failed attempt, so the job is still accounted for:
+                logger.error(f'{job.hostname}: scrape failed: {type(e).__name__}: {e}')
+                result = {'returncode': -1, 'files': 0, 'bytes': 0, 'truncated': []}
+            finally:
+                self.active[job.domain] -= 1
+                self.running -= 1
+                if self.parked[job.domain]:
+                    self.requeue(self.parked[job.domain].pop(0))
+            returncode = result['returncode']
+            self.record_result(job.domain, returncode)
+
+            # a network failure, or an exception raised by the fetch; anything else is not worth retrying:
+            if returncode in SCRAPE_TRANSIENT and job.attempts <= self.retries:
+                logger.info(f'Requeueing {job.hostname} (attempt {job.attempts} of {self.retries + 1})')
+                self.requeue(job)
+                continue
+
+            self.outstanding -= 1
+            self.finished += 1
+            if returncode not in SCRAPE_COMPLETED:
+                self.failed += 1
+            on_done(job, result)
+            if self.outstanding == 0:
+                self.idle.set()
 
-    # Final update and close
-    pbar.count = len(tasks)
+    async def run(self, on_start, on_done):
+        """Process all submitted jobs, calling on_start(job) before each attempt and
+        on_done(job, result) once a job has finished for good"""
+        workers = [asyncio.create_task(self.worker(on_start, on_done)) for _ in range(self.workers)]
+        try:
+            await self.idle.wait()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+def scrape_priority(depth, history=None, order=None):
+    """Rank a site by its (bytes, seconds) history, fastest or slowest first according to order
+    (TOPGEN_SCRAPE_ORDER); sites without history (of unknown cost) go before them, shallow ones first"""
+    if history is None:
+        return (float('-inf'), 0, depth)
+    size, seconds = history
+    if (order or TOPGEN_SCRAPE_ORDER) == 'slowest':
+        return (-seconds, -size, depth)
+    return (seconds, size, depth)
+
+def linked_hosts(top):
+    """Return the hosts the HTML and CSS files scraped into the vhost directory top link to"""
+    hosts = set()
+    for dirpath, _, filenames in os.walk(top):
+        for name in filenames:
+            if not name.lower().endswith(('.html', '.htm', '.css')):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                with open(path, errors='replace') as f:
+                    text = f.read()
+            except OSError:
+                continue
+            base = 'http://' + os.path.relpath(path, TOPGEN_VHOSTS).replace(os.sep, '/')
+            if name.lower().endswith('.css'):
+                refs = css_urls(text)
+            else:
+                parser = LinkExtractor()
+                parser.feed(text)
+                refs = parser.links + parser.requisites
+                if parser.base:
+                    base = urljoin(base, parser.base)
+            for ref in refs:
+                try:
+                    host = urlsplit(urljoin(base, ref)).hostname
+                except ValueError:
+                    continue
+                if host:
+                    hosts.add(host)
+    return hosts
+
+def span_reach(sites):
+    """Return the vhost directories wget may rewrite files in when scraping sites ((url, depth) pairs).
+
+    With --span-hosts that's the sites' own directories plus those of every host their pages
+    link to, followed as many links deep as the sites are scraped, plus one for the page
+    requisites of the deepest pages. Links are taken from the copies scraped by earlier runs.
+    """
+    reached = {urlparse(url).hostname for url, _ in sites}
+    frontier = set(reached)
+    for _ in range(max(depth for _, depth in sites) + 1):
+        found = set()
+        for host in frontier:
+            found |= linked_hosts(os.path.join(TOPGEN_VHOSTS, host))
+        frontier = {host for host in found - reached if os.path.isdir(os.path.join(TOPGEN_VHOSTS, host))}
+        reached |= frontier
+    return sorted(os.path.join(TOPGEN_VHOSTS, host) for host in reached
+                  if host and os.path.isdir(os.path.join(TOPGEN_VHOSTS, host)))
+
+async def download_websites(resume=False, feed=None):
+    """Download all websites from TOPGEN_ORIG, or only the unfinished ones if resuming.
+
+    If a VhostFeed is given, it is told to look for new vhosts whenever a site finishes.
+    """
+    journal = ScrapeJournal(TOPGEN_JOURNAL)
+    if not resume:
+        journal.reset()
+    history = journal.history()
+    # Sites added to TOPGEN_ORIG since the interrupted run are picked up as well:
+    budgets = {}
+    for url, depth, budget in parse_sites(TOPGEN_ORIG):
+        journal.add(url, depth)
+        budgets[url] = budget
+    if resume:
+        logger.info(f"Resuming scrape: {journal.counts()}")
+
+    # wget rewrites files in place, and with --span-hosts it also refreshes page requisites in other
+    # vhosts' directories (the shared CDN assets dedup links together), so no file it might touch may
+    # share its inode; check even without --dedup, the tree may have been hardlinked by an earlier run:
+    store = DedupStore(TOPGEN_BLOBS)
+    if TOPGEN_SCRAPE_ENGINE == 'wget' and journal.unfinished() and store.hardlinked():
+        loop = asyncio.get_running_loop()
+        reach = await loop.run_in_executor(None, span_reach, journal.unfinished())
+        unlinked = await loop.run_in_executor(None, store.unlink, reach)
+        if unlinked:
+            logger.info(f"Copied {unlinked} hardlinked files before scraping, the dedup stage links them up again")
+
+    crawler = None
+    if TOPGEN_SCRAPE_ENGINE == "native":
+        crawler = NativeCrawler(TOPGEN_VHOSTS, dedup=DedupStore(TOPGEN_BLOBS, TOPGEN_DEDUP) if TOPGEN_DEDUP else None)
+        await crawler.start()
+    scheduler = ScrapeScheduler(TOPGEN_SCRAPE_WORKERS, TOPGEN_SCRAPE_PER_DOMAIN, TOPGEN_SCRAPE_RETRIES,
+                                fetch=crawler.crawl if crawler else None)
+    for url, depth in journal.unfinished():
+        scheduler.submit(ScrapeJob(url, depth, priority=scrape_priority(depth, history.get(url)), budget=budgets.get(url)))
+
+    pbar = manager.counter(total=scheduler.outstanding, desc='Scraping Websites', bar_format=BAR_FMT)
+    status = manager.status_bar(status_format=u'Scraping{fill}{stats}{fill}', stats='', justify=enlighten.Justify.CENTER,
+                                autorefresh=True, min_delta=0.5, leave=False)
+    started = time.monotonic()
+    attempt_started = {}
+
+    def report_status():
+        rate = scheduler.finished / max(time.monotonic() - started, 1) * 60
+        status.update(stats=f'queued {scheduler.queued()} | running {scheduler.running} | '
+                            f'done {scheduler.finished} | failed {scheduler.failed} | {rate:.1f} sites/min')
+
+    def on_start(job):
+        journal.start(job.url)
+        attempt_started[job.url] = time.monotonic()
+
+    def on_done(job, result):
+        journal.finish(job.url, result)
+        metrics.site(job.hostname, result, time.monotonic() - attempt_started.pop(job.url))
+        pbar.update(1)
+        report_status()
+        if feed:
+            feed.discover()
+
+    async def report_periodically():
+        while True:
+            report_status()
+            await asyncio.sleep(1)
+
+    reporter = asyncio.create_task(report_periodically())
+    try:
+        await scheduler.run(on_start, on_done)
+    finally:
+        reporter.cancel()
+        truncations = journal.truncations()
+        write_atomic(TOPGEN_SCRAPE_REPORT, json.dumps(truncations, indent=1, sort_keys=True))
+        if truncations:
+            logger.info(f"{len(truncations)} sites truncated by their scrape budget, see {TOPGEN_SCRAPE_REPORT}")
+        journal.close()
+        if crawler:
+            await crawler.close()
+        if feed:
+            feed.discover()
+            feed.close()
+    report_status()
+    status.close()
     pbar.close()
 
-async def download_website(url):
-    url = url.strip()
-    if not url:
-        raise ValueError("URL is empty")
+async def download_website(url, depth=wget_depth, budget=None):
+    """Scrape url into TOPGEN_VHOSTS with wget, within budget (a ScrapeBudget).
+
+    Returns a dict with wget's exit code ('returncode', -1 if wget could not be run),
+    the number of 'files' and 'bytes' it saved, and what the budget 'truncated'. wget
+    is stopped as soon as the site runs out of budget, which counts as success.
+    """
+    result = {'returncode': None, 'files': 0, 'bytes': 0, 'truncated': []}
     hostname = urlparse(url).hostname
+    meter = (budget or ScrapeBudget.default()).meter()
+    current = {'path': None, 'type': ''}
     pbar = manager.counter(desc='    Scraping %s' % hostname, autorefresh=True, leave=False, counter_format='{desc}:{desc_pad}[Elapsed: {elapsed}]')
     try:
-        proc = await asyncio.create_subprocess_shell(
-            f"/usr/bin/wget -v --page-requisites --recursive --adjust-extension --span-hosts -N --convert-file-only --no-check-certificate -e robots=off --random-wait -t 2 -U 'Mozilla/5.0 (X11)' -P {TOPGEN_VHOSTS} -l {wget_depth} {url}",
+        # url and budget come from the sites file, so no shell gets to see them:
+        proc = await asyncio.create_subprocess_exec(
+            '/usr/bin/wget', '-v', '--progress=dot:binary', '--page-requisites', '--recursive', '--adjust-extension',
+            '--span-hosts', '-N', '--convert-file-only', '--no-check-certificate', '-e', 'robots=off', '--random-wait',
+            '-t', '2', '-U', 'Mozilla/5.0 (X11)', *meter.budget.wget_options(), '-P', TOPGEN_VHOSTS, '-l', str(depth),
+            '--', url,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE)
-        
+        metrics.count('subprocesses', command='wget')
+        # formatting every line of wget output costs, only do so if it gets logged:
+        verbose = logger.isEnabledFor(logging.DEBUG)
+
+        def stop():
+            if proc.returncode is None:
+                logger.info(f'{hostname}: {meter.exceeded}, stopping wget')
+                proc.terminate()
+
+        def discard(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
         # Process stdout and stderr streams simultaneously
         async def read_stream(stream):
             while True:
                 line = await stream.readline()
                 if not line:
                     break
-                logger.debug(f'[{hostname}] {line.decode().strip()}')
-        
+                line = line.decode(errors='replace').strip()
+                progress = WGET_PROGRESS.match(line)
+                if progress:
+                    # stop wget halfway through a file that does not fit:
+                    if not meter.fits(int(progress.group(1)) * 1024):
+                        stop()
+                    continue
+                if length := WGET_LENGTH.match(line):
+                    current['type'] = length.group(1)
+                elif saving := WGET_SAVING.match(line):
+                    current['path'] = saving.group(1)
+                    if meter.exhausted():
+                        stop()
+                elif saved := WGET_SAVED.search(line):
+                    path, size = saved.group(1), int(saved.group(2))
+                    content_type = current['type'] or mimetypes.guess_type(path)[0] or ''
+                    current.update(path=None, type='')
+                    if meter.admit(path, content_type) and meter.consume(size):
+                        result['files'] += 1
+                        result['bytes'] += size
+                    else:
+                        discard(path)
+                        if meter.exhausted():
+                            stop()
+                if verbose:
+                    logger.debug(f'[{hostname}] {line}')
+
         # Create tasks for reading both streams
         stdout_task = asyncio.create_task(read_stream(proc.stdout))
         stderr_task = asyncio.create_task(read_stream(proc.stderr))
-        
-        # Wait for wget to complete and streams to be processed
-        await proc.wait()
+
+        # Wait for wget to complete (or run out of time) and streams to be processed
+        try:
+            await asyncio.wait_for(asyncio.shield(proc.wait()), meter.remaining_time())
+        except asyncio.TimeoutError:
+            meter.exhausted()
+            stop()
+            await proc.wait()
         await stdout_task
         await stderr_task
-        
-        
-        if proc.returncode != 0:
+
+        result['truncated'] = meter.report()
+        if meter.exceeded:
+            # wget was stopped on purpose, and may have left a partial file behind:
+            if current['path']:
+                discard(current['path'])
+            result['returncode'] = 0
+            logger.warning(f'{hostname}: truncated ({"; ".join(result["truncated"])})')
+        else:
+            result['returncode'] = proc.returncode
+        if result['returncode'] == 8:
+            logger.warning(f'{hostname}: some requests got server error responses (wget exit code 8)')
+        elif result['returncode'] != 0:
             logger.error(f'{hostname}: wget returned non-zero exit code {proc.returncode}')
-        
+
         logger.info(f'✓ {hostname} ({format_elapsed_time(pbar.elapsed)})')
 
     except Exception as e:
+        # counted as a failed attempt, which the scheduler retries:
+        result['returncode'] = -1
         logger.error(f'Failed {hostname} after {format_elapsed_time(pbar.elapsed)}: {str(e)}')
     finally:
         pbar.close()
+    return result
 
-async def handle_custom_vhosts():
-    """Process custom vhosts from TOPGEN_VARETC/custom_vhosts directory"""
-    if not os.path.exists(TOPGEN_CUSTOM_VHOSTS):
-        logger.debug("No custom vhosts directory found")
-        return
+# Native crawler engine (--engine native)
 
-    vhosts = list(os.scandir(TOPGEN_CUSTOM_VHOSTS))
-    with manager.counter(total=len(vhosts), desc='Handling Custom vHosts', bar_format=BAR_FMT) as pbar:
-        for vhost in vhosts:
-            if vhost.is_dir():
-                vhost_name = vhost.name
-                vhost_content = os.path.join(TOPGEN_CUSTOM_VHOSTS, vhost_name)
-                vhost_destination = os.path.join(TOPGEN_VHOSTS, vhost_name)
-
-                # Copy website content to vhosts directory
-                if os.path.exists(vhost_destination):
-                    shutil.rmtree(vhost_destination)
-                shutil.copytree(vhost_content, vhost_destination)
-                logger.debug(f"Copied custom vhost: {vhost_name}")
-            pbar.update(1)
+class LinkExtractor(HTMLParser):
+    """Collect followable links and page requisites (images, scripts, stylesheets, ...) from HTML"""
+    REQUISITE_ATTRS = {
+        'img': ('src', 'srcset'), 'source': ('src', 'srcset'), 'script': ('src',),
+        'video': ('src', 'poster'), 'audio': ('src',), 'track': ('src',), 'embed': ('src',),
+        'iframe': ('src',), 'frame': ('src',), 'input': ('src',), 'object': ('data',),
+        'body': ('background',), 'table': ('background',), 'td': ('background',),
+    }
+    REQUISITE_RELS = {'stylesheet', 'icon', 'shortcut', 'apple-touch-icon', 'preload', 'modulepreload'}
 
-async def cleanup_vhosts():
-    """Remove IP-only vhosts and vhosts with port numbers"""
-    vhosts = list(glob.glob(f"{TOPGEN_VHOSTS}/*"))
-    with manager.counter(total=len(vhosts), desc='Cleaning vhosts', bar_format=BAR_FMT) as pbar:
-        for vhost in vhosts:
-            vhost_name = os.path.basename(vhost)
-            if re.match(r'^[\d.]+$', vhost_name) or ':' in vhost_name:
-                logger.debug(f"Cleaning up: Removing {vhost_name}")
-                shutil.rmtree(vhost, ignore_errors=True)
-            pbar.update(1)
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.base = None
+        self.links = []
+        self.requisites = []
+        self.in_style = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {k: v for k, v in attrs if v}
+        if tag == 'base' and 'href' in attrs:
+            self.base = attrs['href']
+        elif tag in ('a', 'area') and 'href' in attrs:
+            self.links.append(attrs['href'])
+        elif tag == 'link' and 'href' in attrs:
+            rels = set(attrs.get('rel', '').lower().split())
+            (self.requisites if rels & self.REQUISITE_RELS else self.links).append(attrs['href'])
+        elif tag == 'style':
+            self.in_style = True
+        for attr in self.REQUISITE_ATTRS.get(tag, ()):
+            if attr not in attrs:
+                continue
+            if attr == 'srcset':
+                self.requisites.extend(c.split()[0] for c in attrs[attr].split(',') if c.strip())
+            else:
+                self.requisites.append(attrs[attr])
+        if 'style' in attrs:
+            self.requisites.extend(css_urls(attrs['style']))
+
+    def handle_endtag(self, tag):
+        if tag == 'style':
+            self.in_style = False
+
+    def handle_data(self, data):
+        if self.in_style:
+            self.requisites.extend(css_urls(data))
+
+def css_urls(text):
+    """Return the url(...) and @import targets referenced by a stylesheet"""
+    return [a or b for a, b in CSS_URL.findall(text) if not (a or b).startswith('data:')]
+
+class NativeCrawler:
+    """Asyncio replacement for the wget engine, shared by all sites of a scrape.
+
+    All sites share one pooled keep-alive (HTTP/2 where available) client, and a URL is
+    fetched at most once per run no matter how many sites reference it. Files are saved
+    under <root>/<host>/<path> like wget does with --adjust-extension --convert-file-only:
+    HTML and CSS served under other names get a .html/.css suffix, and links to renamed
+    files are rewritten accordingly once a site is done.
+    """
+    def __init__(self, root, connections=TOPGEN_NATIVE_CONNECTIONS, per_site=TOPGEN_NATIVE_PER_SITE, dedup=None):
+        self.root = root
+        self.dedup = dedup
+        self.connections = connections
+        self.per_site = per_site
+        self.client = None
+        self.fetches = {}
+        self.expanded = {}
+        self.renamed = {}
+
+    async def start(self):
+        """Open the shared HTTP client"""
+        try:
+            import httpx
+        except ImportError:
+            raise RuntimeError("the native engine requires the httpx python module")
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+        self.httpx = httpx
+        self.client = httpx.AsyncClient(
+            http2=http2, verify=False, follow_redirects=True,
+            headers={'User-Agent': 'Mozilla/5.0 (X11)'},
+            timeout=httpx.Timeout(60.0, connect=20.0),
+            limits=httpx.Limits(max_connections=self.connections,
+                                max_keepalive_connections=self.connections))
+
+    async def close(self):
+        await self.client.aclose()
+
+    def local_path(self, url, content_type=''):
+        """Map url to its file under root, adjusting the extension for HTML and CSS content"""
+        parts = urlsplit(url)
+        host = parts.hostname
+        if parts.port and parts.port != {'http': 80, 'https': 443}[parts.scheme]:
+            host = f"{host}:{parts.port}"
+        path = posixpath.normpath('/' + unquote(parts.path))
+        if parts.path.endswith('/') or path == '/':
+            path = posixpath.join(path, 'index.html')
+        if parts.query:
+            path += '?' + parts.query
+        if content_type.startswith('text/html') and not re.search(r'\.html?$', path, re.I):
+            path += '.html'
+        elif content_type.startswith('text/css') and not path.lower().endswith('.css'):
+            path += '.css'
+        return os.path.join(self.root, host, path.lstrip('/'))
+
+    def cached_path(self, url):
+        """Return a previously saved copy of url, if any (for If-Modified-Since, like wget -N)"""
+        path = self.local_path(url)
+        for candidate in (path, path + '.html', path + '.css'):
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+
+    def fetch(self, url, site):
+        """Fetch url once per run; concurrent callers share the same download"""
+        if url not in self.fetches:
+            self.fetches[url] = asyncio.ensure_future(self.download(url, site))
+        return self.fetches[url]
+
+    async def download(self, url, site):
+        """Save url to disk, returning (path, content_type) or None on error"""
+        async with site['slots']:
+            for attempt in range(2):
+                try:
+                    return await self.save(url, site)
+                except self.httpx.TransportError as e:
+                    error = e
+                except BudgetExceeded:
+                    # only this site is out of budget, others may still fetch url:
+                    if self.fetches.get(url) is asyncio.current_task():
+                        del self.fetches[url]
+                    return None
+            logger.debug(f"[{site['hostname']}] {url}: {error!r}")
+            site['errors'].add(4)
+            return None
+
+    async def save(self, url, site):
+        meter = site['meter']
+        if not meter.wanted(url):
+            raise BudgetExceeded(url)
+        cached = self.cached_path(url)
+        headers = {}
+        if cached:
+            headers['If-Modified-Since'] = formatdate(os.path.getmtime(cached), usegmt=True)
+        async with self.client.stream('GET', url, headers=headers) as resp:
+            final_url = str(resp.url)
+            content_type = resp.headers.get('content-type', '').lower()
+            if resp.status_code == 304 and cached:
+                logger.debug(f"[{site['hostname']}] {url} not modified")
+                if cached != self.local_path(final_url):
+                    self.renamed[final_url] = cached[len(self.local_path(final_url)):]
+                return cached, content_type or mimetypes.guess_type(cached)[0] or ''
+            if resp.status_code >= 400:
+                logger.debug(f"[{site['hostname']}] {url}: HTTP {resp.status_code}")
+                site['errors'].add(8)
+                return None
+            if not meter.admit(final_url, content_type):
+                raise BudgetExceeded(url)
+
+            path = self.local_path(final_url, content_type)
+            if not os.path.realpath(path).startswith(os.path.realpath(self.root) + os.sep):
+                return None
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.topgen.')
+            except OSError as e:
+                logger.debug(f"[{site['hostname']}] cannot save {url} as {path}: {e}")
+                return None
+            try:
+                size = 0
+                digest = hashlib.sha256()
+                with os.fdopen(fd, 'wb') as f:
+                    async for chunk in resp.aiter_bytes():
+                        if not meter.consume(len(chunk)):
+                            raise BudgetExceeded(url)
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        last_modified = resp.headers.get('last-modified')
+        if last_modified:
+            try:
+                mtime = parsedate_to_datetime(last_modified).timestamp()
+                os.utime(path, (mtime, mtime))
+            except (TypeError, ValueError):
+                pass
+        if path != self.local_path(final_url):
+            self.renamed[final_url] = path[len(self.local_path(final_url)):]
+        # links are converted in place later, so only deduplicate other files right away:
+        if self.dedup and size and not content_type.startswith(('text/html', 'text/css')):
+            self.dedup.link(path, digest.hexdigest())
+        site['files'] += 1
+        site['bytes'] += size
+        site['documents'].append((final_url, path, content_type))
+        return path, content_type
+
+    def references(self, url, path, content_type):
+        """Return the absolute (links, requisites) referenced by a saved HTML or CSS file"""
+        with open(path, 'rb') as f:
+            text = f.read().decode('utf-8', 'surrogateescape')
+        if content_type.startswith('text/css') or path.endswith('.css'):
+            links, requisites, base = [], css_urls(text), url
+        else:
+            parser = LinkExtractor()
+            try:
+                parser.feed(text)
+                parser.close()
+            except Exception as e:
+                logger.debug(f"Failed parsing {url}: {e}")
+            links, requisites = parser.links, parser.requisites
+            base = urljoin(url, parser.base) if parser.base else url
+
+        def absolute(refs):
+            result = []
+            for ref in refs:
+                target = urldefrag(urljoin(base, ref.strip()))[0]
+                if target.startswith(('http://', 'https://')):
+                    result.append(target)
+            return result
+        return absolute(links), absolute(requisites)
 
-async def curate_vhosts():
-    """Handle www.example.org/index.html issue"""
-    vhosts = list(glob.glob(f"{TOPGEN_VHOSTS}/*"))
-    with manager.counter(total=len(vhosts), desc='Curating vhosts', bar_format=BAR_FMT) as pbar:
-        for vhost in vhosts:
-            vhost_base = os.path.basename(vhost)
-            
-            if not os.path.isdir(vhost):
-                pbar.update(1)
+    async def requisites(self, url, fetched, site):
+        """Fetch everything needed to render a saved page (including stylesheet imports)"""
+        todo = [(url, fetched)]
+        while todo:
+            url, (path, content_type) = todo.pop()
+            if not (content_type.startswith(('text/html', 'text/css')) or path.endswith(('.html', '.htm', '.css'))):
                 continue
-                
-            num_files = len(os.listdir(vhost))
-            
-            if (num_files == 1 and 
-                os.path.isfile(os.path.join(vhost, "index.html"))):
-                
-                www_vhost = os.path.join(TOPGEN_VHOSTS, f"www.{vhost_base}")
-                if (os.path.isdir(www_vhost) and 
-                    not os.path.isfile(os.path.join(www_vhost, "index.html"))):
-                    
-                    src = os.path.join(vhost, "index.html")
-                    dst = os.path.join(www_vhost, "index.html")
-                    shutil.copy2(src, dst)
-                    logger.info(f"Curated: {src} -> {dst}")
+            _, requisites = self.references(url, path, content_type)
+            results = await asyncio.gather(*(self.fetch(r, site) for r in requisites))
+            for requisite, res in zip(requisites, results):
+                if res and res[0].endswith('.css') and requisite not in site['styles']:
+                    site['styles'].add(requisite)
+                    todo.append((requisite, res))
+
+    async def page(self, url, remaining, site):
+        """Fetch a page and its requisites, following links while remaining depth lasts"""
+        fetched = await self.fetch(url, site)
+        if fetched is None or self.expanded.get(url, -1) >= remaining:
+            return
+        self.expanded[url] = remaining
+        await self.requisites(url, fetched, site)
+        path, content_type = fetched
+        if remaining > 0 and (content_type.startswith('text/html') or path.endswith(('.html', '.htm'))):
+            links, _ = self.references(url, path, content_type)
+            await asyncio.gather(*(self.page(link, remaining - 1, site) for link in links))
+
+    def convert_links(self, url, path):
+        """Rewrite links in a saved document to point at the renamed (.html/.css) local files"""
+        with open(path, 'rb') as f:
+            text = f.read().decode('utf-8', 'surrogateescape')
+
+        def convert(ref):
+            target, fragment = urldefrag(urljoin(url, ref))
+            suffix = self.renamed.get(target)
+            if not suffix or '?' in ref:
+                return ref
+            ref_path = ref.split('#', 1)[0]
+            return ref_path + suffix + (f'#{fragment}' if fragment else '')
+
+        converted = HTML_REF.sub(lambda m: m.group(1) + m.group(2) + convert(m.group(3)) + m.group(2), text)
+        converted = CSS_REF.sub(lambda m: m.group(1) + convert(m.group(2)) + m.group(3), converted)
+        if converted != text:
+            write_atomic(path, converted.encode('utf-8', 'surrogateescape'))
+
+    async def crawl(self, url, depth=wget_depth, budget=None):
+        """Scrape url into root within budget; returns a dict compatible with download_website()
+        ('returncode' -1 if the crawl raised)"""
+        hostname = urlparse(url).hostname
+        site = {'hostname': hostname, 'slots': asyncio.Semaphore(self.per_site),
+                'errors': set(), 'files': 0, 'bytes': 0, 'documents': [], 'styles': set(),
+                'meter': (budget or ScrapeBudget.default()).meter()}
+        result = {'returncode': None, 'files': 0, 'bytes': 0, 'truncated': []}
+        pbar = manager.counter(desc='    Scraping %s' % hostname, autorefresh=True, leave=False, counter_format='{desc}:{desc_pad}[Elapsed: {elapsed}]')
+        try:
+            await self.page(urldefrag(url)[0], depth, site)
+            for doc_url, path, content_type in site['documents']:
+                if content_type.startswith(('text/html', 'text/css')):
+                    self.convert_links(doc_url, path)
+            # like wget, lower-numbered error codes take precedence:
+            result.update(returncode=min(site['errors'], default=0), files=site['files'], bytes=site['bytes'],
+                          truncated=site['meter'].report())
+            if result['truncated']:
+                logger.warning(f'{hostname}: truncated ({"; ".join(result["truncated"])})')
+            if result['returncode'] == 8:
+                logger.warning(f'{hostname}: some requests got server error responses (exit code 8)')
+            elif result['returncode'] != 0:
+                logger.error(f'{hostname}: native engine finished with exit code {result["returncode"]}')
+            logger.info(f'✓ {hostname} ({format_elapsed_time(pbar.elapsed)})')
+        except Exception as e:
+            # counted as a failed attempt, which the scheduler retries, like a wget that could not be run:
+            result['returncode'] = -1
+            logger.error(f'Failed {hostname} after {format_elapsed_time(pbar.elapsed)}: {str(e)}')
+        finally:
+            pbar.close()
+        return result
+
+def junk_vhost(vhost_name):
+    """IP-only vhosts and vhosts with port numbers are not served"""
+    return bool(re.match(r'^[\d.]+$', vhost_name)) or ':' in vhost_name
+
+def copy_custom_vhost(vhost_name):
+    """Copy a custom vhost from TOPGEN_CUSTOM_VHOSTS over its scraped content, if any"""
+    vhost_destination = os.path.join(TOPGEN_VHOSTS, vhost_name)
+    if os.path.exists(vhost_destination):
+        shutil.rmtree(vhost_destination)
+    shutil.copytree(os.path.join(TOPGEN_CUSTOM_VHOSTS, vhost_name), vhost_destination)
+    logger.debug(f"Copied custom vhost: {vhost_name}")
+
+def remove_vhost(vhost_name):
+    logger.debug(f"Cleaning up: Removing {vhost_name}")
+    shutil.rmtree(os.path.join(TOPGEN_VHOSTS, vhost_name), ignore_errors=True)
+
+def curate_vhost(vhost_base, vhosts):
+    """Handle the www.example.org/index.html issue: if example.org only has an index.html,
+    and www.example.org (one of vhosts) has none, copy it over"""
+    www_base = f"www.{vhost_base}"
+    if www_base not in vhosts:
+        return
+    vhost = os.path.join(TOPGEN_VHOSTS, vhost_base)
+    with os.scandir(vhost) as it:
+        entries = list(itertools.islice(it, 2))
+    if len(entries) != 1 or entries[0].name != "index.html" or not entries[0].is_file():
+        return
+    dst = os.path.join(TOPGEN_VHOSTS, www_base, "index.html")
+    if not os.path.isfile(dst):
+        src = os.path.join(vhost, "index.html")
+        shutil.copy2(src, dst)
+        logger.info(f"Curated: {src} -> {dst}")
+
+def generate_landing_page(vhosts):
+    """Generate the topgen.info landing page listing vhosts"""
+    os.makedirs(TOPGEN_SITE, exist_ok=True)
+    html_content = ''.join(f'      <li><a href="//{vhost}">{vhost}</a>\n'
+                           for vhost in sorted(vhosts) if not vhost.endswith('topgen.info'))
+    with open(os.path.join(TOPGEN_TEMPLATES, "topgen.info"), 'r') as template:
+        template_result = Template(template.read()).substitute(vhosts=html_content)
+    write_atomic(os.path.join(TOPGEN_SITE, "index.html"), template_result)
+    logger.debug(f"Generated landing page with {html_content.count(chr(10))} vhosts")
+
+async def postprocess_vhosts():
+    """Copy custom vhosts, remove junk vhosts, curate vhosts and generate the landing page.
+
+    TOPGEN_VHOSTS is scanned once, and the per-vhost work is spread across a thread pool.
+    """
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=TOPGEN_POSTPROCESS_WORKERS) as pool:
+        async def fan_out(desc, func, names, *args):
+            with manager.counter(total=len(names), desc=desc, bar_format=BAR_FMT) as pbar:
+                async def run(name):
+                    try:
+                        await loop.run_in_executor(pool, func, name, *args)
+                    except OSError as e:
+                        logger.error(f"{desc}: {name}: {str(e)}")
+                    pbar.update(1)
+                await asyncio.gather(*(run(name) for name in names))
+
+        def scan(path):
+            try:
+                with os.scandir(path) as it:
+                    return {entry.name for entry in it if entry.is_dir()}
+            except FileNotFoundError:
+                return set()
+
+        custom, vhosts = await asyncio.gather(loop.run_in_executor(pool, scan, TOPGEN_CUSTOM_VHOSTS),
+                                              loop.run_in_executor(pool, scan, TOPGEN_VHOSTS))
+        if not custom:
+            logger.debug("No custom vhosts found")
+        await fan_out('Handling Custom vHosts', copy_custom_vhost, sorted(custom))
+        vhosts |= custom
+
+        junk = sorted(v for v in vhosts if junk_vhost(v))
+        await fan_out('Cleaning vhosts', remove_vhost, junk)
+        vhosts.difference_update(junk)
+
+        await fan_out('Curating vhosts', curate_vhost, sorted(vhosts), frozenset(vhosts))
+
+        with manager.counter(total=1, desc='Generating topgen.info', bar_format=BAR_FMT) as pbar:
+            await loop.run_in_executor(pool, generate_landing_page, vhosts)
             pbar.update(1)
 
-async def generate_landing_page():
-    """Generate the topgen.info landing page"""
-    with manager.counter(total=1, desc='Generating topgen.info', bar_format=BAR_FMT) as pbar:
-        # Create topgen.info directory
-        os.makedirs(TOPGEN_SITE, exist_ok=True)
+async def dedup_vhosts():
+    """Replace duplicate files across all vhosts with links into the blob store"""
+    store = DedupStore(TOPGEN_BLOBS, TOPGEN_DEDUP)
+    with manager.counter(desc='Deduplicating vhosts', unit='inodes', bar_format=BAR_FMT,
+                         counter_format='{desc}:{desc_pad}{count:d} {unit} [Elapsed: {elapsed}]') as pbar:
+        loop = asyncio.get_running_loop()
+        linked, saved = await loop.run_in_executor(
+            None, lambda: store.deduplicate(TOPGEN_VHOSTS, progress=lambda: pbar.update(1)))
+    metrics.count('files_deduplicated', linked)
+    metrics.count('bytes_deduplicated', saved)
+    logger.info(f"Deduplicated {linked} files, saved {saved / 2**20:.1f} MiB")
 
-        # Get list of vhosts (excluding topgen.info itself)
-        vhosts = [os.path.basename(v) for v in glob.glob(f"{TOPGEN_VHOSTS}/*") 
-                if not v.endswith('topgen.info')]
-        html_content = ""
-        # Add vhost entries
-        for vhost in sorted(vhosts):
-            html_content += f'      <li><a href="//{vhost}">{vhost}</a>\n'
-        
-        # Write file from Template
-        index_path = os.path.join(TOPGEN_SITE, "index.html")
-        with open(index_path, 'w') as f:
-            with open (os.path.join(TOPGEN_TEMPLATES, "topgen.info"), 'r') as template:
-                template_source = Template(template.read())
-                template_result = template_source.substitute(vhosts=html_content)
-            f.write(template_result)
-        
-        logger.debug(f"Generated landing page with {len(vhosts)} vhosts")
-        pbar.update(1)
+def compressible_files(top):
+    """Yield paths of files under top that get compressed sidecars, judging by their extension"""
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            if name.lower().endswith(TOPGEN_COMPRESS_TYPES) and not name.startswith('.topgen.'):
+                yield os.path.join(dirpath, name)
+
+async def compress_vhosts():
+    """Write precompressed .gz (and .br) sidecars of text assets for nginx's gzip_static"""
+    brotli = TOPGEN_COMPRESS == 'brotli'
+    if brotli:
+        try:
+            import brotli as _  # noqa: F401
+        except ImportError:
+            raise RuntimeError("brotli compression requires the brotli python module")
+    loop = asyncio.get_running_loop()
+    paths = await loop.run_in_executor(None, lambda: list(compressible_files(TOPGEN_VHOSTS)))
+    try:
+        with open(TOPGEN_COMPRESS_SKIP) as f:
+            skip = json.load(f)
+    except (OSError, ValueError):
+        skip = {}
+    with manager.counter(total=len(paths), desc='Compressing vHost Assets', bar_format=BAR_FMT) as pbar:
+        with process_pool(TOPGEN_COMPRESS_WORKERS) as pool:
+            async def compress(batch):
+                batch_skip = {sidecar: skip[sidecar] for path in batch
+                              for sidecar in (path + '.gz', path + '.br') if sidecar in skip}
+                try:
+                    result = await loop.run_in_executor(pool, compress_batch, batch, brotli, batch_skip)
+                except Exception as e:
+                    logger.error(f'Failed compressing batch: {str(e)}')
+                    result = (0, 0, 0, batch_skip)
+                pbar.update(len(batch))
+                return result
+            results = await asyncio.gather(*(compress(batch) for batch in chunked(paths, TOPGEN_COMPRESS_BATCH)))
+    compressed, bytes_in, bytes_out = (sum(column) for column in zip((0, 0, 0), *(r[:3] for r in results)))
+    skip = {}
+    for result in results:
+        skip.update(result[3])
+    write_atomic(TOPGEN_COMPRESS_SKIP, json.dumps(skip, indent=1, sort_keys=True))
+    metrics.count('files_compressed', compressed)
+    metrics.count('sidecar_bytes', bytes_out)
+    logger.info(f"Compressed {compressed} of {len(paths)} text assets "
+                f"({bytes_in / 2**20:.1f} MiB to {bytes_out / 2**20:.1f} MiB of sidecars)")
 
 async def generate_CA():
     """Generate SSL certificates for TopGen"""
@@ -253,6 +2053,7 @@ async def generate_CA():
                 '-subj', '/C=US/ST=PA/L=Pgh/O=CMU/OU=CERT/CN=topgen_ca',
                 stderr=asyncio.subprocess.DEVNULL
             )
+            metrics.count('subprocesses', command='openssl')
             await proc.communicate()
 
         # Copy CA cert to topgen.info site
@@ -270,182 +2071,407 @@ async def generate_CA():
                 '2048',
                 stderr=asyncio.subprocess.DEVNULL
             )
+            metrics.count('subprocesses', command='openssl')
             await proc.communicate()
         
-        # Create temporary CA directory structure
-        logger.debug("Creating temporary CA directory")
-        tmp_ca_dir = tempfile.mkdtemp(prefix='TopGenCA.')
-        
-        # Create serial and index files
-        logger.debug("Creating serial file")
-        with open(os.path.join(tmp_ca_dir, "serial"), 'w') as f:
-            f.write("000a")
+        logger.debug("CA and vhost key ready")
+        pbar.update(1)
 
-        logger.debug("Creating index file")
-        with open(os.path.join(tmp_ca_dir, "index"), 'w') as f:
+async def generate_vhost_certificates(missing_only=False):
+    """Sign certificates for all vhosts (or only those without one) in parallel batches"""
+    vhosts = sorted(os.path.basename(v) for v in glob.glob(f"{TOPGEN_VHOSTS}/*"))
+    if TOPGEN_CERT_MODE == 'lazy':
+        os.makedirs(TOPGEN_LAZY_CERTS, exist_ok=True)
+        logger.info(f"Not signing certificates for {len(vhosts)} vhosts, topgen-certd.py issues them on demand")
+        return
+    certs = cert_groups(vhosts)
+    if TOPGEN_CERT_MODE != 'vhost':
+        os.makedirs(TOPGEN_SHARED_CERTS, exist_ok=True)
+        # Drop consolidated certificates for name sets no longer in use:
+        for stale in glob.glob(os.path.join(TOPGEN_SHARED_CERTS, "*.cer")):
+            if stale not in certs:
+                os.remove(stale)
+    if missing_only:
+        certs = {path: names for path, names in certs.items() if not os.path.exists(path)}
+    signer_args = (os.path.join(TOPGEN_VARETC, "topgen_ca.key"),
+                   os.path.join(TOPGEN_VARETC, "topgen_ca.cer"),
+                   os.path.join(TOPGEN_VARETC, "topgen_vh.key"))
 
-            pass  # Create empty index file
-    
-        # Write CA configuration
-        logger.debug("Creating CA configuration file")
-        ca_conf_path = os.path.join(tmp_ca_dir, "ca.conf")
-
-        # Create Dict of CA configuration values
-        logger.debug("Creating CA configuration dictionary")
-        ca_dict = {
-            'tmp_ca_dir': tmp_ca_dir,
-            'ca_cert': ca_cert,
-            'ca_key': ca_key
-        }
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    with manager.counter(total=len(certs), desc='Generate vHost Certificates', bar_format=BAR_FMT) as pbar:
+        with process_pool(TOPGEN_SIGN_WORKERS, initializer=signer_init, initargs=signer_args) as pool:
+            # Consolidated certificates carry many names each, so sign fewer of them per batch:
+            batch_size = max(1, TOPGEN_SIGN_BATCH // max(len(names) for names in certs.values())) if certs else 1
+            tasks = [loop.run_in_executor(pool, sign_batch, batch)
+                     for batch in chunked(sorted(certs.items()), batch_size)]
+            for task in asyncio.as_completed(tasks):
+                try:
+                    signed = await task
+                    pbar.update(signed)
+                    metrics.count('certs_signed', signed, stage='certs')
+                except Exception as e:
+                    logger.error(f'Failed signing certificate batch: {str(e)}')
+    metrics.count('cert_signing_seconds', time.monotonic() - started)
 
-        with open(ca_conf_path, 'w') as f:
-            with open (os.path.join(TOPGEN_TEMPLATES, "CertificateAuthority.conf"), 'r') as template:
-                template_source = Template(template.read())
-                template_result = template_source.substitute(ca_dict)
-            f.write(template_result)
-        
-        # Store tmp_ca_dir path for cleanup
-        global TMP_CA_DIR
-        TMP_CA_DIR = tmp_ca_dir
-        global CA_CONF_PATH
-        CA_CONF_PATH = ca_conf_path
-        
-        logger.debug(f"Certificate generation complete. Temporary CA dir: {tmp_ca_dir}")
+    logger.debug(f"Signed {len(certs)} certificates for {len(vhosts)} vhosts ({TOPGEN_CERT_MODE} mode)")
+
+async def generate_hosts_nginx(incremental=False):
+    """Resolve all vhosts and write them to hosts.nginx, sorted by name"""
+    vhosts = sorted(os.path.basename(v) for v in glob.glob(f"{TOPGEN_VHOSTS}/*"))
+    hosts = {}
+
+    # Keep addresses of vhosts already listed in hosts.nginx:
+    hosts_nginx = os.path.join(TOPGEN_VARETC, "hosts.nginx")
+    if incremental and os.path.exists(hosts_nginx):
+        with open(hosts_nginx) as f:
+            known = dict(reversed(line.split()) for line in f if len(line.split()) == 2)
+        hosts = {v: known[v] for v in vhosts if v in known}
+
+    nameservers = parse_nameservers(TOPGEN_RESOLVERS) if TOPGEN_RESOLVERS else \
+        [(ns, 53) for ns in system_nameservers()]
+    cache = ResolveCache(TOPGEN_RESOLVE_CACHE)
+    resolver = Resolver(nameservers, cache)
+
+    async def resolve(vhost_base):
+        vhost_ip = await resolver.resolve(vhost_base)
+        if vhost_ip is None:
+            vhost_ip = TOPGEN_FALLBACK_IP
+            logger.warning(f"[{vhost_base}] Unable to resolve IP address, using fallback IP {vhost_ip}")
+        hosts[vhost_base] = vhost_ip
         pbar.update(1)
 
-async def generate_vhost_certificates():
-    """Generate certificates and nginx configuration for all vhosts"""
-    global CA_CONF_PATH
+    unresolved = [v for v in vhosts if v not in hosts]
+    with manager.counter(total=len(unresolved), desc='Generating hosts.nginx', bar_format=BAR_FMT) as pbar:
+        try:
+            await asyncio.gather(*(resolve(v) for v in unresolved))
+        finally:
+            cache.close()
 
-    vhosts = list(glob.glob(f"{TOPGEN_VHOSTS}/*"))
-    # Get CSR configuration
-    vh_template = open(os.path.join(TOPGEN_TEMPLATES, "vHost_CSR.conf"), 'r')
+    write_atomic(hosts_nginx, ''.join(f"{hosts[v]} {v}\n" for v in vhosts))
+    logger.debug(f"Wrote {len(vhosts)} vhosts to hosts.nginx ({resolver.stats})")
 
-    with manager.counter(total=len(vhosts), desc='Generate vHost Certificates', bar_format=BAR_FMT) as pbar:
-        for vhost in vhosts:
-            logger.debug(f"[{vhost}] Generating Certificate")
-            vhost_base = os.path.basename(vhost)
-            cert_path = os.path.join(TOPGEN_CERTS, f"{vhost_base}.cer")
+def nginx_shard(vhost_base, shards):
+    """Return the shard include file index for a vhost (stable across runs)"""
+    return int(hashlib.sha1(vhost_base.encode()).hexdigest()[:8], 16) % shards
 
-            # Generate CSR configuration
-            template_source = Template(vh_template.read())
-            vh_conf = template_source.substitute(vhost_base=vhost_base)
-        
-            # Generate certificate
-            proc = await asyncio.create_subprocess_exec(
-                'openssl', 'ca', '-batch', '-notext',
-                '-config', CA_CONF_PATH,
-                '-out', cert_path,
-                '-in', '-',
-                stdin=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.DEVNULL
-            )
+async def generate_nginx_conf(shards=TOPGEN_NGINX_SHARDS):
+    """Write nginx.conf and its vhost shard include files, rewriting only shards that changed"""
+    vhosts = sorted(glob.glob(f"{TOPGEN_VHOSTS}/*"))
+    nginx_conf = os.path.join(TOPGEN_VARETC, "nginx.conf")
+    manifest_path = os.path.join(TOPGEN_NGINX_SHARDS_DIR, "manifest.json")
+    os.makedirs(TOPGEN_NGINX_SHARDS_DIR, exist_ok=True)
 
-            # Generate CSR and pipe to CA
-            csr_cmd = [
-                'openssl', 'req', '-new',
-                '-key', os.path.join(TOPGEN_VARETC, "topgen_vh.key"),
-                '-subj', '/C=US/ST=PA/L=Pgh/O=CMU/OU=CERT/CN=topgen_vh',
-                '-addext', f'subjectAltName = DNS:{vhost_base}'
-            ]
-            logger.debug(f"[{vhost}] Sending Certificate Signing Request")
-            csr_proc = await asyncio.create_subprocess_exec(
-                *csr_cmd,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.DEVNULL
-            )
-                
-            csr, _ = await csr_proc.communicate(vh_conf.encode())
-            await proc.communicate(csr)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    # One server block per vhost, or (with consolidated certificates) one per certificate,
+    # serving all the names it covers from their respective vhost directories, or (with
+    # on-demand certificates) one per shard, loading certificates named after the SNI name:
+    template_name = {'vhost': "nginx.conf_vhost", 'lazy': "nginx.conf_lazy"}.get(TOPGEN_CERT_MODE, "nginx.conf_group")
+    with open(os.path.join(TOPGEN_TEMPLATES, template_name), 'r') as template:
+        vhost_template = template.read()
+    template_source = Template(vhost_template)
+
+    # Group server blocks by shard:
+    entries = [[] for _ in range(shards)]
+    vhost_names = [os.path.basename(v) for v in vhosts]
+    if TOPGEN_CERT_MODE == 'lazy':
+        names_by_shard = defaultdict(list)
+        for vhost_base in sorted(vhost_names):
+            names_by_shard[nginx_shard(vhost_base, shards)].append(vhost_base)
+        for shard, names in names_by_shard.items():
+            entries[shard].append({'server_names': ' '.join(names), 'TOPGEN_VHOSTS': TOPGEN_VHOSTS,
+                                   'cert_path': os.path.join(TOPGEN_LAZY_CERTS, "$topgen_lazy_cert.cer"),
+                                   'backend': TOPGEN_LAZY_BACKEND})
+    else:
+        for cert_path, names in cert_groups(vhost_names).items():
+            if TOPGEN_CERT_MODE == 'vhost':
+                params = {'vhost_base': names[0], 'vhost': os.path.join(TOPGEN_VHOSTS, names[0]), 'cert_path': cert_path}
+                shard = nginx_shard(names[0], shards)
+            else:
+                params = {'server_names': ' '.join(names), 'TOPGEN_VHOSTS': TOPGEN_VHOSTS, 'cert_path': cert_path}
+                # by group, not by certificate name: the block stays put when the group's names change
+                shard = nginx_shard(os.path.basename(cert_path).rsplit('-', 1)[0], shards)
+            entries[shard].append(params)
+    for shard_entries in entries:
+        shard_entries.sort(key=lambda params: params['cert_path'])
+
+    shard_paths = [os.path.join(TOPGEN_NGINX_SHARDS_DIR, f"vhosts-{i:03d}.conf") for i in range(shards)]
+    new_manifest = {}
+    written = 0
+    with manager.counter(total=shards, desc='Generating nginx.conf', unit='shards', bar_format=BAR_FMT) as pbar:
+        for shard, shard_path in enumerate(shard_paths):
+            # The digest covers everything a shard's content depends on:
+            digest = hashlib.sha256(vhost_template.encode())
+            for params in entries[shard]:
+                digest.update('\0'.join(f"{k}={v}" for k, v in sorted(params.items())).encode() + b'\n')
+            digest = digest.hexdigest()
+            new_manifest[os.path.basename(shard_path)] = digest
 
+            if manifest.get(os.path.basename(shard_path)) != digest or not os.path.exists(shard_path):
+                blocks = [template_source.substitute(params) for params in entries[shard]]
+                write_atomic(shard_path, ''.join(blocks))
+                written += 1
+                logger.debug(f"Wrote {len(blocks)} vhost blocks to {shard_path}")
             pbar.update(1)
-            logger.debug(f"[{vhost}] Wrote certificate to {cert_path}")
 
-async def generate_hosts_nginx():
-    vhosts = list(glob.glob(f"{TOPGEN_VHOSTS}/*"))
-    tasks = []
+    # Remove shards left over from a run with more shards:
+    for stale in glob.glob(os.path.join(TOPGEN_NGINX_SHARDS_DIR, "vhosts-*.conf")):
+        if stale not in shard_paths:
+            os.remove(stale)
+
+    with open(os.path.join(TOPGEN_TEMPLATES, "nginx.conf_base"), 'r') as template:
+        template_source = Template(template.read())
+        base = template_source.substitute(TOPGEN_VARETC=TOPGEN_VARETC)
+    includes = ''.join(f"include {shard_path};\n" for shard_path in shard_paths)
+    files = {}
+    if TOPGEN_CERT_MODE != 'vhost':
+        # server blocks serving several vhosts find their directory by the Host header, which may
+        # name anything; $topgen_vhost is empty (and the connection closed) unless it's a vhost:
+        vhosts_map = os.path.join(TOPGEN_NGINX_SHARDS_DIR, "vhosts.map")
+        files[vhosts_map] = ''.join(f"{name} {name};\n" for name in sorted(vhost_names))
+        includes = f"map $host $topgen_vhost {{\n\tdefault \"\";\n\tinclude {vhosts_map};\n}}\n\n{includes}"
+    stream = "# nothing to serve from the top level of nginx.conf unless topgen-scrape.py --cert-mode lazy\n"
+    if TOPGEN_CERT_MODE == 'lazy':
+        # names topgen-certd.py issued a certificate for map to that certificate whatever their spelling,
+        # names issued since nginx was last reloaded map to the symlinks topgen-certd.py adds for them:
+        includes = (f"map $ssl_server_name $topgen_lazy_cert {{\n\thostnames;\n\tdefault $ssl_server_name;\n"
+                    f"\tinclude {TOPGEN_LAZY_MAP};\n}}\n\n{includes}")
+        if TOPGEN_LAZY_CACHE:
+            # parsed certificates are kept across handshakes, certificate files are checked once a minute:
+            includes = f"ssl_certificate_cache max={TOPGEN_LAZY_CACHE} inactive=1h;\n{includes}"
+        with open(os.path.join(TOPGEN_TEMPLATES, "nginx.conf_stream"), 'r') as template:
+            stream = Template(template.read()).substitute(TOPGEN_LAZY_MAP=TOPGEN_LAZY_MAP, certd=TOPGEN_LAZY_CERTD,
+                                                          backend=TOPGEN_LAZY_BACKEND)
+        # topgen-certd.py maintains the map, nginx only needs it to exist:
+        if not os.path.exists(TOPGEN_LAZY_MAP):
+            write_atomic(TOPGEN_LAZY_MAP, '')
+    files[TOPGEN_NGINX_STREAM] = stream
+    files[nginx_conf] = f"{base}\n\n{includes}"
+    for path, content in files.items():
+        try:
+            with open(path) as f:
+                unchanged = f.read() == content
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            write_atomic(path, content)
 
-    # Create task list
-    for vhost in vhosts:
-        task = asyncio.create_task(generate_vhost_hosts_nginx(vhost))
-        tasks.append(task)
+    write_atomic(manifest_path, json.dumps(new_manifest, indent=1, sort_keys=True))
+    logger.debug(f"Finished nginx.conf for {len(vhosts)} vhosts, rewrote {written} of {shards} shards")
 
-    # Create progress bar
-    pbar = manager.counter(total=len(tasks), desc='Generating hosts.nginx', autorefresh=True, bar_format=BAR_FMT)
-    await asyncio.sleep(0.1)  # Wait for progress bar to initialize
+# Stage pipeline
 
-    # Run progress updater and tasks
-    update_task = asyncio.create_task(update_progress(tasks, pbar))
-    await asyncio.gather(*tasks)
-    await update_task
+class VhostFeed:
+    """Publish vhost directories to subscribed stages as soon as the scrape creates them"""
+    def __init__(self):
+        self.known = set()
+        self.queues = []
 
-    # Final update and close
-    pbar.count = len(tasks)
-    pbar.close()
+    def subscribe(self):
+        queue = asyncio.Queue()
+        self.queues.append(queue)
+        return queue
+
+    def discover(self):
+        """Publish vhosts created since the last call"""
+        try:
+            names = {e.name for e in os.scandir(TOPGEN_VHOSTS) if e.is_dir() and not junk_vhost(e.name)}
+        except OSError:
+            return
+        new = sorted(names - self.known)
+        self.known.update(new)
+        for queue in self.queues:
+            for name in new:
+                queue.put_nowait(name)
+
+    def close(self):
+        """Tell subscribers the feed has ended (None)"""
+        for queue in self.queues:
+            queue.put_nowait(None)
 
-async def generate_vhost_hosts_nginx(vhost):
-    vhost_base = os.path.basename(vhost)
+async def drain(queue, limit):
+    """Wait for the next batch of up to limit names from a VhostFeed queue ([] once the feed ends)"""
+    name = await queue.get()
+    batch = []
+    while name is not None:
+        batch.append(name)
+        if len(batch) >= limit or queue.empty():
+            return batch
+        name = queue.get_nowait()
+    queue.put_nowait(None)
+    return batch
 
-    # Resolve IP address
+async def presign_certificates(queue, ca_ready):
+    """Sign certificates for vhosts as the scrape creates them (per-vhost certificate mode only)"""
+    await ca_ready.wait()
+    signer_args = (os.path.join(TOPGEN_VARETC, "topgen_ca.key"),
+                   os.path.join(TOPGEN_VARETC, "topgen_ca.cer"),
+                   os.path.join(TOPGEN_VARETC, "topgen_vh.key"))
+    loop = asyncio.get_running_loop()
+    tasks = []
+    with process_pool(TOPGEN_SIGN_WORKERS, initializer=signer_init, initargs=signer_args) as pool:
+        while batch := await drain(queue, TOPGEN_SIGN_BATCH):
+            tasks.append(loop.run_in_executor(pool, sign_batch, sorted(cert_groups(batch).items())))
+        signed = sum(n for n in await asyncio.gather(*tasks, return_exceptions=True) if isinstance(n, int))
+    metrics.count('certs_signed', signed, stage='presign')
+    logger.debug(f"Pre-signed {signed} certificates during scrape")
+
+async def preresolve_vhosts(queue):
+    """Resolve vhosts as the scrape creates them, warming the resolve cache for hosts.nginx"""
+    nameservers = parse_nameservers(TOPGEN_RESOLVERS) if TOPGEN_RESOLVERS else \
+        [(ns, 53) for ns in system_nameservers()]
+    cache = ResolveCache(TOPGEN_RESOLVE_CACHE)
+    resolver = Resolver(nameservers, cache)
+    tasks = []
     try:
-        # Using socket to resolve hostname
-        logger.debug(f"[{vhost}] Gathering IP Address from external DNS")
-        vhost_ip = socket.gethostbyname(vhost_base)
-    except socket.gaierror:
-        # Use fallback IP for unresolvable hosts
-        vhost_ip = "1.0.0.0"
-        logger.warning(f"[{vhost}] Unable to resolve IP address, using fallback IP {vhost_ip}")
-
-    # Append to hosts.nginx file
-    with open(os.path.join(TOPGEN_VARETC, "hosts.nginx"), 'a') as f:
-        f.write(f"{vhost_ip} {vhost_base}\n")
-    logger.debug(f"[{vhost}] Wrote {vhost_ip} {vhost_base} to hosts.nginx")
-
-async def generate_nginx_conf():
-    vhosts = list(glob.glob(f"{TOPGEN_VHOSTS}/*"))
-
-    # Remove old nginx.conf if exists
-    nginx_conf = os.path.join(TOPGEN_VARETC, "nginx.conf")
-    if os.path.exists(nginx_conf):
-        os.remove(nginx_conf)
-    
-    with manager.counter(total=len(vhosts), desc='Generating nginx.conf', bar_format=BAR_FMT) as pbar:
-        # Generate base nginx.conf
+        while batch := await drain(queue, TOPGEN_RESOLVE_CONCURRENCY):
+            tasks.extend(asyncio.create_task(resolver.resolve(name)) for name in batch)
+        await asyncio.gather(*tasks)
+    finally:
+        cache.close()
+    logger.debug(f"Pre-resolved vhosts during scrape ({resolver.stats})")
+
+class StageRunner:
+    """Run pipeline stages concurrently, each as soon as the stages it depends on are done.
+
+    Dependencies on stages that were not selected for this run are considered satisfied.
+    """
+    def __init__(self, status):
+        self.status = status
+        self.stages = {}
+        self.done = defaultdict(asyncio.Event)
+        self.running = []
+        self.tasks = []
+
+    def add(self, name, func, deps=()):
+        self.stages[name] = (func, deps)
+
+    def background(self, coro):
+        """Start coro alongside the stages, to be awaited by one of them (cancelled if the run fails first)"""
+        task = asyncio.create_task(coro)
+        self.tasks.append(task)
+        return task
+
+    async def run_stage(self, name, selected):
+        func, deps = self.stages[name]
+        for dep in deps:
+            if dep in selected:
+                await self.done[dep].wait()
+        self.running.append(name)
+        self.status.update(stage=f"Running: {', '.join(self.running)}")
+        started = time.monotonic()
+        metrics.stage_started(name)
+        ok = False
         try:
-            with open(os.path.join(TOPGEN_VARETC, "nginx.conf"), 'w') as f:
-                with open (os.path.join(TOPGEN_TEMPLATES, "nginx.conf_base"), 'r') as template:
-                    template_source = Template(template.read())
-                    template_result = template_source.substitute(TOPGEN_VARETC=TOPGEN_VARETC)
-                f.write(template_result)
-                f.flush()
-                logger.debug("Writing base for nginx.conf")
-        except Exception as e:
-            logger.error(f'Failed writing base for nginx.conf: {str(e)}')
+            await func()
+            ok = True
+        finally:
+            self.running.remove(name)
+            self.status.update(stage=f"Running: {', '.join(self.running)}" if self.running else "Finished")
+            metrics.stage_finished(name, ok)
+            self.done[name].set()
+        logger.info(f"Stage {name} finished ({format_elapsed_time(time.monotonic() - started)})")
 
-        # Get nginx block template
+    async def run(self, selected):
+        for name in self.stages:
+            if name not in selected:
+                self.done[name].set()
+        stages = [asyncio.create_task(self.run_stage(name, selected)) for name in self.stages if name in selected]
         try:
-            with open(os.path.join(TOPGEN_TEMPLATES, "nginx.conf_vhost"), 'r') as template:
-                template_source = Template(template.read())
-                for vhost in vhosts:
-                    vhost_base = os.path.basename(vhost)
-                    cert_path = os.path.join(TOPGEN_CERTS, f"{vhost_base}.cer")
-                    # Append to nginx.conf file
-                    with open(os.path.join(TOPGEN_VARETC, "nginx.conf"), 'a') as f:
-                        nginx_block = template_source.substitute(cert_path=cert_path, vhost_base=vhost_base, vhost=vhost)
-                        f.write(nginx_block)
-                        logger.debug(f"[{vhost_base}] Wrote vhost block to nginx.conf")
-                    pbar.update(1)
-        except Exception as e:
-            logger.error(f'[{vhost_base}] Failed writing vhost for nginx.conf: {str(e)}')
+            await asyncio.gather(*stages)
+        finally:
+            # a failed stage leaves the other stages and the background tasks running; stop them
+            # (a presign/preresolve fed by a failed scrape would otherwise wait for vhosts forever):
+            for task in stages + self.tasks:
+                task.cancel()
+            await asyncio.gather(*stages, *self.tasks, return_exceptions=True)
+
+def set_target_dir(varlib):
+    """Point TOPGEN_VARLIB and every path derived from it at varlib (see --target-dir)"""
+    global TOPGEN_VARLIB
+    global TOPGEN_VHOSTS
+    global TOPGEN_VARETC
+    global TOPGEN_CERTS
+    global TOPGEN_SITE
+    global TOPGEN_JOURNAL
+    global TOPGEN_BLOBS
+    global TOPGEN_RESOLVE_CACHE
+    global TOPGEN_NGINX_SHARDS_DIR
+    global TOPGEN_SHARED_CERTS
+    global TOPGEN_LAZY_CERTS
+    global TOPGEN_LAZY_MAP
+    global TOPGEN_NGINX_STREAM
+    global TOPGEN_SCRAPE_REPORT
+    global TOPGEN_COMPRESS_SKIP
 
-        logger.debug(f"Finished writing nginx.conf for {len(vhosts)} vhosts")
+    TOPGEN_VARLIB = os.path.realpath(varlib)
+    TOPGEN_VHOSTS = os.path.join(TOPGEN_VARLIB, "vhosts")
+    TOPGEN_VARETC = os.path.join(TOPGEN_VARLIB, "etc")
+    TOPGEN_CERTS = os.path.join(TOPGEN_VARLIB, "certs")
+    TOPGEN_SITE = os.path.join(TOPGEN_VHOSTS, "topgen.info")
+    TOPGEN_JOURNAL = os.path.join(TOPGEN_VARETC, "scrape.journal")
+    TOPGEN_BLOBS = os.path.join(TOPGEN_VARLIB, "blobs")
+    TOPGEN_RESOLVE_CACHE = os.path.join(TOPGEN_VARETC, "resolve.cache")
+    TOPGEN_NGINX_SHARDS_DIR = os.path.join(TOPGEN_VARETC, "nginx.d")
+    TOPGEN_SHARED_CERTS = os.path.join(TOPGEN_CERTS, "shared")
+    TOPGEN_LAZY_CERTS = os.path.join(TOPGEN_CERTS, "lazy")
+    TOPGEN_LAZY_MAP = os.path.join(TOPGEN_VARETC, "lazy_certs.map")
+    TOPGEN_NGINX_STREAM = os.path.join(TOPGEN_VARETC, "nginx-stream.conf")
+    TOPGEN_SCRAPE_REPORT = os.path.join(TOPGEN_VARETC, "scrape.report.json")
+    TOPGEN_COMPRESS_SKIP = os.path.join(TOPGEN_VARETC, "compress.skip.json")
+
+    # Ensure directories exist
+    os.makedirs(TOPGEN_VHOSTS, exist_ok=True)
+    os.makedirs(TOPGEN_CERTS, exist_ok=True)
+    os.makedirs(TOPGEN_VARETC, exist_ok=True)
+
+# Pipeline stages, in the order the full pipeline lists them
+STAGES = ['scrape', 'postprocess', 'dedup', 'compress', 'ca', 'certs', 'hosts', 'nginx']
 
 async def main():
     global TOPGEN_ORIG
-    global TOPGEN_VARLIB
+    global TOPGEN_SCRAPE_WORKERS
+    global TOPGEN_SCRAPE_PER_DOMAIN
+    global TOPGEN_SCRAPE_RETRIES
+    global TOPGEN_SCRAPE_ORDER
+    global TOPGEN_SCRAPE_ENGINE
+    global TOPGEN_DEDUP
+    global TOPGEN_RESOLVERS
+    global TOPGEN_RESOLVE_MIN_TTL
+    global TOPGEN_NGINX_SHARDS
+    global TOPGEN_CERT_MODE
+    global TOPGEN_CERT_BUCKET
+    global TOPGEN_LAZY_CACHE
+    global TOPGEN_BUDGET_BYTES
+    global TOPGEN_BUDGET_FILES
+    global TOPGEN_BUDGET_TIME
+    global TOPGEN_BUDGET_ALLOW
+    global TOPGEN_BUDGET_DENY
+    global TOPGEN_COMPRESS
+    global TOPGEN_METRICS
+    global TOPGEN_METRICS_INTERVAL
+    global TOPGEN_PROFILE
 
     parser = argparse.ArgumentParser(description="Recursively scrape, clean, curate a given list of Web sites. Additionally, issue certificates signed with a self-signed TopGen CA (which is in turn also generated, if necessary). Generate a drop-in config file for the nginx HTTP server, and a hosts file containing <ip_addr fqdn> entries for each scraped vhost.", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("stages", nargs="*", metavar="stage", help="""pipeline stages to run (default: all of them, subject to --environment):
+  scrape       download the sites listed in --sites into vhosts
+  postprocess  copy custom vhosts over scraped content, remove IP-only vhosts and vhosts with
+               port numbers, fix up example.org vs. www.example.org index.html issues, and
+               generate the topgen.info landing page
+  dedup        deduplicate vhost files (requires --dedup)
+  compress     write precompressed sidecars of text assets (gzip, unless --compress brotli)
+  ca           generate the TopGen CA and the vhost key, if necessary
+  certs        issue vhost certificates
+  hosts        resolve vhost IP addresses into hosts.nginx
+  nginx        generate nginx.conf
+  all          the full pipeline
+stages run as soon as the stages they depend on are done, independent ones concurrently;
+when scraping, certificates and vhost addresses are worked on as vhosts are created""")
     parser.add_argument("-s", "--sites", help=f"file containing space or newline separated sites to be scraped for static content; lines beginning with '#' are ignored;\n(default: {TOPGEN_ORIG})", default=TOPGEN_ORIG)
     parser.add_argument("-t", "--target-dir", help=f"directory where all results (scraped content, list of vhosts, certificates, configuration files, etc. are stored;\n(default: {TOPGEN_VARLIB})", default=TOPGEN_VARLIB)
     # Set Environment to either 'Development' or 'Production'
@@ -453,54 +2479,150 @@ async def main():
     parser.add_argument("-e", "--environment", help="environment in which to run the script; 'Development' will overwrite all files, 'Production' will only write files that do not exist;\\n(default: Production)", default="Production")
     parser.add_argument("-d", "--skip-scrape", help="Skip the scraping of websites, for if you want to quickly add new vhosts.", action='store_false')
     parser.add_argument("-n", "--skip-hosts", help="Skip generating of the hosts.nginx file", action='store_false')
+    parser.add_argument("-r", "--resume", help=f"resume an interrupted scrape: only sites not completed according to the scrape journal are scraped,\nand only vhosts lacking a certificate or hosts.nginx entry are processed;\n(journal: {TOPGEN_JOURNAL})", action='store_true')
+    parser.add_argument("--engine", help=f"scrape engine: 'wget' runs one wget process per site, 'native' uses a built-in crawler\nsharing pooled keep-alive connections and downloads across all sites;\n(default: {TOPGEN_SCRAPE_ENGINE})", choices=["wget", "native"], default=TOPGEN_SCRAPE_ENGINE)
+    parser.add_argument("--dedup", help=f"replace identical files across vhosts with hardlinks to (or reflink copies of) a single copy\nkept in a content-addressed blob store; with the native engine, files are deduplicated as they are scraped;\nas wget rewrites files in place, hardlinked files are copied before wget scrapes the tree again\n(and linked up again by the dedup stage), which 'reflink' avoids;\n(blob store: {TOPGEN_BLOBS})", choices=["hardlink", "reflink"], default=TOPGEN_DEDUP)
+    parser.add_argument("--resolvers", help="comma separated list of upstream DNS resolvers (ip[:port]) used to look up vhost addresses;\n(default: nameservers from /etc/resolv.conf)", default=TOPGEN_RESOLVERS)
+    parser.add_argument("--resolve-min-ttl", help=f"seconds vhost addresses stay cached at least, even if their DNS records' TTL is shorter;\n(default: {TOPGEN_RESOLVE_MIN_TTL})", type=int, default=TOPGEN_RESOLVE_MIN_TTL)
+    parser.add_argument("--nginx-shards", help=f"number of include files nginx vhost server blocks are spread across;\n(default: {TOPGEN_NGINX_SHARDS})", type=int, default=TOPGEN_NGINX_SHARDS)
+    parser.add_argument("--cert-mode", help=f"'vhost' issues one certificate (and nginx server block) per vhost; 'domain' and 'bucket' issue\nmulti-SAN certificates shared by the vhosts of a registered domain, or of a hash bucket, with\none nginx server block per certificate, which cuts nginx memory use and reload time; 'lazy' issues no\ncertificates up front, topgen-certd.py signs them as vhosts are first visited over HTTPS;\n(default: {TOPGEN_CERT_MODE})", choices=["vhost", "domain", "bucket", "lazy"], default=TOPGEN_CERT_MODE)
+    parser.add_argument("--cert-bucket-size", help=f"maximum number of vhosts covered by a consolidated certificate;\n(default: {TOPGEN_CERT_BUCKET})", type=int, default=TOPGEN_CERT_BUCKET)
+    parser.add_argument("--lazy-cache", help=f"with --cert-mode lazy, number of certificates nginx keeps in memory (ssl_certificate_cache,\nnginx 1.27.4 or later; 0 for older nginx);\n(default: {TOPGEN_LAZY_CACHE})", type=int, default=TOPGEN_LAZY_CACHE)
+    parser.add_argument("-w", "--workers", help=f"maximum number of sites scraped concurrently;\n(default: {TOPGEN_SCRAPE_WORKERS})", type=int, default=TOPGEN_SCRAPE_WORKERS)
+    parser.add_argument("--per-domain", help=f"maximum number of sites of the same registered domain scraped concurrently;\n(default: {TOPGEN_SCRAPE_PER_DOMAIN})", type=int, default=TOPGEN_SCRAPE_PER_DOMAIN)
+    parser.add_argument("--scrape-order", help=f"order in which sites are started, by the time (then size) their last scrape took: 'fastest'\nfinishes small and fast sites first, 'slowest' starts the longest scrapes first so a run doesn't\nend waiting for a few stragglers; sites never scraped before go first, shallow ones first;\n(default: {TOPGEN_SCRAPE_ORDER})", choices=["fastest", "slowest"], default=TOPGEN_SCRAPE_ORDER)
+    parser.add_argument("--retries", help=f"number of times a site failing with a network error (or whose scrape could not be run) is requeued;\n(default: {TOPGEN_SCRAPE_RETRIES})", type=int, default=TOPGEN_SCRAPE_RETRIES)
+    parser.add_argument("--max-bytes", help="maximum number of bytes downloaded per site (K, M, G and T suffixes allowed);\n(default: unlimited)", type=parse_size, default=TOPGEN_BUDGET_BYTES)
+    parser.add_argument("--max-files", help="maximum number of files downloaded per site;\n(default: unlimited)", type=int, default=TOPGEN_BUDGET_FILES)
+    parser.add_argument("--max-time", help="maximum time spent scraping a site, in seconds (m, h and d suffixes allowed);\n(default: unlimited)", type=parse_duration, default=TOPGEN_BUDGET_TIME)
+    parser.add_argument("--allow", help="comma separated MIME types (e.g. 'text/*') and extensions (e.g. '.pdf'); only matching files are kept;\n(default: all)", type=parse_patterns, default=TOPGEN_BUDGET_ALLOW)
+    parser.add_argument("--deny", help="comma separated MIME types (e.g. 'video/*') and extensions (e.g. '.iso') not to download;\nthese and the --max-* limits may be overridden per site in the sites file (e.g. 'bytes=1G deny=.iso');\nsites cut short are listed in scrape.report.json\n(default: none)", type=parse_patterns, default=TOPGEN_BUDGET_DENY)
+    parser.add_argument("--compress", help=f"write precompressed .gz ('gzip') or .gz and .br ('brotli') sidecars of text assets\nof at least {TOPGEN_COMPRESS_MIN_SIZE} bytes, served by nginx with gzip_static (and brotli_static);\nfiles unchanged since their sidecars were written are skipped\n(default: no sidecars)", choices=["gzip", "brotli"], default=TOPGEN_COMPRESS)
+    parser.add_argument("--log-level", help=f"minimum severity of messages logged; 'DEBUG' includes every line of wget output;\n(default: {TOPGEN_LOG_LEVEL})", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default=TOPGEN_LOG_LEVEL)
+    parser.add_argument("--metrics", help="file to write run metrics to (per-stage and per-site durations, bytes, files, subprocesses,\nDNS query latencies, certificate signing rate), periodically and when the run ends; written\nin the Prometheus text format if the file name ends in .prom, as JSON otherwise;\n(default: no metrics)", default=TOPGEN_METRICS)
+    parser.add_argument("--metrics-interval", help=f"seconds between metrics file updates;\n(default: {TOPGEN_METRICS_INTERVAL})", type=float, default=TOPGEN_METRICS_INTERVAL)
+    parser.add_argument("--profile", help="file to dump cProfile statistics of the main process to when the run ends (view with e.g.\n'python -m pstats'); signing, compression and dedup worker processes are not covered,\nuse a sampling profiler such as 'py-spy record --subprocesses' for those;\n(default: no profiling)", default=TOPGEN_PROFILE)
     args = parser.parse_args()
+    stages = [] if args.stages == ['all'] else args.stages
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f"invalid stage: '{stage}' (choose from {', '.join(STAGES)}, all)")
     TOPGEN_ORIG = args.sites
-    TOPGEN_VARLIB = args.target_dir
+    TOPGEN_SCRAPE_WORKERS = max(1, args.workers)
+    TOPGEN_SCRAPE_PER_DOMAIN = max(1, args.per_domain)
+    TOPGEN_SCRAPE_RETRIES = max(0, args.retries)
+    TOPGEN_SCRAPE_ORDER = args.scrape_order
+    TOPGEN_SCRAPE_ENGINE = args.engine
+    TOPGEN_DEDUP = args.dedup
+    TOPGEN_RESOLVERS = args.resolvers
+    TOPGEN_RESOLVE_MIN_TTL = max(0, args.resolve_min_ttl)
+    TOPGEN_NGINX_SHARDS = max(1, args.nginx_shards)
+    TOPGEN_CERT_MODE = args.cert_mode
+    TOPGEN_CERT_BUCKET = max(1, args.cert_bucket_size)
+    TOPGEN_LAZY_CACHE = max(0, args.lazy_cache)
+    TOPGEN_BUDGET_BYTES = args.max_bytes
+    TOPGEN_BUDGET_FILES = args.max_files
+    TOPGEN_BUDGET_TIME = args.max_time
+    TOPGEN_BUDGET_ALLOW = args.allow
+    TOPGEN_BUDGET_DENY = args.deny
+    TOPGEN_COMPRESS = args.compress
+    TOPGEN_METRICS = args.metrics
+    TOPGEN_METRICS_INTERVAL = max(1, args.metrics_interval)
+    TOPGEN_PROFILE = args.profile
+    setup_process(args.log_level)
+    set_target_dir(args.target_dir)
     ENVIRONMENT = args.environment
+    RESUME = args.resume
 
     status = manager.status_bar(status_format=u'Topgen-Scrape - {ENVIRONMENT}{fill}{stage}{fill}{elapsed}',
         color='bold_underline_bright_white_on_lightslategray',
         justify=enlighten.Justify.CENTER, autorefresh=True, min_delta=0.5, stage='Initializing', ENVIRONMENT=ENVIRONMENT)
-    
-    if ENVIRONMENT == "Development" or ENVIRONMENT == "Production" and len(os.listdir(TOPGEN_VHOSTS)) == 0:
-        status.update(stage="Creating vHosts")
-        if args.skip_scrape:
-            await download_websites()
-        else:
-            manager.counter(desc='Skipped Scraping Sites').close()
-        await handle_custom_vhosts()
-        await cleanup_vhosts()
-        await curate_vhosts()
-        await generate_landing_page()
-    else:
-        logger.debug("Skipping vHost creation")
 
-    if ENVIRONMENT == "Development" or ENVIRONMENT == "Production" and len(os.listdir(TOPGEN_CERTS)) == 0:
-        status.update(stage="Generating Certificates")
-        await generate_CA()
-        await generate_vhost_certificates()
+    if stages:
+        selected = set(stages)
     else:
-        logger.debug("Skipping certificate generation")
-    
-    if ENVIRONMENT == "Development" or ENVIRONMENT == "Production" and not os.path.exists(os.path.join(TOPGEN_ETC, "hosts.nginx")) and os.path.exists(os.path.join(TOPGEN_ETC, "nginx.conf")):
-        status.update(stage="Generating Nginx config files")
-        if ENVIRONMENT == "Development" or ENVIRONMENT == "Production" and not len(os.path.exists(os.path.join(TOPGEN_ETC, "hosts.nginx"))):
-            if args.skip_hosts:
-                await generate_hosts_nginx()
-            else:
-                manager.counter(desc='Skipped generating hosts.nginx').close()
+        # Development overwrites everything, Production only generates what is missing:
+        regenerate = RESUME or ENVIRONMENT == "Development"
+        selected = set()
+        if regenerate or len(os.listdir(TOPGEN_VHOSTS)) == 0:
+            selected.update(['scrape', 'postprocess'])
+            if TOPGEN_DEDUP:
+                selected.add('dedup')
+        else:
+            logger.debug("Skipping vHost creation")
+        # sidecars of files that haven't changed are skipped, so this is cheap to repeat:
+        if TOPGEN_COMPRESS:
+            selected.add('compress')
+        if regenerate or len(os.listdir(TOPGEN_CERTS)) == 0:
+            selected.update(['ca', 'certs'])
+        else:
+            logger.debug("Skipping certificate generation")
+        if regenerate or not os.path.exists(os.path.join(TOPGEN_VARETC, "hosts.nginx")):
+            selected.add('hosts')
         else:
             logger.debug("Skipping hosts.nginx generation")
-        if ENVIRONMENT == "Development" or ENVIRONMENT == "Production" and not os.path.exists(os.path.join(TOPGEN_ETC, "nginx.conf")):
-            await generate_nginx_conf()
-        else: 
+        if regenerate or not os.path.exists(os.path.join(TOPGEN_VARETC, "nginx.conf")):
+            selected.add('nginx')
+        else:
             logger.debug("Skipping nginx.conf generation")
-    else:
-        logger.debug("Skipping Nginx config generation")
-    
+        if not args.skip_scrape:
+            selected.discard('scrape')
+            manager.counter(desc='Skipped Scraping Sites').close()
+        if not args.skip_hosts:
+            selected.discard('hosts')
+            manager.counter(desc='Skipped generating hosts.nginx').close()
+    if 'dedup' in selected and not TOPGEN_DEDUP:
+        parser.error("the dedup stage requires --dedup")
+    if 'compress' in selected and not TOPGEN_COMPRESS:
+        TOPGEN_COMPRESS = 'gzip'
+
+    runner = StageRunner(status)
+    # While scraping, sign certificates and resolve addresses of new vhosts right away;
+    # the certs and hosts stages then only need to catch up on whatever is left:
+    feed = VhostFeed() if 'scrape' in selected else None
+    presign = preresolve = None
+    if feed and 'certs' in selected and TOPGEN_CERT_MODE == 'vhost':
+        presign = runner.background(presign_certificates(feed.subscribe(), runner.done["ca"]))
+    if feed and 'hosts' in selected:
+        preresolve = runner.background(preresolve_vhosts(feed.subscribe()))
+
+    async def certs():
+        if presign:
+            await presign
+        await generate_vhost_certificates(missing_only=RESUME or presign is not None)
+
+    async def hosts():
+        if preresolve:
+            await preresolve
+        await generate_hosts_nginx(incremental=RESUME)
+
+    runner.add('scrape', lambda: download_websites(resume=RESUME, feed=feed))
+    runner.add('postprocess', postprocess_vhosts, deps=['scrape'])
+    runner.add('dedup', dedup_vhosts, deps=['postprocess'])
+    runner.add('compress', compress_vhosts, deps=['postprocess', 'dedup'])
+    runner.add('ca', generate_CA)
+    runner.add('certs', certs, deps=['ca', 'postprocess'])
+    runner.add('hosts', hosts, deps=['postprocess'])
+    runner.add('nginx', lambda: generate_nginx_conf(TOPGEN_NGINX_SHARDS), deps=['ca', 'postprocess'])
+
+    profiler = cProfile.Profile() if TOPGEN_PROFILE else None
+    exporter = asyncio.create_task(metrics.export_periodically(TOPGEN_METRICS, TOPGEN_METRICS_INTERVAL)) \
+        if TOPGEN_METRICS else None
+    if profiler:
+        profiler.enable()
+    try:
+        await runner.run(selected)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(TOPGEN_PROFILE)
+            logger.info(f"Wrote profile to {TOPGEN_PROFILE}")
+        if exporter:
+            exporter.cancel()
+            metrics.write(TOPGEN_METRICS)
+
     status.update(stage="Finished")
-    # Add cleanup at end of script
-    atexit.register(lambda: shutil.rmtree(TMP_CA_DIR, ignore_errors=True))
-    
 
-asyncio.run(main())
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,443 @@
+#!/bin/python3
+
+# Configure virtual mail service for TopGen
+# (glsomlo@cert.org, February 2016)
+#
+# All domains and accounts listed in the vmail config file are collected
+# in memory, and each postfix/dovecot map is then written out in a single
+# pass. Account ranges (e.g., 'user[1-500]:pass') expand into many
+# accounts sharing a password, passwords (unless stored in PLAIN) are
+# hashed across a pool of worker processes, and maildirs are created in
+# bulk by a pool of worker threads, so thousands of domains with hundreds
+# of accounts each take seconds rather than hours.
+
+import argparse
+import base64
+import hashlib
+import multiprocessing
+import os
+import pwd
+import re
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# input: topgen virtual mail config file
+VMAIL_CFG = '/etc/topgen/vmail.cfg'
+
+# topgen directory structure:
+TOPGEN_VARLIB = '/var/lib/topgen'
+
+# dovecot password scheme for dc_usr_pass ('PLAIN' keeps cram-md5 authentication available):
+PASS_SCHEME = 'PLAIN'
+
+# if True, print a summary of the generated configuration:
+VERBOSE = False
+
+# if True, force/overwrite any prior existing configuration
+FORCE_GEN = False
+
+###########################################################################
+####    NO FURTHER USER-SERVICEABLE PARTS BEYOND THIS POINT !!!!!!!    ####
+###########################################################################
+
+# passwords are hashed in batches of HASH_BATCH across HASH_WORKERS processes:
+HASH_BATCH = 4096
+HASH_WORKERS = os.cpu_count() or 1
+
+# maildirs are created by MAILDIR_WORKERS threads, one domain at a time each:
+MAILDIR_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# salted SHA-2 schemes supported by dovecot's passwd-file driver
+PASS_SCHEMES = {
+    'PLAIN': None,
+    'SSHA256': hashlib.sha256,
+    'SSHA512': hashlib.sha512,
+}
+SALT_SIZE = 8
+
+# account range syntax, e.g. 'user[1-500]' or 'user[001-500]' (zero-padded):
+ACCOUNT_RANGE = re.compile(r'^(.*)\[(\d+)-(\d+)\](.*)$')
+
+MASTER_CF_BASE = '''\
+# service  type private unpriv  chroot  wakeup  maxproc  cmd+args
+# name          (yes)   (yes)   (no)    (never) (100)
+# ======================================================================
+smtp       inet  n       -       n       -       -       smtpd
+submission inet  n       -       n       -       -       smtpd
+    -o smtpd_sasl_auth_enable=yes
+    -o smtpd_recipient_restrictions=permit_sasl_authenticated,reject
+    -o milter_macro_daemon_name=ORIGINATING
+pickup     unix  n       -       n       60      1       pickup
+cleanup    unix  n       -       n       -       0       cleanup
+qmgr       unix  n       -       n       300     1       qmgr
+tlsmgr     unix  -       -       n       1000?   1       tlsmgr
+rewrite    unix  -       -       n       -       -       trivial-rewrite
+bounce     unix  -       -       n       -       0       bounce
+defer      unix  -       -       n       -       0       bounce
+trace      unix  -       -       n       -       0       bounce
+verify     unix  -       -       n       -       1       verify
+flush      unix  n       -       n       1000?   0       flush
+proxymap   unix  -       -       n       -       -       proxymap
+proxywrite unix  -       -       n       -       1       proxymap
+smtp       unix  -       -       n       -       -       smtp
+relay      unix  -       -       n       -       -       smtp
+showq      unix  n       -       n       -       -       showq
+error      unix  -       -       n       -       -       error
+retry      unix  -       -       n       -       -       error
+discard    unix  -       -       n       -       -       discard
+local      unix  -       n       n       -       -       local
+virtual    unix  -       n       n       -       -       virtual
+lmtp       unix  -       -       n       -       -       lmtp
+anvil      unix  -       -       n       -       1       anvil
+scache     unix  -       -       n       -       1       scache
+'''
+
+MASTER_CF_DOMAIN = '''\
+mx_{domain}
+           unix  -       -       n       -       -       smtp
+    -o smtp_helo_name={domain}
+    -o smtp_bind_address={addr}
+'''
+
+MAIN_CF = '''\
+# Local mail: when people email <foo>@topgen.info, local aliases get
+#  mail delivered inside the topgen container, in /var/spool/mail/<foo>
+#
+mydomain = topgen.info
+myhostname = greybox.topgen.info
+mynetworks = 127.0.0.0/8
+mydestination = localhost, $myhostname, localhost.$mydomain, $mydomain
+# if e.g. root tries to read its @topgen.info mail via cmdline,
+#  we need these entries to be local to our container,
+#  and match expected defaults:
+data_directory = /var/lib/postfix
+queue_directory = /var/spool/postfix
+mail_spool_directory = /var/spool/mail
+
+# virtual multi-domain mailserver setup:
+#
+virtual_mailbox_domains = {cfgdir}/pf_virt_dom
+virtual_mailbox_base = {mboxdir}
+virtual_mailbox_maps =
+      texthash:{cfgdir}/pf_usr_mbox
+      static:DFLT
+# use already existing dovenull account numerical uid/gid:
+virtual_uid_maps = static:{uid}
+virtual_gid_maps = static:{gid}
+# if recipient domain not local, use correct sender "personality":
+# (NOTE: map sender domains to transport/service entries in master.cf)
+sender_dependent_default_transport_maps =
+      texthash:{cfgdir}/pf_dom_send
+
+# force remote clients to authenticate:
+# (NOTE: see also "submission" entry in master.cf;
+#        "smtps", identically configured, would listen
+#        on deprecated port 465)
+#
+smtpd_sasl_auth_enable = yes
+smtpd_sasl_type = dovecot
+# auth service socket from dovecot (relative to $queue_directory):
+smtpd_sasl_path = private/auth
+smtpd_client_restrictions =
+      permit_mynetworks,
+      permit_sasl_authenticated,
+      reject
+# enable compatibility with outlook/exchange smtp auth:
+broken_sasl_auth_clients = yes
+
+# force remote clients to use encryption:
+#
+smtpd_tls_security_level = encrypt
+smtpd_tls_cert_file = {cfgdir}/pf_tls.cer
+smtpd_tls_key_file = {cfgdir}/pf_tls.key
+'''
+
+DOVECOT_CONF = '''\
+log_path = /var/log/dovecot.log
+mbox_write_locks = fcntl
+
+ssl = required
+ssl_cert = <{cfgdir}/dc_tls.cer
+ssl_key = <{cfgdir}/dc_tls.key
+
+auth_mechanisms = {mechanisms}
+
+# set domain based on local IP used by client:
+passdb {{
+  driver = passwd-file
+  args = username_format=%l {cfgdir}/dc_addr_dom
+  result_success = continue
+}}
+
+passdb {{
+  driver = passwd-file
+  args = {cfgdir}/dc_usr_pass
+}}
+
+# match postfix location:
+mail_location = maildir:{mboxdir}/%d/%n
+
+userdb {{
+  driver = static
+  args = uid=dovenull gid=dovenull home={mboxdir}/%d/%n
+}}
+
+# auth service available to postfix
+# (as postfix:main.cf:$smtpd_sasl_path):
+service auth {{
+  # "/var/spool/postfix" is postfix:main.cf:$queue_directory;
+  unix_listener /var/spool/postfix/private/auth {{
+    mode = 0660
+    user = postfix
+    group = postfix
+  }}
+}}
+'''
+
+# self-signed TLS certificates for postfix (pf_) and dovecot (dc_):
+#FIXME: maybe this could be the same cert+key, but then we'll HAVE to figure
+#       out SELinux labeling (since postfix wants postfix_etc_t and dovecot
+#       wants dovecot_etc_t, and right now one can't read files labeled for
+#       the other !!!
+TLS_SUBJECTS = {
+    'pf_tls': '/C=US/ST=PA/L=Pgh/O=CMU/OU=CERT/CN=smtp.topgen.info',
+    'dc_tls': '/C=US/ST=PA/L=Pgh/O=CMU/OU=CERT/CN=imap.topgen.info',
+}
+
+
+def warn(msg):
+    print(f'\n{msg}', file=sys.stderr)
+
+
+def fail(msg):
+    sys.exit(f'\nERROR: {msg}\n')
+
+
+def expand_accounts(tokens):
+    """Yield (user, password) pairs from 'user:pass' tokens, expanding 'user[1-500]:pass' ranges"""
+    for token in tokens:
+        # unlike topgen-vmail.sh's ${U%:*}, split at the first colon, so passwords may contain colons:
+        user, _, password = token.partition(':')
+        match = ACCOUNT_RANGE.match(user)
+        if not match:
+            yield user, password
+            continue
+        prefix, first, last, suffix = match.groups()
+        # a leading zero (e.g. 'user[001-500]') asks for zero-padded numbers:
+        width = len(first) if first.startswith('0') else 0
+        for n in range(int(first), int(last) + 1):
+            yield f'{prefix}{n:0{width}d}{suffix}', password
+
+
+def read_vmail_cfg(path):
+    """Return [(host, domain, addr, [(user, password), ...]), ...] for all domains with accounts"""
+    domains = []
+    seen = set()
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.split()
+            # skip if no users:
+            if len(fields) < 3:
+                continue
+            host, addr = fields[:2]
+            domain = host.split('.', 1)[1] if '.' in host else host
+            if domain in seen:
+                warn(f'WARNING: skipping {host}: domain {domain} already configured')
+                continue
+            seen.add(domain)
+            accounts = {}
+            for user, password in expand_accounts(fields[2:]):
+                if user in accounts:
+                    warn(f'WARNING: skipping duplicate account {user}@{domain}')
+                    continue
+                accounts[user] = password
+            domains.append((host, domain, addr, list(accounts.items())))
+    return domains
+
+
+def hash_passwords(scheme, passwords):
+    """Return dovecot password strings ('{SCHEME}...') for a list of passwords"""
+    digest = PASS_SCHEMES[scheme]
+    if digest is None:
+        return [f'{{{scheme}}}{p}' for p in passwords]
+    hashed = []
+    for password in passwords:
+        salt = os.urandom(SALT_SIZE)
+        hashed.append(f'{{{scheme}}}' + base64.b64encode(digest(password.encode() + salt).digest() + salt).decode())
+    return hashed
+
+
+def hash_all(scheme, passwords, workers):
+    """hash_passwords() for all passwords, in batches across a process pool if they need hashing"""
+    if PASS_SCHEMES[scheme] is None or len(passwords) <= HASH_BATCH:
+        return hash_passwords(scheme, passwords)
+    batches = [passwords[i:i + HASH_BATCH] for i in range(0, len(passwords), HASH_BATCH)]
+    # workers start from a forkserver, not as forks of whatever this process is running at the time:
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as pool:
+        return [h for batch in pool.map(hash_passwords, [scheme] * len(batches), batches) for h in batch]
+
+
+def create_maildirs(mboxdir, domain, users, owner):
+    """Create <mboxdir>/<domain>/<user>/{cur,new,tmp} for all users; returns the number created"""
+    created = 0
+    domain_dir = os.path.join(mboxdir, domain)
+    os.makedirs(domain_dir, mode=0o700, exist_ok=True)
+    dirs = [domain_dir]
+    for user in users:
+        maildir = os.path.join(domain_dir, user)
+        try:
+            os.mkdir(maildir, 0o700)
+        except FileExistsError:
+            continue
+        subdirs = [os.path.join(maildir, sub) for sub in ('cur', 'new', 'tmp')]
+        for subdir in subdirs:
+            os.mkdir(subdir, 0o700)
+        dirs.append(maildir)
+        dirs.extend(subdirs)
+        created += 1
+    if owner:
+        for path in dirs:
+            os.chown(path, *owner)
+    return created
+
+
+def write_file(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def main():
+    global VERBOSE
+
+    parser = argparse.ArgumentParser(description="Generate virtual mail server configuration for the (domain, server, users) sets given in a configuration file. Place configuration data under <target_directory>/etc/postfix/, and create a maildir for each account under <target_directory>/vmail/, which must exist and be owned by dovenull:dovenull.", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-c", dest="vmail_cfg", metavar="vmail_config", help=f"file containing virtual mail domain configuration entries, one per line. The format\nof each line is: <hostname>.<domain> <ip_addr> <usr1>:<pw1> <usr2>:...\nwhere 'usr[1-500]:pw' stands for usr1 through usr500, all with password pw\n('usr[001-500]:pw' for zero-padded usr001 through usr500);\n(default: {VMAIL_CFG})", default=VMAIL_CFG)
+    parser.add_argument("-t", dest="target_dir", metavar="target_directory", help=f"directory where all resulting configuration files are stored;\n(default: {TOPGEN_VARLIB})", default=TOPGEN_VARLIB)
+    parser.add_argument("-p", dest="scheme", metavar="scheme", help=f"dovecot password scheme, one of {', '.join(PASS_SCHEMES)}; salted hashes rule out the\ncram-md5 authentication mechanism, which is then not offered;\n(default: {PASS_SCHEME})", choices=list(PASS_SCHEMES), default=PASS_SCHEME)
+    parser.add_argument("-w", dest="workers", metavar="workers", help=f"number of processes hashing passwords;\n(default: {HASH_WORKERS})", type=int, default=HASH_WORKERS)
+    parser.add_argument("-M", dest="maildirs", help="do not create maildirs (dovecot creates them on first login, postfix on first delivery)", action="store_false")
+    parser.add_argument("-f", dest="force", help="don't stop if encountering pre-existing configuration; instead, forcibly remove\nand re-create configuration. CAUTION: pre-existing configuration will be lost!", action="store_true", default=FORCE_GEN)
+    parser.add_argument("-v", dest="verbose", help="print a summary of the generated configuration", action="store_true", default=VERBOSE)
+    args = parser.parse_args()
+    VERBOSE = args.verbose
+
+    # once the target directory is set, these are its relevant subdirectories:
+    cfgdir = os.path.join(args.target_dir, 'etc', 'postfix')
+    mboxdir = os.path.join(args.target_dir, 'vmail')
+    hostfile = os.path.join(args.target_dir, 'etc', 'hosts.vmail')
+
+    # assert existence of required input files and target folders:
+    if not (os.path.isfile(args.vmail_cfg) and os.path.getsize(args.vmail_cfg) > 0 and
+            os.path.isdir(cfgdir) and os.path.isdir(mboxdir)):
+        fail(f'file "{args.vmail_cfg}" and\n'
+             f'       folders "{cfgdir}", and\n'
+             f'               "{mboxdir}" MUST exist\n'
+             f'       before running this command!')
+
+    # assert vmail config folder is empty:
+    if args.force:
+        for entry in os.scandir(cfgdir):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+    if os.listdir(cfgdir):
+        fail(f'folder "{cfgdir}" MUST be empty\n'
+             f'       before running this command!')
+
+    # assert non-existence of vmail hosts file
+    if args.force and os.path.lexists(hostfile):
+        os.remove(hostfile)
+    if os.path.isfile(hostfile) and os.path.getsize(hostfile) > 0:
+        fail(f'file "{hostfile}" must NOT exist!\n'
+             f'       Please remove it manually before re-running this command!')
+
+    # assert mailbox data folder is owned by dovenull:
+    try:
+        dovenull = pwd.getpwnam('dovenull')
+    except KeyError:
+        fail('user "dovenull" does not exist!')
+    if os.stat(mboxdir).st_uid != dovenull.pw_uid:
+        fail(f'folder "{mboxdir}" MUST be owned by "dovenull"!')
+
+    domains = read_vmail_cfg(args.vmail_cfg)
+
+    # If, for some reason, no domain-specific config entries were generated
+    # (e.g., empty vmail config file), skip generating meaningless global configs:
+    if not domains:
+        return
+
+    # generate self-signed TLS certificates in the background, meanwhile building the maps:
+    openssl = [subprocess.Popen(['openssl', 'req', '-subj', subject, '-newkey', 'rsa:2048', '-nodes',
+                                 '-keyout', os.path.join(cfgdir, f'{name}.key'), '-days', '7300', '-x509',
+                                 '-out', os.path.join(cfgdir, f'{name}.cer')], stderr=subprocess.DEVNULL)
+               for name, subject in TLS_SUBJECTS.items()]
+
+    # domain-specific configuration entries:
+    hosts, virt_dom, master_cf, dom_send, addr_dom, usr_mbox, usr_names, passwords = ([] for _ in range(8))
+    for host, domain, addr, accounts in domains:
+        # ipaddr-fqdn pair for the vmail specific hosts file:
+        hosts.append(f'{addr} {host}\n')
+        # domain for postfix:master.cf:$virtual_mailbox_domains
+        virt_dom.append(f'{domain}\n')
+        # domain-specific outbound sender for postfix:master.cf and
+        # postfix:master.cf:$sender_dependent_default_transport_maps
+        master_cf.append(MASTER_CF_DOMAIN.format(domain=domain, addr=addr))
+        dom_send.append(f'{domain} mx_{domain}\n')
+        # domain imap server ip (for dovecot:dovecot.conf)
+        addr_dom.append(f'{addr}:::::::domain={domain}\n')
+        # domain users (pf_usr_mbox for mail dirs, dc_usr_pass for auth):
+        for user, password in accounts:
+            usr_mbox.append(f'{user}@{domain} {domain}/{user}/\n')
+            usr_names.append(f'{user}@{domain}')
+            passwords.append(password)
+
+    usr_pass = [f'{name}:{password}\n' for name, password in
+                zip(usr_names, hash_all(args.scheme, passwords, max(1, args.workers)))]
+
+    write_file(hostfile, ''.join(hosts))
+    write_file(os.path.join(cfgdir, 'pf_virt_dom'), ''.join(virt_dom))
+    write_file(os.path.join(cfgdir, 'master.cf'), MASTER_CF_BASE + ''.join(master_cf))
+    write_file(os.path.join(cfgdir, 'pf_dom_send'), ''.join(dom_send))
+    write_file(os.path.join(cfgdir, 'dc_addr_dom'), ''.join(addr_dom))
+    write_file(os.path.join(cfgdir, 'pf_usr_mbox'), ''.join(usr_mbox))
+    write_file(os.path.join(cfgdir, 'dc_usr_pass'), ''.join(usr_pass))
+
+    # generate fixed (components of) postfix & dovecot config files:
+    write_file(os.path.join(cfgdir, 'main.cf'),
+               MAIN_CF.format(cfgdir=cfgdir, mboxdir=mboxdir, uid=dovenull.pw_uid, gid=dovenull.pw_gid))
+    mechanisms = 'plain login cram-md5' if PASS_SCHEMES[args.scheme] is None else 'plain login'
+    write_file(os.path.join(cfgdir, 'dovecot.conf'),
+               DOVECOT_CONF.format(cfgdir=cfgdir, mboxdir=mboxdir, mechanisms=mechanisms))
+
+    # create all maildirs (owned by dovenull, if we're allowed to chown):
+    created = 0
+    if args.maildirs:
+        owner = (dovenull.pw_uid, dovenull.pw_gid) if os.geteuid() == 0 else None
+        with ThreadPoolExecutor(max_workers=MAILDIR_WORKERS) as pool:
+            created = sum(pool.map(lambda d: create_maildirs(mboxdir, d[1], [u for u, _ in d[3]], owner), domains))
+
+    for proc in openssl:
+        if proc.wait() != 0:
+            fail(f'failed generating TLS certificates in "{cfgdir}"')
+
+    # FIXME: Sort out SELinux policy associated with topgen package !!!
+    # But, for now, let's label the relevant files and folders manually:
+    if os.path.exists('/sys/fs/selinux/enforce') and shutil.which('chcon'):
+        entries = os.listdir(cfgdir)
+        subprocess.run(['chcon', '-t', 'dovecot_etc_t', os.path.join(cfgdir, 'dovecot.conf')] +
+                       [os.path.join(cfgdir, e) for e in entries if e.startswith('dc_')])
+        subprocess.run(['chcon', '-t', 'postfix_etc_t'] +
+                       [os.path.join(cfgdir, e) for e in entries if e.endswith('.cf') or e.startswith('pf_')])
+        subprocess.run(['chcon', '-R', '-t', 'mail_spool_t', mboxdir])
+
+    if VERBOSE:
+        print(f'{len(domains)} domains, {len(usr_names)} accounts ({args.scheme} passwords), '
+              f'{created} maildirs created; configuration written to {cfgdir}')
+
+
+if __name__ == "__main__":
+    main()
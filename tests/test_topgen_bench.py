@@ -0,0 +1,65 @@
+import http.server
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH = os.path.join(ROOT, "sbin", "topgen-bench.py")
+
+# topgen-bench.py isn't an importable module name, so load it by path (load clients, started by
+# a forkserver, import it as topgen_bench through the symlink next to this file):
+spec = importlib.util.spec_from_file_location("topgen_bench", BENCH)
+bench = importlib.util.module_from_spec(spec)
+sys.modules["topgen_bench"] = bench
+spec.loader.exec_module(bench)
+
+
+def test_bench_times_every_stage(tmp_path):
+    work = tmp_path / "work"
+    subprocess.run([sys.executable, BENCH, "-N", "20", "--pages", "1", "--no-load", "--compress", "gzip",
+                    "-w", str(work), "-o", str(tmp_path / "results.json")], check=True, capture_output=True)
+    with open(tmp_path / "results.json") as f:
+        results = json.load(f)
+    assert list(results['stages']) == ["fleet", "postprocess", "compress", "ca", "certs", "hosts", "hosts_cached",
+                                       "nginx", "mkdns"]
+    assert results['params']['vhosts'] == 20 and results['rates']['certs_per_s'] > 0
+
+    # the stages ran for real on the synthetic fleet (plus the topgen.info landing page):
+    vhosts = sorted(os.listdir(work / "vhosts"))
+    assert len(vhosts) == 21 and "topgen.info" in vhosts
+    assert sorted(name[:-len(".cer")] for name in os.listdir(work / "certs")) == vhosts
+    # the signing rate counts the certificates written, the landing page's included:
+    assert results['rates']['certs_per_s'] == round(len(vhosts) / max(results['stages']['certs'], 0.001), 1)
+    with open(work / "etc" / "hosts.nginx") as f:
+        assert sorted(line.split()[1] for line in f) == vhosts
+    assert os.path.exists(work / "etc" / "named.conf")
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = self.headers["Host"].encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_load_clients(tmp_path):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        load = bench.run_load(["a.test", "b.test"], server.server_address[1], tls=False, keepalive=True,
+                              clients=2, connections=2, duration=0.5)
+    finally:
+        server.shutdown()
+    assert load['requests'] > 0 and load['errors'] == 0
+    assert load['requests_per_s'] > 0 and load['latency_p50_ms'] <= load['latency_p99_ms']
@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import importlib.util
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+SBIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sbin")
+
+# topgen-certd.py isn't an importable module name, so load it by path:
+spec = importlib.util.spec_from_file_location("topgen_certd", os.path.join(SBIN, "topgen-certd.py"))
+certd = importlib.util.module_from_spec(spec)
+sys.modules["topgen_certd"] = certd
+spec.loader.exec_module(certd)
+tg = certd.tg
+
+
+@pytest.fixture
+def target(tmp_path, monkeypatch):
+    """Point topgen-certd.py at a scratch TopGen directory"""
+    for name in dir(tg):
+        if name.startswith("TOPGEN_"):
+            monkeypatch.setattr(tg, name, getattr(tg, name))
+    tg.set_target_dir(str(tmp_path))
+    os.makedirs(tg.TOPGEN_VARETC, exist_ok=True)
+    os.makedirs(tg.TOPGEN_LAZY_CERTS, exist_ok=True)
+    return tmp_path
+
+
+def test_sni_names_are_normalized(target):
+    os.makedirs(os.path.join(tg.TOPGEN_VHOSTS, "www.a.test"))
+    cache = certd.CertCache(1, None)
+    service = certd.CertService(cache, None)
+    assert service.vhost("WWW.A.Test.") == "www.a.test"
+    assert service.vhost("www.a.test") == "www.a.test"
+    for sni in ("www.b.test", ".www.a.test", "../a.test", ""):
+        assert service.vhost(sni) is None
+
+    # nginx looks the certificate up by the name as sent:
+    with open(cache.path("www.a.test"), "w") as f:
+        f.write("cert\n")
+    cache.lru["www.a.test"] = 0
+    cache.alias("www.a.test", "WWW.A.Test.")
+    with open(cache.path("WWW.A.Test.")) as f:
+        assert f.read() == "cert\n"
+
+    # aliases survive restarts, and go with their certificate:
+    with open(os.path.join(tg.TOPGEN_VARETC, "topgen_ca.cer"), "w") as f:
+        f.write("ca\n")
+    with open(os.path.join(tg.TOPGEN_LAZY_CERTS, "ca.sha256"), "w") as f:
+        f.write(hashlib.sha256(b"ca\n").hexdigest())
+    cache = certd.CertCache(1, None)
+    cache.load()
+    assert list(cache.lru) == ["www.a.test"] and cache.aliases == {"www.a.test": {"WWW.A.Test."}}
+    # evicted certificates outlive the flush taking their names out of nginx's map:
+    cache.lru["www.c.test"] = 1
+    cache.evict()
+    asyncio.run(cache.flush())
+    with open(tg.TOPGEN_LAZY_MAP) as f:
+        assert f.read() == "www.c.test www.c.test;\n"
+    assert sorted(os.listdir(tg.TOPGEN_LAZY_CERTS)) == ["WWW.A.Test..cer", "ca.sha256", "www.a.test.cer"]
+    asyncio.run(cache.flush())
+    assert os.listdir(tg.TOPGEN_LAZY_CERTS) == ["ca.sha256"]
+
+
+def test_proxy_header():
+    assert certd.parse_proxy_header(b"PROXY TCP4 192.0.2.1 127.0.0.1 1234 443\r\n") == \
+        (("192.0.2.1", 1234), ("127.0.0.1", 443))
+    assert certd.parse_proxy_header(b"PROXY TCP6 2001:db8::1 ::1 1234 443\r\n") == \
+        (("2001:db8::1", 1234), ("::1", 443))
+    assert certd.parse_proxy_header(b"PROXY UNKNOWN\r\n") == (None, None)
+    for line in (b"\x16\x03\x01\x02\x00\x01\n", b"PROXY TCP4 192.0.2.1\r\n", b"PROXY TCP4 a b c d\r\n"):
+        with pytest.raises(ValueError):
+            certd.parse_proxy_header(line)
+
+
+class Backend(threading.Thread):
+    """Stands in for nginx: reads the PROXY header, then completes the TLS handshake with the
+    certificate named after the SNI name as sent ($ssl_server_name), and answers b'pong'"""
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.address = self.sock.getsockname()
+        self.headers = []
+        self.names = []
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def sni(self, sock, name, _):
+        self.names.append(name)
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(os.path.join(tg.TOPGEN_LAZY_CERTS, f"{name}.cer"),
+                            os.path.join(tg.TOPGEN_VARETC, "topgen_vh.key"))
+        sock.context = ctx
+
+    def serve(self, conn):
+        header = b''
+        while not header.endswith(b'\r\n'):
+            data = conn.recv(1)
+            if not data:
+                conn.close()
+                return
+            header += data
+        self.headers.append(header.decode())
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.sni_callback = self.sni
+        with ctx.wrap_socket(conn, server_side=True) as tls:
+            if tls.recv(4) == b'ping':
+                tls.sendall(b'pong')
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.mark.skipif(not shutil.which("openssl"), reason="needs openssl")
+def test_handshake_through_certd(target):
+    asyncio.run(tg.generate_CA())
+    os.makedirs(os.path.join(tg.TOPGEN_VHOSTS, "www.a.test"))
+    ca_cert = os.path.join(tg.TOPGEN_VARETC, "topgen_ca.cer")
+    # signing in threads of this process spares pickling across test modules loading topgen-scrape.py:
+    tg.signer_init(os.path.join(tg.TOPGEN_VARETC, "topgen_ca.key"), ca_cert,
+                   os.path.join(tg.TOPGEN_VARETC, "topgen_vh.key"))
+    backend = Backend()
+    backend.start()
+    client_ctx = ssl.create_default_context(cafile=ca_cert)
+    client_ctx.check_hostname = False
+
+    async def connect(port, name, client_port):
+        # as nginx's stream block passes it on, announcing the client:
+        sock = socket.create_connection(("127.0.0.1", port))
+        sock.sendall(f"PROXY TCP4 192.0.2.1 192.0.2.2 {client_port} 443\r\n".encode())
+        reader, writer = await asyncio.open_connection(sock=sock, ssl=client_ctx, server_hostname=name)
+        try:
+            writer.write(b'ping')
+            return writer.get_extra_info('peercert'), await reader.read()
+        finally:
+            writer.close()
+
+    async def run():
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            reload = [sys.executable, "-c", f"open({str(target / 'reloaded')!r}, 'a').write('x')"]
+            cache = certd.CertCache(10, pool, reload)
+            cache.load()
+            service = certd.CertService(cache, backend.address)
+            server = await asyncio.start_server(service.handle, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                results = [await connect(port, name, 1000 + i) for i, name in enumerate(("www.a.test", "WWW.A.Test"))]
+                with pytest.raises((ssl.SSLError, ConnectionError)):
+                    await connect(port, "www.b.test", 1002)
+                # the new name is passed on to nginx, which serves it without asking from then on:
+                assert cache.flusher is not None
+                await cache.flush()
+            finally:
+                server.close()
+                await server.wait_closed()
+            return port, results, service, cache
+
+    try:
+        port, results, service, cache = asyncio.run(asyncio.wait_for(run(), 60))
+    finally:
+        backend.close()
+
+    # the SNI name reached nginx as sent, which found a certificate for it:
+    assert backend.names == ["www.a.test", "WWW.A.Test"]
+    for i, ((cert, answer), header) in enumerate(zip(results, backend.headers)):
+        assert answer == b'pong'
+        assert cert['subjectAltName'] == (('DNS', 'www.a.test'),)
+        assert header == f"PROXY TCP4 192.0.2.1 192.0.2.2 {1000 + i} 443\r\n"
+    # one certificate was issued, and a connection for a name without a vhost never reached nginx:
+    assert cache.stats['issued'] == 1 and cache.stats['hits'] == 1
+    assert service.stats['rejected'] == 1 and len(backend.headers) == 2
+    with open(tg.TOPGEN_LAZY_MAP) as f:
+        assert f.read() == "www.a.test www.a.test;\n"
+    assert (target / "reloaded").read_text() == "x" and cache.stats['reloads'] == 1
+
+
+@pytest.mark.skipif(not shutil.which("openssl"), reason="needs openssl")
+def test_certd_signs_in_worker_processes(target):
+    asyncio.run(tg.generate_CA())
+    os.makedirs(os.path.join(tg.TOPGEN_VHOSTS, "www.a.test"))
+    backend = Backend()
+    backend.start()
+    with socket.create_server(("127.0.0.1", 0)) as sock:
+        port = sock.getsockname()[1]
+    proc = subprocess.Popen([sys.executable, os.path.join(SBIN, "topgen-certd.py"), "-t", str(target),
+                             "-l", f"127.0.0.1:{port}", "-b", "%s:%d" % backend.address, "-w", "2", "-r", ""])
+    client_ctx = ssl.create_default_context(cafile=os.path.join(tg.TOPGEN_VARETC, "topgen_ca.cer"))
+    client_ctx.check_hostname = False
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                conn = socket.create_connection(("127.0.0.1", port))
+                break
+            except ConnectionRefusedError:
+                assert time.monotonic() < deadline and proc.poll() is None
+                time.sleep(0.1)
+        conn.sendall(b"PROXY UNKNOWN\r\n")
+        with client_ctx.wrap_socket(conn, server_hostname="www.a.test") as tls:
+            tls.sendall(b'ping')
+            assert tls.recv(4) == b'pong'
+            assert tls.getpeercert()['subjectAltName'] == (('DNS', 'www.a.test'),)
+    finally:
+        proc.terminate()
+        proc.wait(30)
+        backend.close()
+    assert proc.returncode == 0
@@ -0,0 +1,51 @@
+import os
+import subprocess
+import sys
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOOPBACK = os.path.join(ROOT, "sbin", "topgen-loopback.py")
+IP = "/usr/sbin/ip"
+
+pytestmark = pytest.mark.skipif(os.geteuid() != 0 or not os.access(IP, os.X_OK),
+                                reason="needs root and iproute2 to create a network namespace")
+
+
+@pytest.fixture
+def netns():
+    """A throwaway network namespace, so the host's loopback interface is never touched"""
+    name = f"topgen-test-{uuid.uuid4().hex[:8]}"
+    subprocess.run([IP, "netns", "add", name], check=True)
+    yield name
+    subprocess.run([IP, "netns", "del", name], check=True)
+
+
+def addresses(netns):
+    output = subprocess.run([IP, "-n", netns, "-o", "addr", "show", "dev", "lo", "scope", "global"],
+                            check=True, capture_output=True, text=True).stdout
+    return sorted(line.split()[3] for line in output.splitlines())
+
+
+def test_loopback_applies_only_the_delta(netns, tmp_path):
+    hosts = tmp_path / "hosts.nginx"
+    state = tmp_path / "loopback.state"
+
+    def provision():
+        return subprocess.run([sys.executable, LOOPBACK, "-N", netns, "-H", str(hosts), "-S", str(state), "-v"],
+                              check=True, capture_output=True, text=True).stdout
+
+    # configured by someone else, and never listed in a hosts file:
+    subprocess.run([IP, "-n", netns, "addr", "add", "192.0.2.1/32", "scope", "global", "dev", "lo"], check=True)
+
+    hosts.write_text("10.0.0.1 a.test\n10.0.0.2 b.test\n# 10.0.0.9 commented.test\nfd00::1 c.test\n")
+    assert "added 3, removed 0" in provision()
+    assert addresses(netns) == ["10.0.0.1/32", "10.0.0.2/32", "192.0.2.1/32", "fd00::1/128"]
+
+    # an unchanged rerun has nothing to do:
+    assert "added 0, removed 0" in provision()
+
+    hosts.write_text("10.0.0.2 b.test\n10.0.0.3 d.test\n")
+    assert "added 1, removed 2" in provision()
+    assert addresses(netns) == ["10.0.0.2/32", "10.0.0.3/32", "192.0.2.1/32"]
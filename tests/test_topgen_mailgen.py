@@ -0,0 +1,52 @@
+import email
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAILGEN = os.path.join(ROOT, "sbin", "topgen-mailgen.py")
+
+VMAIL_CFG = '''mail.a.test 10.0.0.1 alice:pw1 bob:pw2
+mx.b.test 10.0.0.2 user[1-3]:pw
+'''
+
+
+def inject(tmp_path, target, seed):
+    os.makedirs(target / "vmail")
+    output = subprocess.run([sys.executable, MAILGEN, "inject", "-c", str(tmp_path / "vmail.cfg"), "-t", str(target),
+                             "-n", "4", "--size", "2048", "--max-size", "65536", "-w", "2", "--seed", str(seed)],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output)['inject']
+
+
+def mailboxes(target):
+    """{address: sorted [(folder, size, subject)]} of every injected message"""
+    boxes = {}
+    for domain in sorted(os.listdir(target / "vmail")):
+        for user in sorted(os.listdir(target / "vmail" / domain)):
+            messages = boxes[f"{user}@{domain}"] = []
+            for folder in ("cur", "new"):
+                for name in os.listdir(target / "vmail" / domain / user / folder):
+                    with open(target / "vmail" / domain / user / folder / name, "rb") as f:
+                        data = f.read()
+                    assert name.split(",S=")[1].split(":")[0] == str(len(data))
+                    message = email.message_from_bytes(data)
+                    assert message["To"] == f"<{user}@{domain}>"
+                    messages.append((folder, len(data), message["Subject"]))
+            messages.sort()
+    return boxes
+
+
+def test_inject_is_reproducible(tmp_path):
+    (tmp_path / "vmail.cfg").write_text(VMAIL_CFG)
+    first = inject(tmp_path, tmp_path / "first", 42)
+    boxes = mailboxes(tmp_path / "first")
+    assert sorted(boxes) == ["alice@a.test", "bob@a.test", "user1@b.test", "user2@b.test", "user3@b.test"]
+    assert first['mailboxes'] == 5 and first['messages'] == sum(len(m) for m in boxes.values()) > 0
+    assert all(len(m) <= 8 for m in boxes.values())
+
+    # the same seed fills the mailboxes with the same messages:
+    second = inject(tmp_path, tmp_path / "second", 42)
+    assert (second['messages'], second['bytes']) == (first['messages'], first['bytes'])
+    assert mailboxes(tmp_path / "second") == boxes
@@ -0,0 +1,121 @@
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SBIN = os.path.join(ROOT, "sbin")
+
+spec = importlib.util.spec_from_file_location("topgen_mkdns", os.path.join(SBIN, "topgen-mkdns.py"))
+mkdns = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(mkdns)
+
+# one-line empty hash followed by another declaration, quoting styles, and comments:
+DELEGATIONS = '''declare -A DELEGATIONS_FWD=()
+declare -A DELEGATIONS_REV=(
+  ['155.6.4']='ns.x.mil'
+  ['9.9.9']="ns.x.mil ns.y.mil"
+  # ['1.2.3']='commented.out'
+)
+declare -A DELEGATIONS_NS=( ["ns.x.mil"]="155.6.4.10" [ns.y.mil]=155.6.4.11 )
+'''
+
+HOSTS = '''1.2.3.4 www.a.com
+1.2.3.5 a.com
+155.6.4.20 www.x.mil
+9.9.9.9 foo.org
+10.1.1.1 b.org
+'''
+
+
+def bash_hashes(path):
+    """The three delegation hashes, as bash itself reads them"""
+    script = 'source "$1"; for h in DELEGATIONS_FWD DELEGATIONS_REV DELEGATIONS_NS; do ' \
+             'declare -n a=$h; for k in "${!a[@]}"; do printf "%s\\t%s\\t%s\\n" "$h" "$k" "${a[$k]}"; done; done'
+    out = subprocess.run(["bash", "-c", script, "bash", path], capture_output=True, text=True, check=True).stdout
+    hashes = {'DELEGATIONS_FWD': {}, 'DELEGATIONS_REV': {}, 'DELEGATIONS_NS': {}}
+    for line in out.splitlines():
+        name, key, value = line.split('\t')
+        hashes[name][key] = value
+    return tuple(hashes.values())
+
+
+@pytest.mark.skipif(not shutil.which("bash"), reason="needs bash")
+@pytest.mark.parametrize("text", [DELEGATIONS, open(os.path.join(ROOT, "etc", "delegations.dns")).read()])
+def test_read_delegations_matches_bash(tmp_path, text):
+    path = tmp_path / "delegations.dns"
+    path.write_text(text)
+    assert mkdns.read_delegations(str(path)) == bash_hashes(str(path))
+
+
+# output of topgen-mkdns.sh (as it was before the rewrite) for HOSTS, hosts.vmail and
+# DELEGATIONS, with the output directory replaced by OUT:
+EXPECTED = os.path.join(ROOT, "tests", "mkdns_expected")
+
+
+def zone_file(lines):
+    """A zone file as its sequence of directives, SOA and comment lines, with the records in
+    between each pair of those as a sorted group (bash wrote each group in hash order)"""
+    structure, records = [], []
+    for line in lines:
+        if line.startswith(("$", "@", ";")):
+            structure += [tuple(sorted(records)), line] if records else [line]
+            records = []
+        elif line:
+            records.append(line)
+    return structure + [tuple(sorted(records))]
+
+
+def named_conf(lines):
+    """named.conf as its (ordered) top-level statements, each block as the sorted statements
+    and sub-blocks it contains (acl addresses and view zones were written in hash order)"""
+    stack = [("", [])]
+    for line in lines:
+        line = line.strip()
+        if line.endswith("{"):
+            stack.append((line, []))
+        elif line.startswith("}"):
+            header, body = stack.pop()
+            stack[-1][1].append((header, tuple(sorted(body, key=str))))
+        elif line:
+            stack[-1][1].append(line)
+    assert len(stack) == 1, "unbalanced braces"
+    return stack[0][1]
+
+
+def generated(out):
+    """{relative path: structure} of everything generated under out"""
+    files = {}
+    for dirpath, _, filenames in os.walk(out):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            with open(path) as f:
+                lines = f.read().replace(str(out), "OUT").splitlines()
+            relpath = os.path.relpath(path, out)
+            if relpath.endswith(".zone"):
+                files[relpath] = zone_file(lines)
+            elif relpath == "named.conf":
+                files[relpath] = named_conf(lines)
+            else:
+                files[relpath] = sorted(lines)
+    return files
+
+
+def test_output_matches_bash_script(tmp_path):
+    (tmp_path / "hosts.nginx").write_text(HOSTS)
+    (tmp_path / "hosts.vmail").write_text("5.6.7.8 mail.a.com\n")
+    (tmp_path / "delegations.dns").write_text(DELEGATIONS)
+    out = tmp_path / "out"
+    os.makedirs(out / "zones")
+    subprocess.run([sys.executable, os.path.join(SBIN, "topgen-mkdns.py"), "-q",
+                    "-w", str(tmp_path / "hosts.nginx"), "-m", str(tmp_path / "hosts.vmail"),
+                    "-d", str(tmp_path / "delegations.dns"), "-n", str(out / "hosts.named"),
+                    "-c", str(out / "named.conf"), "-z", str(out / "zones")], check=True, capture_output=True)
+    output = generated(out)
+    assert "zones/tldsrv/com.zone" in output
+    for path, structure in generated(EXPECTED).items():
+        assert output.pop(path) == structure, path
+    assert not output, "generated files the bash script did not"
@@ -0,0 +1,767 @@
+import asyncio
+import datetime
+import http.server
+import importlib.util
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+from collections import Counter
+
+import pytest
+from cryptography import x509
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SBIN = os.path.join(ROOT, "sbin")
+
+# topgen-scrape.py isn't an importable module name, so load it by path (worker processes, started
+# by a forkserver, import it as topgen_scrape through the symlink next to this file):
+spec = importlib.util.spec_from_file_location("topgen_scrape", os.path.join(SBIN, "topgen-scrape.py"))
+tg = importlib.util.module_from_spec(spec)
+sys.modules["topgen_scrape"] = tg
+spec.loader.exec_module(tg)
+
+
+def test_import_has_no_side_effects():
+    # topgen-bench.py and topgen-certd.py load this file too, it mustn't configure their process:
+    script = f"""
+import importlib.util, logging, resource
+before = resource.getrlimit(resource.RLIMIT_NOFILE)
+spec = importlib.util.spec_from_file_location("topgen_scrape", {os.path.join(SBIN, "topgen-scrape.py")!r})
+tg = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(tg)
+assert resource.getrlimit(resource.RLIMIT_NOFILE) == before
+assert not logging.getLogger().handlers
+assert not tg.manager.enabled
+"""
+    subprocess.run([sys.executable, "-c", script], check=True)
+
+
+@pytest.fixture
+def target(tmp_path, monkeypatch):
+    """Point topgen-scrape.py at a scratch TopGen directory"""
+    for name in dir(tg):
+        if name.startswith("TOPGEN_"):
+            monkeypatch.setattr(tg, name, getattr(tg, name))
+    tg.set_target_dir(str(tmp_path))
+    return tmp_path
+
+
+def test_scheduler_survives_failing_fetch(monkeypatch):
+    monkeypatch.setattr(tg, "TOPGEN_BACKOFF_BASE", 0)
+    calls = []
+
+    async def fetch(url, depth, budget):
+        calls.append(url)
+        if "broken" in url:
+            raise OSError("cannot spawn wget")
+        return {'returncode': 0, 'files': 1, 'bytes': 1, 'truncated': []}
+
+    done = {}
+    scheduler = tg.ScrapeScheduler(workers=1, per_domain=1, retries=1, fetch=fetch)
+    for url in ("http://broken.example/", "http://ok.example/"):
+        scheduler.submit(tg.ScrapeJob(url, 1, priority=1))
+    asyncio.run(asyncio.wait_for(scheduler.run(lambda job: None,
+                                               lambda job, result: done.update({job.url: result['returncode']})), 10))
+
+    assert done == {"http://broken.example/": -1, "http://ok.example/": 0}
+    # the failed fetch was retried once, and the pool wasn't left a worker short:
+    assert calls.count("http://broken.example/") == 2
+    assert scheduler.failed == 1 and scheduler.outstanding == 0
+
+
+def test_metrics_export(tmp_path, monkeypatch):
+    monkeypatch.setattr(tg, "TOPGEN_METRICS_SITE_BUCKETS", (1, 10))
+    metrics = tg.Metrics()
+    metrics.stage_started("scrape")
+    metrics.site("a.test", {'returncode': 0, 'files': 2, 'bytes': 300, 'truncated': []}, 0.5)
+    metrics.site("b.test", {'returncode': 0, 'files': 1, 'bytes': 100, 'truncated': ["file limit of 1 reached"]}, 5)
+    metrics.site("c.test", {'returncode': 4, 'files': 0, 'bytes': 0, 'truncated': []}, 20)
+    metrics.stage_finished("scrape")
+    metrics.count("certs_signed", 50, stage="certs")
+    metrics.count("cert_signing_seconds", 2)
+
+    metrics.write(str(tmp_path / "metrics.json"))
+    with open(tmp_path / "metrics.json") as f:
+        snapshot = json.load(f)
+    assert snapshot['stages']['scrape']['status'] == 'finished'
+    assert snapshot['counters']['sites{result="truncated"}'] == 1 and snapshot['counters']['site_bytes'] == 400
+    assert snapshot['sites']['c.test'] == {'seconds': 20, 'returncode': 4, 'files': 0, 'bytes': 0, 'truncated': []}
+    assert snapshot['rates'] == {'cert_signing_per_second': 25.0}
+
+    metrics.write(str(tmp_path / "metrics.prom"))
+    prom = (tmp_path / "metrics.prom").read_text().splitlines()
+    assert 'topgen_scrape_sites_total{result="failed"} 1' in prom
+    assert ['topgen_scrape_site_scrape_seconds_bucket{le="1"} 1', 'topgen_scrape_site_scrape_seconds_bucket{le="10"} 2',
+            'topgen_scrape_site_scrape_seconds_bucket{le="+Inf"} 3'] == [l for l in prom if "_bucket" in l]
+    assert 'topgen_scrape_cert_signing_per_second 25.0' in prom
+    # per-site series would not scale, so only the JSON export has them:
+    assert not any("a.test" in line for line in prom)
+
+
+def test_hardlink_dedup_survives_wget_rescrape(target, monkeypatch):
+    vhosts = target / "vhosts"
+    for vhost in ("a.test", "b.test", "cdn.test"):
+        os.makedirs(vhosts / vhost)
+    (vhosts / "a.test" / "index.html").write_text('<img src="http://cdn.test/logo.png">')
+    (vhosts / "b.test" / "index.html").write_text('<img src="logo.png">')
+    for vhost in ("b.test", "cdn.test"):
+        (vhosts / vhost / "logo.png").write_bytes(b"same logo\n")
+    store = tg.DedupStore(tg.TOPGEN_BLOBS, 'hardlink')
+    assert store.deduplicate(tg.TOPGEN_VHOSTS)[0] == 1
+    blob = store.blob_path(tg.DedupStore.digest(vhosts / "b.test" / "logo.png"))
+    # an earlier pass crashed halfway through relinking a file:
+    (vhosts / "cdn.test" / ".topgen-dedup.logo.png").write_bytes(b"same")
+
+    async def wget(url, depth, budget=None):
+        # wget -N rewrites a changed file in place, with --span-hosts also in other hosts' directories:
+        with open(vhosts / "cdn.test" / "logo.png", "r+b") as f:
+            f.write(b"new! logo\n")
+        return {'returncode': 0, 'files': 2, 'bytes': 26, 'truncated': []}
+
+    monkeypatch.setattr(tg, "download_website", wget)
+    # the tree was deduplicated by an earlier run, this one doesn't ask for it:
+    monkeypatch.setattr(tg, "TOPGEN_DEDUP", None)
+    monkeypatch.setattr(tg, "TOPGEN_SCRAPE_ENGINE", 'wget')
+    sites = target / "sites.txt"
+    sites.write_text("http://a.test/\n")
+    monkeypatch.setattr(tg, "TOPGEN_ORIG", str(sites))
+    assert tg.span_reach([("http://a.test/", 1)]) == [str(vhosts / "a.test"), str(vhosts / "cdn.test")]
+    asyncio.run(tg.download_websites())
+
+    assert (vhosts / "cdn.test" / "logo.png").read_bytes() == b"new! logo\n"
+    assert sorted(os.listdir(vhosts / "cdn.test")) == ["logo.png"]
+    # b.test is out of a.test's reach, its files were left linked:
+    assert os.path.samefile(vhosts / "b.test" / "logo.png", blob)
+    with open(blob, "rb") as f:
+        assert f.read() == b"same logo\n"
+
+    # the next deduplication pass links the copies up again:
+    (vhosts / "a.test" / "logo.png").write_bytes(b"new! logo\n")
+    store.deduplicate(tg.TOPGEN_VHOSTS)
+    assert os.path.samefile(vhosts / "a.test" / "logo.png", vhosts / "cdn.test" / "logo.png")
+    assert os.path.samefile(vhosts / "b.test" / "logo.png", blob)
+
+
+def test_reflink_dedup_skips_unchanged_clones(target, monkeypatch):
+    vhosts = target / "vhosts"
+    for vhost in ("a.test", "b.test", "c.test"):
+        os.makedirs(vhosts / vhost)
+        (vhosts / vhost / "logo.png").write_bytes(b"same logo\n")
+    (vhosts / "c.test" / "style.css").write_bytes(b"same css\n")
+    (vhosts / "a.test" / "style.css").write_bytes(b"same css\n")
+    store = tg.DedupStore(tg.TOPGEN_BLOBS, 'reflink')
+    # copies stand in for clones, which the filesystems tests run on may not support:
+    monkeypatch.setattr(store, "clone", lambda src, dst: shutil.copy2(src, dst))
+    assert store.deduplicate(tg.TOPGEN_VHOSTS) == (3, 29)
+    css_blob = store.blob_path(tg.DedupStore.digest(vhosts / "a.test" / "style.css"))
+    assert os.path.exists(css_blob)
+
+    # unchanged clones are neither cloned nor counted again:
+    hashed = []
+    digest = store.digest
+    monkeypatch.setattr(store, "digest", lambda path: hashed.append(path) or digest(path))
+    assert store.deduplicate(tg.TOPGEN_VHOSTS) == (0, 0)
+    assert hashed == []
+
+    # a file changed since gets hashed again, and blobs no file has the content of any more are collected:
+    (vhosts / "a.test" / "style.css").unlink()
+    (vhosts / "c.test" / "style.css").write_bytes(b"new! css\n")
+    assert store.deduplicate(tg.TOPGEN_VHOSTS) == (0, 0)
+    assert hashed == [str(vhosts / "c.test" / "style.css")]
+    assert not os.path.exists(css_blob)
+    assert os.path.exists(store.blob_path(tg.DedupStore.digest(vhosts / "c.test" / "style.css")))
+
+    # a reflinked tree is safe from wget rewriting files in place, nothing gets copied before scraping:
+    assert not store.hardlinked()
+    monkeypatch.setattr(tg, "span_reach", lambda sites: pytest.fail("walked a reflinked tree"))
+    monkeypatch.setattr(tg, "download_website",
+                        lambda url, depth, budget=None: asyncio.sleep(0, {'returncode': 0, 'files': 0, 'bytes': 0,
+                                                                          'truncated': []}))
+    monkeypatch.setattr(tg, "TOPGEN_SCRAPE_ENGINE", 'wget')
+    sites = target / "sites.txt"
+    sites.write_text("http://a.test/\n")
+    monkeypatch.setattr(tg, "TOPGEN_ORIG", str(sites))
+    asyncio.run(tg.download_websites())
+
+
+def test_postprocess_vhosts(target, monkeypatch):
+    monkeypatch.setattr(tg, "TOPGEN_TEMPLATES", os.path.join(ROOT, "templates", "topgen-scrape"))
+    monkeypatch.setattr(tg, "TOPGEN_CUSTOM_VHOSTS", str(target / "custom_vhosts"))
+    vhosts = target / "vhosts"
+    for vhost in ("1.2.3.4", "a.test:8080", "a.test", "www.a.test", "b.test", "www.b.test", "custom.test"):
+        os.makedirs(vhosts / vhost)
+    (vhosts / "a.test" / "index.html").write_text("a")
+    (vhosts / "b.test" / "index.html").write_text("b")
+    (vhosts / "www.b.test" / "index.html").write_text("www.b")
+    (vhosts / "custom.test" / "scraped.html").write_text("scraped")
+    os.makedirs(target / "custom_vhosts" / "custom.test")
+    (target / "custom_vhosts" / "custom.test" / "index.html").write_text("custom")
+
+    asyncio.run(tg.postprocess_vhosts())
+    served = ["a.test", "b.test", "custom.test", "www.a.test", "www.b.test"]
+    assert sorted(os.listdir(vhosts)) == sorted(served + ["topgen.info"])
+    # custom vhosts replace what was scraped:
+    assert os.listdir(vhosts / "custom.test") == ["index.html"]
+    # a lone index.html is copied to the www vhost lacking one, but doesn't replace an existing one:
+    assert (vhosts / "www.a.test" / "index.html").read_text() == "a"
+    assert (vhosts / "www.b.test" / "index.html").read_text() == "www.b"
+    assert re.findall(r'<a href="//([^"]+)">', (vhosts / "topgen.info" / "index.html").read_text()) == served
+
+
+def test_incompressible_files_are_not_recompressed(target, monkeypatch):
+    vhost = target / "vhosts" / "a.test"
+    os.makedirs(vhost)
+    (vhost / "random.js").write_bytes(os.urandom(4096))
+    (vhost / "index.html").write_bytes(b"<p>hello</p>\n" * 1000)
+    asyncio.run(tg.compress_vhosts())
+    assert os.path.exists(vhost / "index.html.gz") and not os.path.exists(vhost / "random.js.gz")
+    with open(tg.TOPGEN_COMPRESS_SKIP) as f:
+        skip = tg.json.load(f)
+    assert list(skip) == [str(vhost / "random.js.gz")]
+
+    def compress(*args, **kwargs):
+        raise AssertionError("compressed again")
+
+    monkeypatch.setattr(tg.gzip, "compress", compress)
+    paths = [str(vhost / "random.js"), str(vhost / "index.html")]
+    assert tg.compress_batch(paths, skip=skip) == (0, 0, 0, skip)
+
+
+def test_sites_file_budgets(target, monkeypatch):
+    monkeypatch.setattr(tg, "TOPGEN_BUDGET_FILES", 100)
+    sites = target / "sites.txt"
+    sites.write_text("# comment\nhttp://a.test/ 2 bytes=1.5K time=2m deny=video/*,.iso\n"
+                     "http://b.test/ files=x http://c.test/\n")
+    (a, a_depth, a_budget), (b, _, b_budget), (c, c_depth, c_budget) = tg.parse_sites(str(sites))
+    assert (a, a_depth, c, c_depth) == ("http://a.test/", 2, "http://c.test/", tg.wget_depth)
+    assert a_budget.limits == {'bytes': 1536, 'files': 100, 'time': 120.0, 'allow': None, 'deny': ['video/*', '.iso']}
+    # an invalid override is ignored, and overrides don't leak into other sites:
+    assert b_budget.limits == c_budget.limits == tg.ScrapeBudget.default().limits
+
+    meter = tg.ScrapeBudget(bytes=100, files=2, deny=["video/*", ".iso"]).meter()
+    assert not meter.wanted("http://a.test/disk.iso")
+    assert not meter.admit("clip", "video/mp4")
+    assert meter.admit("a.html", "text/html") and meter.consume(60)
+    # a file still downloading is stopped once it no longer fits:
+    assert not meter.fits(50)
+    assert meter.exhausted() and not meter.admit("b.html", "text/html")
+    assert meter.report() == ["byte limit of 100 reached", "rejected 1 .iso file(s)", "rejected 1 video/mp4 file(s)"]
+
+
+@pytest.mark.skipif(not os.access("/usr/bin/wget", os.X_OK), reason="needs wget")
+def test_sites_file_values_never_reach_a_shell(target, monkeypatch):
+    monkeypatch.chdir(target)
+    budget = tg.ScrapeBudget(deny=tg.parse_patterns("iso,x';touch pwned;'"))
+    assert budget.wget_options() == ['-R', "iso,x';touch pwned;'"]
+    # nothing listens on the discard port, so wget fails right away:
+    result = asyncio.run(tg.download_website("http://127.0.0.1:9/$(touch pwned)", 1, budget))
+    assert result['returncode'] not in (None, 0)
+    assert not (target / "pwned").exists()
+
+
+SITE = {
+    '/': ('text/html', b'<a href="page1.html">1</a> <a href="about">about</a> <img src="img.png">'
+                       b'<link rel="stylesheet" href="style">'),
+    '/page1.html': ('text/html', b'<a href="page2.html">2</a>'),
+    '/page2.html': ('text/html', b'deep'),
+    '/about': ('text/html', b'<a href="/">home</a>'),
+    '/style': ('text/css', b'body { background: url(bg.png) }'),
+    '/img.png': ('image/png', b'PNG' * 100),
+    '/bg.png': ('image/png', b'BG' * 100),
+}
+
+
+class SiteHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in SITE:
+            self.send_error(404)
+            return
+        content_type, body = SITE[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def site():
+    """A small website on a loopback port, returning its root url"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SiteHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/"
+    server.shutdown()
+    server.server_close()
+
+
+def native_crawl(root, url, depth, budget):
+    pytest.importorskip("httpx")
+
+    async def crawl():
+        crawler = tg.NativeCrawler(str(root))
+        await crawler.start()
+        try:
+            return await crawler.crawl(url, depth, budget)
+        finally:
+            await crawler.close()
+    return asyncio.run(crawl())
+
+
+def saved(root):
+    return sorted(os.path.relpath(os.path.join(d, f), root).split(os.sep, 1)[1]
+                  for d, _, files in os.walk(root) for f in files)
+
+
+def test_native_crawler_follows_links_and_requisites(site, tmp_path):
+    result = native_crawl(tmp_path, site, 1, tg.ScrapeBudget())
+    assert result['returncode'] == 0 and result['truncated'] == []
+    # page2.html is two links deep, about and style get the extension wget would give them:
+    assert saved(tmp_path) == ['about.html', 'bg.png', 'img.png', 'index.html', 'page1.html', 'style.css']
+    assert result['files'] == 6
+    assert result['bytes'] == sum(len(body) for path, (_, body) in SITE.items() if path != '/page2.html')
+    vhost = tmp_path / site.split('/')[2]
+    assert (vhost / 'img.png').read_bytes() == SITE['/img.png'][1]
+    index = (vhost / 'index.html').read_text()
+    assert 'href="about.html"' in index and 'href="style.css"' in index
+
+
+def test_native_crawler_respects_depth(site, tmp_path):
+    native_crawl(tmp_path, site, 0, tg.ScrapeBudget())
+    # requisites are fetched at any depth, links aren't followed:
+    assert saved(tmp_path) == ['bg.png', 'img.png', 'index.html', 'style.css']
+    native_crawl(tmp_path / "deeper", site, 2, tg.ScrapeBudget())
+    assert 'page2.html' in saved(tmp_path / "deeper")
+
+
+def test_native_crawler_respects_budget(site, tmp_path):
+    result = native_crawl(tmp_path / "denied", site, 1, tg.ScrapeBudget(deny=['.png']))
+    assert saved(tmp_path / "denied") == ['about.html', 'index.html', 'page1.html', 'style.css']
+    assert result['truncated'] == ['rejected 2 .png file(s)']
+
+    result = native_crawl(tmp_path / "limited", site, 1, tg.ScrapeBudget(files=2))
+    assert result['files'] == 2 and len(saved(tmp_path / "limited")) == 2
+    assert result['truncated'] == ['file limit of 2 reached']
+
+    result = native_crawl(tmp_path / "small", site, 1, tg.ScrapeBudget(bytes=150))
+    assert 0 < result['bytes'] <= 150
+    assert result['truncated'] == ['byte limit of 150 reached']
+
+
+def test_native_crawler_failure_is_retried(target, monkeypatch):
+    pytest.importorskip("httpx")
+    monkeypatch.setattr(tg, "TOPGEN_SCRAPE_ENGINE", "native")
+    monkeypatch.setattr(tg, "TOPGEN_SCRAPE_RETRIES", 1)
+    monkeypatch.setattr(tg, "TOPGEN_BACKOFF_BASE", 0)
+    calls = []
+
+    async def page(self, url, depth, site):
+        calls.append(url)
+        raise RuntimeError("crawler bug")
+
+    monkeypatch.setattr(tg.NativeCrawler, "page", page)
+    sites = target / "sites.txt"
+    sites.write_text("http://a.test/\n")
+    monkeypatch.setattr(tg, "TOPGEN_ORIG", str(sites))
+    asyncio.run(tg.download_websites())
+
+    assert calls == ["http://a.test/", "http://a.test/"]
+    journal = tg.ScrapeJournal(tg.TOPGEN_JOURNAL)
+    assert journal.db.execute("SELECT state, attempts, returncode FROM sites").fetchall() == [("failed", 2, -1)]
+    journal.close()
+
+
+def test_server_errors_complete_a_scrape(target, monkeypatch):
+    monkeypatch.setattr(tg, "TOPGEN_SCRAPE_ENGINE", "wget")
+    monkeypatch.setattr(tg, "TOPGEN_SCRAPE_RETRIES", 1)
+    monkeypatch.setattr(tg, "TOPGEN_BACKOFF_BASE", 0)
+    # one 404 among a's page requisites, a network failure for b, a protocol error for c:
+    codes = {"http://a.test/": 8, "http://b.test/": 4, "http://c.test/": 7}
+
+    async def wget(url, depth, budget=None):
+        return {'returncode': codes[url], 'files': 1, 'bytes': 10, 'truncated': []}
+
+    monkeypatch.setattr(tg, "download_website", wget)
+    sites = target / "sites.txt"
+    sites.write_text("".join(f"{url}\n" for url in codes))
+    monkeypatch.setattr(tg, "TOPGEN_ORIG", str(sites))
+    asyncio.run(tg.download_websites())
+
+    journal = tg.ScrapeJournal(tg.TOPGEN_JOURNAL)
+    assert journal.db.execute("SELECT url, state, attempts, returncode FROM sites ORDER BY url").fetchall() == [
+        ("http://a.test/", "done", 1, 8), ("http://b.test/", "failed", 2, 4), ("http://c.test/", "failed", 1, 7)]
+    journal.close()
+
+    # only network failures and failed attempts make a domain back off:
+    scheduler = tg.ScrapeScheduler(1, 1, 0)
+    for code in (0, 8, 7):
+        scheduler.record_result("a.test", code)
+    assert scheduler.not_before == {}
+    for code in (4, -1):
+        scheduler.record_result(f"{code}.test", code)
+    assert sorted(scheduler.not_before) == ["-1.test", "4.test"]
+
+
+def test_dns_query_and_parse():
+    query = tg.dns_query("www.A.test.", 0x1234)
+    assert query == (b'\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00'
+                     b'\x03www\x01A\x04test\x00\x00\x01\x00\x01')
+
+    class Transport:
+        def sendto(self, data, addr):
+            self.response = data
+
+    server = tg.StubDNSServer({"www.a.test": "10.0.0.1"}, ttl=600)
+    server.connection_made(Transport())
+    server.datagram_received(query, None)
+    assert tg.dns_parse(server.transport.response) == (0x1234, 0x8180, 0, [("10.0.0.1", 600)])
+    server.datagram_received(tg.dns_query("www.b.test", 7), None)
+    assert tg.dns_parse(server.transport.response) == (7, 0x8183, 3, [])
+
+
+def test_resolve_cache_honours_record_ttls(target, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(tg.time, "time", lambda: now[0])
+
+    async def resolve_all(port, names):
+        cache = tg.ResolveCache(tg.TOPGEN_RESOLVE_CACHE)
+        resolver = tg.Resolver([("127.0.0.1", port)], cache)
+        try:
+            return [await resolver.resolve(name) for name in names], resolver.stats
+        finally:
+            cache.close()
+
+    async def run():
+        records = {"long.test": "10.0.0.1", "short.test": "10.0.0.2"}
+        long_transport, long_port = await tg.StubDNSServer.start(records, ttl=3600)
+        short_transport, short_port = await tg.StubDNSServer.start(records, ttl=10)
+        try:
+            results = [await resolve_all(long_port, ["long.test", "nx.test"]),
+                       await resolve_all(short_port, ["short.test"])]
+            # a TTL shorter than the floor is cached for the floor:
+            now[0] += tg.TOPGEN_RESOLVE_MIN_TTL - 1
+            results.append(await resolve_all(long_port, ["long.test", "short.test", "nx.test"]))
+            now[0] += 2
+            results.append(await resolve_all(short_port, ["long.test", "short.test"]))
+            # a longer one for the record's TTL, not a week:
+            now[0] += 3600
+            results.append(await resolve_all(long_port, ["long.test", "nx.test"]))
+            return results
+        finally:
+            long_transport.close()
+            short_transport.close()
+
+    monkeypatch.setattr(tg, "TOPGEN_RESOLVE_NEGATIVE_TTL", 3600)
+    results = asyncio.run(run())
+    addresses = [r[0] for r in results]
+    cached = [r[1]['cached'] for r in results]
+    assert addresses == [["10.0.0.1", None], ["10.0.0.2"], ["10.0.0.1", "10.0.0.2", None],
+                         ["10.0.0.1", "10.0.0.2"], ["10.0.0.1", None]]
+    assert cached == [0, 0, 3, 1, 0]
+
+
+def test_resume_scrapes_only_unfinished_sites(target, monkeypatch):
+    monkeypatch.setattr(tg, "TOPGEN_SCRAPE_WORKERS", 1)
+    monkeypatch.setattr(tg, "TOPGEN_SCRAPE_RETRIES", 0)
+    order = []
+    interrupt = [True]
+
+    async def fetch(url, depth, budget=None):
+        order.append(url)
+        if "c.test" in url and interrupt[0]:
+            # the first run is interrupted while scraping c.test:
+            await asyncio.Event().wait()
+        return {'returncode': 6 if "b.test" in url else 0, 'files': 1, 'bytes': 1, 'truncated': []}
+
+    monkeypatch.setattr(tg, "download_website", fetch)
+    sites = target / "sites.txt"
+    monkeypatch.setattr(tg, "TOPGEN_ORIG", str(sites))
+    sites.write_text("http://a.test/\nhttp://b.test/\nhttp://c.test/\n")
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(tg.download_websites(), 1))
+    assert order == ["http://a.test/", "http://b.test/", "http://c.test/"]
+    journal = tg.ScrapeJournal(tg.TOPGEN_JOURNAL)
+    assert journal.counts() == {'done': 1, 'failed': 1, 'running': 1}
+    journal.close()
+
+    # the failed and interrupted sites are scraped again, along with one added since:
+    order.clear()
+    interrupt[0] = False
+    sites.write_text("http://a.test/\nhttp://b.test/\nhttp://c.test/\nhttp://d.test/\n")
+    asyncio.run(tg.download_websites(resume=True))
+    assert sorted(order) == ["http://b.test/", "http://c.test/", "http://d.test/"]
+    journal = tg.ScrapeJournal(tg.TOPGEN_JOURNAL)
+    assert journal.counts() == {'done': 3, 'failed': 1}
+    journal.close()
+
+
+@pytest.mark.parametrize("scrape_order", ["fastest", "slowest"])
+def test_sites_start_in_scrape_order(target, monkeypatch, scrape_order):
+    now = [1000000.0]
+    monkeypatch.setattr(tg.time, "time", lambda: now[0])
+    took = {"http://a.test/": (10, 1000), "http://b.test/": (100, 500)}
+    order = []
+
+    async def fetch(url, depth, budget=None):
+        order.append(url)
+        seconds, size = took.get(url, (1, 1))
+        now[0] += seconds
+        return {'returncode': 0, 'files': 1, 'bytes': size, 'truncated': []}
+
+    monkeypatch.setattr(tg, "download_website", fetch)
+    monkeypatch.setattr(tg, "TOPGEN_SCRAPE_WORKERS", 1)
+    monkeypatch.setattr(tg, "TOPGEN_SCRAPE_ORDER", scrape_order)
+    sites = target / "sites.txt"
+    monkeypatch.setattr(tg, "TOPGEN_ORIG", str(sites))
+    sites.write_text("http://a.test/\nhttp://b.test/\n")
+    asyncio.run(tg.download_websites())
+    assert order == ["http://a.test/", "http://b.test/"]
+
+    # the history survives the journal being reset by the next run, which adds two sites:
+    order.clear()
+    sites.write_text("http://a.test/\nhttp://b.test/\nhttp://c.test/ 2\nhttp://d.test/ 1\n")
+    asyncio.run(tg.download_websites())
+    known = ["http://a.test/", "http://b.test/"]
+    assert order == ["http://d.test/", "http://c.test/"] + (known if scrape_order == "fastest" else known[::-1])
+    journal = tg.ScrapeJournal(tg.TOPGEN_JOURNAL)
+    assert journal.history()["http://b.test/"] == (500, 100)
+    journal.close()
+
+
+def test_wget_spawn_failure_is_retried(target, monkeypatch):
+    async def spawn(*args, **kwargs):
+        raise FileNotFoundError("/usr/bin/wget")
+
+    monkeypatch.setattr(tg.asyncio, "create_subprocess_exec", spawn)
+    assert asyncio.run(tg.download_website("http://a.test/"))['returncode'] == -1
+
+
+# the openssl CA configuration vhost certificates used to be issued with (CertificateAuthority.conf):
+OPENSSL_CA_CONF = """[ ca ]
+default_ca = topgen_ca
+
+[ topgen_ca ]
+private_key = {varetc}/topgen_ca.key
+certificate = {varetc}/topgen_ca.cer
+new_certs_dir = {ca_dir}
+database = {ca_dir}/index
+serial = {ca_dir}/serial
+default_days = 3650
+default_md = sha512
+copy_extensions = copy
+unique_subject = no
+policy = topgen_ca_policy
+x509_extensions = topgen_ca_ext
+
+[ topgen_ca_policy ]
+countryName = supplied
+stateOrProvinceName = supplied
+localityName = supplied
+organizationName = supplied
+organizationalUnitName = supplied
+commonName = supplied
+
+[ topgen_ca_ext ]
+basicConstraints = CA:false
+nsCertType = server
+nsComment = "TopGen CA Generated Certificate"
+subjectKeyIdentifier = hash
+authorityKeyIdentifier = keyid,issuer:always
+"""
+
+
+def openssl_certificate(target, name):
+    """Issue a certificate for name the way it was done before signing moved in-process"""
+    ca_dir = target / "openssl-ca"
+    os.makedirs(ca_dir)
+    (ca_dir / "serial").write_text("000a\n")
+    (ca_dir / "index").write_text("")
+    (ca_dir / "ca.conf").write_text(OPENSSL_CA_CONF.format(varetc=tg.TOPGEN_VARETC, ca_dir=ca_dir))
+    csr = subprocess.run(["openssl", "req", "-new", "-key", os.path.join(tg.TOPGEN_VARETC, "topgen_vh.key"),
+                          "-subj", "/C=US/ST=PA/L=Pgh/O=CMU/OU=CERT/CN=topgen_vh",
+                          "-addext", f"subjectAltName = DNS:{name}"],
+                         capture_output=True, check=True).stdout
+    subprocess.run(["openssl", "ca", "-batch", "-notext", "-config", str(ca_dir / "ca.conf"),
+                    "-out", str(ca_dir / "vhost.cer"), "-in", "-"], input=csr, capture_output=True, check=True)
+    return x509.load_pem_x509_certificate((ca_dir / "vhost.cer").read_bytes())
+
+
+@pytest.mark.skipif(not shutil.which("openssl"), reason="needs openssl")
+def test_sign_batch_matches_openssl(target):
+    asyncio.run(tg.generate_CA())
+    tg.signer_init(*(os.path.join(tg.TOPGEN_VARETC, f) for f in ("topgen_ca.key", "topgen_ca.cer", "topgen_vh.key")))
+    paths = [str(target / "certs" / "www.a.test.cer"), str(target / "certs" / "shared.cer")]
+    assert tg.sign_batch([(paths[0], ["www.a.test"]), (paths[1], ["a.test", "www.a.test", "b.test"])]) == 2
+    single, shared = (x509.load_pem_x509_certificate(open(path, "rb").read()) for path in paths)
+    old = openssl_certificate(target, "www.a.test")
+
+    def extensions(cert):
+        return [(e.oid, e.critical, e.value) for e in cert.extensions]
+    assert extensions(single) == extensions(old)
+    for cert in (single, shared):
+        assert cert.subject == old.subject and cert.issuer == old.issuer
+        assert cert.signature_hash_algorithm.name == old.signature_hash_algorithm.name == "sha512"
+        assert cert.public_key() == old.public_key()
+        assert cert.not_valid_after_utc - cert.not_valid_before_utc == datetime.timedelta(days=3650)
+    assert extensions(shared)[:-1] == extensions(old)[:-1]
+    assert shared.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(
+        x509.DNSName) == ["a.test", "www.a.test", "b.test"]
+
+
+def nginx_server_names(target):
+    """{shard file: Counter of server names} of the shards nginx.conf includes, checked against the manifest"""
+    shards_dir = target / "etc" / "nginx.d"
+    includes = re.findall(r"^include (.*);$", (target / "etc" / "nginx.conf").read_text(), re.M)
+    manifest = json.loads((shards_dir / "manifest.json").read_text())
+    assert sorted(os.path.basename(path) for path in includes) == sorted(manifest)
+    assert sorted(p.name for p in shards_dir.glob("vhosts-*.conf")) == sorted(manifest)
+    return {os.path.basename(path): Counter(name for names in re.findall(r"server_name (.*);", open(path).read())
+                                            for name in names.split())
+            for path in includes}
+
+
+@pytest.mark.parametrize("mode", ["vhost", "domain", "bucket", "lazy"])
+def test_nginx_shards_cover_every_vhost_once(target, monkeypatch, mode):
+    monkeypatch.setattr(tg, "TOPGEN_TEMPLATES", os.path.join(ROOT, "templates", "topgen-scrape"))
+    monkeypatch.setattr(tg, "TOPGEN_CERT_MODE", mode)
+    monkeypatch.setattr(tg, "TOPGEN_CERT_BUCKET", 4)
+    vhosts = [f"{host}.site{i}.test" for i in range(20) for host in ("www", "img")]
+    for vhost in vhosts:
+        os.makedirs(target / "vhosts" / vhost)
+
+    asyncio.run(tg.generate_nginx_conf(8))
+    names = nginx_server_names(target)
+    assert len(names) == 8
+    assert sum(names.values(), Counter()) == Counter(vhosts)
+    inodes = {shard: os.stat(target / "etc" / "nginx.d" / shard).st_ino for shard in names}
+
+    # a new vhost rewrites only the shard it lands in:
+    os.makedirs(target / "vhosts" / "www.new.test")
+    asyncio.run(tg.generate_nginx_conf(8))
+    names = nginx_server_names(target)
+    assert sum(names.values(), Counter()) == Counter(vhosts + ["www.new.test"])
+    rewritten = [shard for shard in names if os.stat(target / "etc" / "nginx.d" / shard).st_ino != inodes[shard]]
+    assert rewritten == [shard for shard in names if "www.new.test" in names[shard]]
+
+    # fewer shards leave none of the old ones behind:
+    asyncio.run(tg.generate_nginx_conf(3))
+    names = nginx_server_names(target)
+    assert len(names) == 3
+    assert sum(names.values(), Counter()) == Counter(vhosts + ["www.new.test"])
+
+
+@pytest.mark.parametrize("mode", ["vhost", "domain", "lazy"])
+def test_server_blocks_only_serve_vhosts(target, monkeypatch, mode):
+    monkeypatch.setattr(tg, "TOPGEN_TEMPLATES", os.path.join(ROOT, "templates", "topgen-scrape"))
+    monkeypatch.setattr(tg, "TOPGEN_CERT_MODE", mode)
+    vhosts = ["www.a.test", "img.a.test", "www.b.test"]
+    for vhost in vhosts:
+        os.makedirs(target / "vhosts" / vhost)
+    asyncio.run(tg.generate_nginx_conf(2))
+    shards = "".join(p.read_text() for p in (target / "etc" / "nginx.d").glob("vhosts-*.conf"))
+    roots = re.findall(r"^\s*root (.*);$", shards, re.M)
+    if mode == "vhost":
+        # one server block per vhost, serving its own directory:
+        assert sorted(roots) == sorted(str(target / "vhosts" / vhost) for vhost in vhosts)
+        return
+
+    # a Host header naming anything but a vhost gets the connection closed:
+    vhosts_map = target / "etc" / "nginx.d" / "vhosts.map"
+    assert vhosts_map.read_text() == "img.a.test img.a.test;\nwww.a.test www.a.test;\nwww.b.test www.b.test;\n"
+    assert f'map $host $topgen_vhost {{\n\tdefault "";\n\tinclude {vhosts_map};\n}}' in \
+        (target / "etc" / "nginx.conf").read_text()
+    assert set(roots) == {str(target / "vhosts" / "$topgen_vhost")}
+    assert shards.count('if ($topgen_vhost = "") {\n\t      return 444;\n\t  }') == len(roots)
+
+
+def test_lazy_nginx_conf_routes_by_sni(target, monkeypatch):
+    monkeypatch.setattr(tg, "TOPGEN_TEMPLATES", os.path.join(ROOT, "templates", "topgen-scrape"))
+    monkeypatch.setattr(tg, "TOPGEN_CERT_MODE", "lazy")
+    for vhost in ("www.a.test", "www.b.test"):
+        os.makedirs(target / "vhosts" / vhost)
+    asyncio.run(tg.generate_nginx_conf(2))
+
+    # the stream block sends names with a certificate to the vhost server blocks, others to topgen-certd.py:
+    stream = (target / "etc" / "nginx-stream.conf").read_text()
+    assert "ssl_preread on;" in stream and "proxy_protocol on;" in stream
+    assert f"include {tg.TOPGEN_LAZY_MAP};" in stream
+    assert f'"" {tg.TOPGEN_LAZY_CERTD};' in stream and f"default {tg.TOPGEN_LAZY_BACKEND};" in stream
+    conf = (target / "etc" / "nginx.conf").read_text()
+    assert f"map $ssl_server_name $topgen_lazy_cert {{\n\thostnames;\n\tdefault $ssl_server_name;\n" \
+           f"\tinclude {tg.TOPGEN_LAZY_MAP};\n}}" in conf
+    shards = "".join(p.read_text() for p in (target / "etc" / "nginx.d").glob("vhosts-*.conf"))
+    assert f"ssl_certificate {tg.TOPGEN_LAZY_CERTS}/$topgen_lazy_cert.cer;" in shards
+
+    # the map is topgen-certd.py's to maintain:
+    assert (target / "etc" / "lazy_certs.map").read_text() == ""
+    (target / "etc" / "lazy_certs.map").write_text("www.a.test www.a.test;\n")
+    asyncio.run(tg.generate_nginx_conf(2))
+    assert (target / "etc" / "lazy_certs.map").read_text() == "www.a.test www.a.test;\n"
+
+    # other modes leave nothing for the top level of nginx.conf to serve:
+    monkeypatch.setattr(tg, "TOPGEN_CERT_MODE", "vhost")
+    asyncio.run(tg.generate_nginx_conf(2))
+    assert all(line.startswith("#") for line in (target / "etc" / "nginx-stream.conf").read_text().splitlines())
+
+
+def test_cert_groups(target):
+    names = ([f"www{i}.example.com" for i in range(7)] + ["www.bbc.co.uk", "news.bbc.co.uk", "bbc.co.uk"] +
+             ["www.other.org"])
+    assert tg.cert_groups(names, 'vhost') == {os.path.join(tg.TOPGEN_CERTS, f"{name}.cer"): [name] for name in names}
+
+    # grouped by registered domain, and split at the SAN limit:
+    groups = {os.path.basename(path).rsplit('-', 1)[0]: names for path, names in tg.cert_groups(names, 'domain', 3).items()}
+    assert groups == {"example.com.0": ["www0.example.com", "www1.example.com", "www2.example.com"],
+                      "example.com.1": ["www3.example.com", "www4.example.com", "www5.example.com"],
+                      "example.com.2": ["www6.example.com"],
+                      "bbc.co.uk": ["bbc.co.uk", "news.bbc.co.uk", "www.bbc.co.uk"],
+                      "other.org": ["www.other.org"]}
+
+    # hash buckets filled above average are split too:
+    fleet = [f"www.site{i}.test" for i in range(1500)]
+    for mode in ("domain", "bucket"):
+        certs = tg.cert_groups(fleet, mode, 100)
+        assert all(os.path.dirname(path) == tg.TOPGEN_SHARED_CERTS for path in certs)
+        assert max(len(names) for names in certs.values()) <= 100
+        assert sorted(name for names in certs.values() for name in names) == sorted(fleet)
+
+    # certificates are named after the names they cover, so only changed groups get reissued:
+    before = tg.cert_groups(names, 'domain', 3)
+    after = tg.cert_groups(names + ["mail.other.org"], 'domain', 3)
+    assert set(before) - set(after) == {path for path, group in before.items() if group == ["www.other.org"]}
+
+
+def test_failed_stage_cancels_the_rest():
+    class Status:
+        def update(self, **fields):
+            pass
+
+    async def run():
+        runner = tg.StageRunner(Status())
+        never = asyncio.Event()
+        # like presign_certificates waiting on a scrape that will never feed it again:
+        presign = runner.background(never.wait())
+
+        async def scrape():
+            raise RuntimeError("scrape failed")
+
+        async def certs():
+            await presign
+
+        runner.add('scrape', scrape)
+        runner.add('certs', certs)
+        runner.add('nginx', never.wait)
+        with pytest.raises(RuntimeError, match="scrape failed"):
+            await asyncio.wait_for(runner.run({'scrape', 'certs', 'nginx'}), 5)
+        return runner, presign
+
+    runner, presign = asyncio.run(run())
+    assert presign.cancelled()
+    assert runner.running == []
@@ -0,0 +1,83 @@
+import base64
+import importlib.util
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SBIN = os.path.join(ROOT, "sbin")
+
+# topgen-vmail.py isn't an importable module name, so load it by path (hashing processes, started
+# by a forkserver, import it as topgen_vmail through the symlink next to this file):
+spec = importlib.util.spec_from_file_location("topgen_vmail", os.path.join(SBIN, "topgen-vmail.py"))
+vmail = importlib.util.module_from_spec(spec)
+sys.modules["topgen_vmail"] = vmail
+spec.loader.exec_module(vmail)
+
+VMAIL_CFG = '''# comment
+mail.a.test 10.0.0.1 alice:pw1 bob:pw2
+mx.b.test 10.0.0.2 carol:pw3 dave:pw4
+nousers.c.test 10.0.0.3
+smtp.a.test 10.0.0.9 mallory:pw9
+'''
+
+
+# configuration topgen-vmail.sh (as it was before the rewrite) generated for VMAIL_CFG, less its repeated
+# a.test domain (configured twice by topgen-vmail.sh, skipped by topgen-vmail.py), with the target
+# directory replaced by TARGET and dovenull's uid/gid by UID/GID:
+EXPECTED = os.path.join(ROOT, "tests", "vmail_expected")
+
+
+def generated(target, uid=None, gid=None):
+    """{relative path: content} of the configuration generated under target"""
+    files = {}
+    for dirpath, _, filenames in os.walk(target):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            # TLS keys and certificates are freshly generated by each run:
+            if "_tls." not in name:
+                with open(path) as f:
+                    files[os.path.relpath(path, target)] = f.read().replace(str(target), "TARGET") \
+                        .replace(f"virtual_uid_maps = static:{uid}\n", "virtual_uid_maps = static:UID\n") \
+                        .replace(f"virtual_gid_maps = static:{gid}\n", "virtual_gid_maps = static:GID\n")
+    return files
+
+
+@pytest.mark.skipif(not shutil.which("openssl"), reason="needs openssl")
+def test_output_matches_bash_script(tmp_path, monkeypatch, capsys):
+    target = tmp_path / "target"
+    os.makedirs(target / "etc" / "postfix")
+    os.makedirs(target / "vmail")
+    (tmp_path / "vmail.cfg").write_text(VMAIL_CFG)
+
+    monkeypatch.setattr(vmail.pwd, "getpwnam",
+                        lambda name: vmail.pwd.struct_passwd((name, "x", os.getuid(), os.getgid(), "", "/", "/sbin/nologin")))
+    monkeypatch.setattr(sys, "argv", ["topgen-vmail.py", "-c", str(tmp_path / "vmail.cfg"), "-t", str(target), "-M"])
+    vmail.main()
+    assert "skipping smtp.a.test: domain a.test already configured" in capsys.readouterr().err
+
+    python = generated(target, os.getuid(), os.getgid())
+    assert "etc/postfix/master.cf" in python and "mallory@a.test" not in python["etc/postfix/pf_usr_mbox"]
+    assert python == generated(EXPECTED)
+    for name in ("pf_tls.cer", "pf_tls.key", "dc_tls.cer", "dc_tls.key"):
+        assert os.path.getsize(target / "etc" / "postfix" / name) > 0
+
+
+def test_passwords_may_contain_colons():
+    # topgen-vmail.sh took the user name up to the last colon, and the password from the first one on
+    # ('u:a:b' became user 'u:a' with password 'a:b'); the user name now ends at the first colon:
+    assert list(vmail.expand_accounts(["u:a:b", "v[1-2]::"])) == [("u", "a:b"), ("v1", ":"), ("v2", ":")]
+
+
+def test_passwords_hashed_in_worker_processes(monkeypatch):
+    monkeypatch.setattr(vmail, "HASH_BATCH", 2)
+    passwords = [f"pw{i}" for i in range(5)]
+    hashed = vmail.hash_all("SSHA256", passwords, 2)
+    assert len(hashed) == len(passwords)
+    for password, entry in zip(passwords, hashed):
+        assert entry.startswith("{SSHA256}")
+        raw = base64.b64decode(entry[len("{SSHA256}"):])
+        digest, salt = raw[:-vmail.SALT_SIZE], raw[-vmail.SALT_SIZE:]
+        assert digest == vmail.hashlib.sha256(password.encode() + salt).digest()
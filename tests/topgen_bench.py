@@ -0,0 +1 @@
+../sbin/topgen-bench.py
\ No newline at end of file
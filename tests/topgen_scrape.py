@@ -0,0 +1 @@
+../sbin/topgen-scrape.py
\ No newline at end of file
@@ -0,0 +1 @@
+../sbin/topgen-vmail.py
\ No newline at end of file